@@ -1,9 +1,24 @@
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context
 from datetime import datetime, timedelta
+from urllib.parse import urlencode
+import hashlib
 import os
+import time
 from database import db
-from market_service import MarketService
-from config import FRIENDS, ALL_MEALS
+from market_service import MarketService, InvalidBatch, decode_trade_cursor, expiry_from_unix, time_from_unix
+from market_events import broker
+from market_cache import current_sequence, to_json
+from order_book import order_books
+from matching_engine import engine
+from ipo_auction import ipo_auction
+from risk import liquidator
+from maintenance import maintainer
+import instrumentation
+from config import (
+    FRIENDS, ALL_MEALS, MAX_BATCH_ORDERS, STREAM_HEARTBEAT_INTERVAL, STREAM_MAX_DURATION,
+    MATCHING_ENGINE, IPO_BATCHING, RISK_LIQUIDATION_INTERVAL, MAINTENANCE_INTERVAL, CANDLE_INTERVALS, CANDLE_DEFAULT_LIMIT, LEADERBOARD_SIZE,
+    TRADE_PAGE_DEFAULT, TRADE_PAGE_MAX
+)
 from init_db import init_database
 
 app = Flask(__name__)
@@ -28,9 +43,28 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
 # Initialize database
 db.init_app(app)
 
+# Per-request query, latency and matching metrics at /metrics (off unless INSTRUMENTATION=1)
+instrumentation.init_app(app, db)
+
 # Create tables and initialize data
 with app.app_context():
     init_database()
+    MarketService.start_journal()
+    order_books.load_all()
+
+# Optional group-commit matching thread (off unless MATCHING_ENGINE is set)
+if MATCHING_ENGINE:
+    engine.start(app, MarketService._run_write)
+
+# Optional per-tick IPO batches (off unless IPO_BATCHING is set)
+if IPO_BATCHING:
+    ipo_auction.start(app, MarketService._run_write)
+
+# Optional background liquidation of margin breaches (off unless RISK_LIQUIDATION_INTERVAL is set)
+liquidator.start(app, MarketService.liquidate_margin_breaches, RISK_LIQUIDATION_INTERVAL)
+
+# Background order expiry and history archiving (off if MAINTENANCE_INTERVAL is 0)
+maintainer.start(app, MarketService.run_maintenance, MAINTENANCE_INTERVAL)
 
 @app.route('/')
 def index():
@@ -55,16 +89,68 @@ def current_user():
     user = session.get('user')
     if user:
         user_obj = MarketService.get_user(user)
+        worth = MarketService.get_net_worth(user)
         return jsonify({
             'username': user,
             'balance': user_obj.balance,
+            'available_balance': user_obj.balance - user_obj.held_balance,
+            'net_worth': worth['net_worth'],
+            'short_exposure': worth['short_exposure'],
             'ipo_price': MarketService.get_current_ipo_price()
         })
     return jsonify({'username': None}), 401
 
+def json_bytes(body):
+    """Wrap pre-serialized JSON bytes in a response"""
+    return app.response_class(body, mimetype='application/json')
+
+def conditional_json(etag, build):
+    """Answer 304 if the client already holds this version, otherwise call build for the JSON bytes
+    
+    Tags are derived from the market sequence, so checking one costs a single
+    primary-key read and nothing else is queried for a 304.
+    """
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = json_bytes(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def request_tag(name, *parts):
+    """ETag for this request: name, parts and a digest of the normalized path and query string
+    
+    Requests for a different meal, filter or page never share a tag, even at
+    the same market version.
+    """
+    query = urlencode(sorted(request.args.items(multi=True)))
+    digest = hashlib.sha1(f"{request.path}?{query}".encode('utf-8')).hexdigest()[:16]
+    return '-'.join([name, *map(str, parts), digest])
+
+def time_arg(name):
+    """Optional ?name= query argument in unix seconds as naive UTC; ValueError if it is not a time"""
+    if name not in request.args:
+        return None
+    try:
+        return time_from_unix(float(request.args[name]))
+    except ValueError:
+        raise ValueError("Invalid start/end") from None
+
+def expires_at_arg(time_in_force):
+    """The order's expires_at (unix seconds) as naive UTC; ValueError if malformed or, for GTD, already past"""
+    expires_at = expiry_from_unix(request.json.get('expires_at'))
+    if time_in_force == 'GTD' and expires_at is not None and expires_at <= datetime.utcnow():
+        raise ValueError("Expiry time has already passed")
+    return expires_at
+
 @app.route('/api/market_summary')
 def market_summary():
-    return jsonify(MarketService.get_market_summary())
+    version = current_sequence()
+    ipo_state, body = MarketService.cached_market_summary(version)
+    # The summary embeds the IPO price, which ticks with the clock rather than the sequence
+    ipo_price = MarketService.ipo_price_at(*ipo_state)
+    return conditional_json(request_tag("summary", version, ipo_price), lambda: body)
 
 @app.route('/api/start_ipo', methods=['POST'])
 def start_ipo():
@@ -100,8 +186,13 @@ def secondary_buy():
     price = request.json.get('price')
     qty = request.json.get('qty')
     snap_buy = request.json.get('snap_buy', False)
+    time_in_force = str(request.json.get('time_in_force', 'GTC')).upper()
+    try:
+        expires_at = expires_at_arg(time_in_force)
+    except ValueError as error:
+        return jsonify({'success': False, 'message': str(error)}), 400
     
-    success, message, trades = MarketService.place_buy_order(user, meal, price, qty, snap_buy)
+    success, message, trades = MarketService.place_buy_order(user, meal, price, qty, snap_buy, time_in_force, expires_at)
     return jsonify({'success': success, 'message': message, 'trades': trades})
 
 @app.route('/api/sell', methods=['POST'])
@@ -114,26 +205,237 @@ def sell():
     price = request.json.get('price')
     qty = request.json.get('qty')
     is_short = request.json.get('is_short', False)
+    time_in_force = str(request.json.get('time_in_force', 'GTC')).upper()
+    try:
+        expires_at = expires_at_arg(time_in_force)
+    except ValueError as error:
+        return jsonify({'success': False, 'message': str(error)}), 400
     
-    success, message, trades = MarketService.place_sell_order(user, meal, price, qty, is_short)
+    success, message, trades = MarketService.place_sell_order(user, meal, price, qty, is_short, time_in_force, expires_at)
     return jsonify({'success': success, 'message': message, 'trades': trades})
 
+@app.route('/api/orders/batch', methods=['POST'])
+def batch_orders():
+    if 'user' not in session:
+        return jsonify({'success': False, 'message': 'Not logged in'}), 401
+    
+    user = session['user']
+    orders = request.json.get('orders') or []
+    atomic = request.json.get('mode', 'atomic') != 'best_effort'
+    
+    if not isinstance(orders, list) or len(orders) > MAX_BATCH_ORDERS:
+        return jsonify({'success': False, 'message': f'Send a list of at most {MAX_BATCH_ORDERS} orders'}), 400
+    
+    try:
+        success, message, results = MarketService.place_orders(user, orders, atomic)
+    except InvalidBatch as invalid:
+        return jsonify({'success': False, 'message': str(invalid), 'results': invalid.results}), 400
+    return jsonify({'success': success, 'message': message, 'results': results})
+
+@app.route('/api/my_orders')
+def my_orders():
+    if 'user' not in session:
+        return jsonify({'success': False, 'message': 'Not logged in'}), 401
+    
+    user = session['user']
+    meal = request.args.get('meal')
+    version = current_sequence()
+    return conditional_json(
+        request_tag("orders", version, user),
+        lambda: to_json(MarketService.get_user_orders(user, meal))
+    )
+
+@app.route('/api/orders/<int:order_id>/cancel', methods=['POST'])
+def cancel_order(order_id):
+    if 'user' not in session:
+        return jsonify({'success': False, 'message': 'Not logged in'}), 401
+    
+    success, message = MarketService.cancel_order(order_id, session['user'])
+    return jsonify({'success': success, 'message': message})
+
+@app.route('/api/orders/cancel_all', methods=['POST'])
+def cancel_all_orders():
+    if 'user' not in session:
+        return jsonify({'success': False, 'message': 'Not logged in'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    meal = data.get('meal') if isinstance(data, dict) else None
+    if not isinstance(data, dict) or (meal is not None and not isinstance(meal, str)):
+        return jsonify({'success': False, 'message': 'Invalid meal', 'cancelled': 0}), 400
+    success, message, cancelled = MarketService.cancel_all_orders(session['user'], meal, data.get('side'))
+    return jsonify({'success': success, 'message': message, 'cancelled': cancelled})
+
 @app.route('/api/portfolio')
 def portfolio():
     if 'user' not in session:
         return jsonify({'success': False, 'message': 'Not logged in'}), 401
     
     user = session['user']
-    return jsonify(MarketService.get_portfolio(user))
+    version = current_sequence()
+    return conditional_json(
+        request_tag("portfolio", version, user),
+        lambda: to_json(MarketService.get_portfolio(user, version=version))
+    )
 
 @app.route('/api/trade_history')
 def trade_history():
-    return jsonify(MarketService.get_trade_history(limit=20))
+    """Trade history, newest first
+    
+    Without parameters this is the cached tape of the last 20 trades. Filters:
+    meal, user, side (BUY or SELL, with user), start and end (unix seconds),
+    order=asc for oldest first, archived=1 to include trades moved to the
+    archive. Pages hold up to `limit` trades; pass the X-Next-Cursor header
+    back as ?cursor= for the next one. With
+    ?format=ndjson (or Accept: application/x-ndjson) every matching trade is
+    streamed as one JSON object per line.
+    """
+    args = request.args
+    ndjson = args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson'
+    version = current_sequence()
+    if not args and not ndjson:
+        return conditional_json(
+            request_tag("trades", version),
+            lambda: MarketService.get_trade_history_json(limit=20, version=version)
+        )
+    
+    side = args.get('side', '').upper() or None
+    if side not in (None, 'BUY', 'SELL') or (side and not args.get('user')):
+        return jsonify({'success': False, 'message': 'side must be BUY or SELL and needs a user'}), 400
+    try:
+        cursor = decode_trade_cursor(args['cursor']) if 'cursor' in args else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
+    try:
+        start, end = time_arg('start'), time_arg('end')
+    except ValueError as exc:
+        return jsonify({'success': False, 'message': str(exc)}), 400
+    filters = {
+        'meal_name': args.get('meal'),
+        'username': args.get('user'),
+        'side': side,
+        'start': start,
+        'end': end,
+        'cursor': cursor,
+        'ascending': args.get('order') == 'asc',
+        'include_archived': args.get('archived') in ('1', 'true')
+    }
+    
+    if ndjson:
+        trades = MarketService.iter_trades(limit=args.get('limit', type=int), **filters)
+        return Response(
+            stream_with_context(to_json(trade) + b'\n' for trade in trades),
+            mimetype='application/x-ndjson'
+        )
+    
+    limit = min(max(1, args.get('limit', TRADE_PAGE_DEFAULT, type=int)), TRADE_PAGE_MAX)
+    page = {}
+    def build():
+        trades, page['next_cursor'] = MarketService.get_trade_page(limit=limit, **filters)
+        return to_json(trades)
+    # Nothing is queried for a 304; the client still holds the page and its cursor
+    response = conditional_json(request_tag("trades", version), build)
+    if page.get('next_cursor'):
+        response.headers['X-Next-Cursor'] = page['next_cursor']
+    return response
 
 @app.route('/api/order_book/<meal>')
 def order_book(meal):
-    return jsonify(MarketService.get_order_book(meal))
+    version = current_sequence()
+    return conditional_json(
+        request_tag("book", version),
+        lambda: MarketService.get_order_book_json(meal, version=version)
+    )
+
+@app.route('/api/leaderboard')
+def leaderboard():
+    limit = max(1, request.args.get('limit', LEADERBOARD_SIZE, type=int))
+    version = current_sequence()
+    return conditional_json(
+        request_tag("leaderboard", version),
+        lambda: to_json(MarketService.get_leaderboard(limit, version=version))
+    )
+
+@app.route('/api/candles/<meal>')
+def candles(meal):
+    """OHLCV bars: ?interval=1s|1m|5m|1h, optional ?start= and ?end= (unix seconds) and ?limit="""
+    interval = request.args.get('interval', '1m')
+    limit = request.args.get('limit', CANDLE_DEFAULT_LIMIT, type=int)
+    if interval not in CANDLE_INTERVALS:
+        return jsonify({'success': False, 'message': f"interval must be one of {', '.join(CANDLE_INTERVALS)}"}), 400
+    try:
+        start, end = time_arg('start'), time_arg('end')
+    except ValueError as exc:
+        return jsonify({'success': False, 'message': str(exc)}), 400
+    
+    version = current_sequence()
+    def build():
+        bars = MarketService.get_candles(meal, interval, start, end, limit)
+        return to_json({'meal': meal, 'interval': interval, 'candles': bars})
+    return conditional_json(request_tag("candles", version), build)
+
+def sse(event, data):
+    """Format one server-sent event; data may be pre-serialized JSON bytes"""
+    if not isinstance(data, bytes):
+        data = to_json(data)
+    return b'event: %s\ndata: %s\n\n' % (event.encode('utf-8'), data)
+
+@app.route('/api/stream')
+def stream():
+    """Live market data: an initial snapshot followed by incremental updates"""
+    if 'user' not in session:
+        return jsonify({'success': False, 'message': 'Not logged in'}), 401
+    
+    user = session['user']
+    subscription = broker.subscribe(user)
+    broker.watch(app)
+    
+    def snapshot():
+        ipo_state, body = MarketService.get_stream_snapshot(user)
+        db.session.remove()  # don't hold a pooled connection for the life of the stream
+        return ipo_state, body
+    
+    def generate():
+        try:
+            ipo_state, body = snapshot()
+            ipo_price = MarketService.ipo_price_at(*ipo_state)
+            yield sse('snapshot', body)
+            
+            deadline = time.monotonic() + STREAM_MAX_DURATION
+            next_heartbeat = time.monotonic() + STREAM_HEARTBEAT_INTERVAL
+            while time.monotonic() < deadline:
+                event, data = subscription.get(timeout=1.0)
+                if event == 'resync':
+                    subscription.clear()
+                    ipo_state, body = snapshot()
+                    ipo_price = MarketService.ipo_price_at(*ipo_state)
+                    yield sse('snapshot', body)
+                elif event is not None:
+                    yield sse(event, data)
+                
+                # The IPO price only depends on the clock, so tick it here
+                current_ipo_price = MarketService.ipo_price_at(*ipo_state)
+                if current_ipo_price != ipo_price:
+                    ipo_price = current_ipo_price
+                    yield sse('ipo', {'ipo_price': ipo_price, 'ipo_active': ipo_state[1]})
+                
+                if time.monotonic() >= next_heartbeat:
+                    next_heartbeat = time.monotonic() + STREAM_HEARTBEAT_INTERVAL
+                    yield b': keep-alive\n\n'
+        finally:
+            broker.unsubscribe(subscription)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/metrics')
+def metrics():
+    if not instrumentation.enabled():
+        return jsonify({'success': False, 'message': 'Instrumentation is disabled'}), 404
+    return Response(instrumentation.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8000))
-    app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
\ No newline at end of file
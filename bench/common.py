@@ -0,0 +1,118 @@
+"""
+Shared helpers for the Dining Exchange benchmarks
+
+Benchmarks run against a scratch database: a temporary SQLite file by
+default, or whatever BENCH_DATABASE_URL points at (its tables are dropped).
+"""
+import os
+import random
+import tempfile
+import time
+from flask import Flask
+from sqlalchemy import event, insert
+from database import db, User, Meal, Order
+from init_db import init_database
+
+
+def scratch_database_url():
+    """BENCH_DATABASE_URL, or a new temporary SQLite file"""
+    database_url = os.environ.get('BENCH_DATABASE_URL')
+    if not database_url:
+        fd, path = tempfile.mkstemp(prefix='bench_', suffix='.db')
+        os.close(fd)
+        database_url = 'sqlite:///' + path
+    return database_url
+
+
+def create_bench_app(database_url=None, reset=True):
+    """Create a Flask app bound to a freshly initialized scratch database
+
+    With reset=False the app attaches to the database as it is, e.g. in a
+    worker process of a multi-process benchmark.
+    """
+    database_url = database_url or scratch_database_url()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+
+    if reset:
+        with app.app_context():
+            db.drop_all()
+            init_database()
+    return app
+
+
+def seed_orders(count, seed=0):
+    """Bulk insert `count` active limit orders spread around a per-meal mid price"""
+    rng = random.Random(seed)
+    user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+    meal_ids = [meal_id for (meal_id,) in db.session.query(Meal.id)]
+    mids = {meal_id: rng.uniform(20, 150) for meal_id in meal_ids}
+
+    rows = []
+    for _ in range(count):
+        meal_id = rng.choice(meal_ids)
+        user_id = rng.choice(user_ids)
+        side = rng.choice(('BID', 'ASK'))
+        offset = round(rng.uniform(0.5, 15.0), 2)
+        qty = rng.randint(1, 10)
+        rows.append({
+            'meal_id': meal_id,
+            'order_type': side,
+            'price': round(mids[meal_id] - offset if side == 'BID' else mids[meal_id] + offset, 2),
+            'quantity': qty,
+            'remaining_quantity': qty,
+            'buyer_id': user_id if side == 'BID' else None,
+            'seller_id': user_id if side == 'ASK' else None,
+            'status': 'ACTIVE'
+        })
+
+    for start in range(0, len(rows), 10000):
+        db.session.execute(insert(Order), rows[start:start + 10000])
+    db.session.commit()
+
+
+class QueryCounter:
+    """Count statements and commits issued on an engine while active"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.queries = 0
+        self.commits = 0
+
+    def _on_execute(self, *args):
+        self.queries += 1
+
+    def _on_commit(self, *args):
+        self.commits += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        event.listen(self.engine, 'commit', self._on_commit)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+        event.remove(self.engine, 'commit', self._on_commit)
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def time_call(func, iterations):
+    """Call func repeatedly and return the per-call latencies in milliseconds"""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000.0)
+        db.session.remove()
+    return samples
@@ -0,0 +1,208 @@
+"""
+Contention benchmark: several worker processes trading against one database
+
+Each worker is a separate process with its own app, in-memory order books
+and reference cache, exactly like a gunicorn worker. All of them hammer the
+same few meals with IPO buys, limit buys, short sells and cancels, plus
+(with --reads) the order book, portfolio and open-order reads that make up
+most real traffic. Reports read and write throughput for each worker count,
+then checks the market invariants (no overdrawn balance, no oversold
+supply, cash and shares conserved, every balance and position equal to
+what the trade tape implies) and exits non-zero if any is violated.
+
+Writes from every worker serialize on the market sequence lock, so write
+throughput is bounded by one writer whatever the worker count; reads take
+no lock and scale with workers up to the number of CPU cores. Rows with
+more workers than usable cores are marked, since those workers only take
+turns on the same cores.
+
+Usage: python -m bench.contention [worker counts...] [--ops N] [--reads FRACTION] [--meals N] [--supply N]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from sqlalchemy import update
+from database import db, User, Meal, Position, Order, Trade
+from market_service import MarketService
+from config import FRIENDS, ALL_MEALS, INITIAL_BALANCE
+from bench.common import create_bench_app, scratch_database_url
+
+EPSILON = 1e-6
+
+
+def usable_cores():
+    """CPU cores this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def worker(database_url, seed, ops, reads, meals, start, results):
+    """Run `ops` random market operations, `reads` of them reads on average, once `start` is set"""
+    app = create_bench_app(database_url, reset=False)
+    rng = random.Random(seed)
+    errors = 0
+    read_count = 0
+    with app.app_context():
+        start.wait()
+        began = time.perf_counter()
+        for _ in range(ops):
+            user = rng.choice(FRIENDS)
+            meal = rng.choice(meals)
+            quantity = rng.randint(1, 5)
+            price = round(rng.uniform(40, 60), 2)
+            roll = rng.random()
+            try:
+                if rng.random() < reads:
+                    read_count += 1
+                    if roll < 0.4:
+                        MarketService.get_order_book_json(meal)
+                    elif roll < 0.7:
+                        MarketService.get_portfolio(user)
+                    else:
+                        MarketService.get_user_orders(user)
+                elif roll < 0.15:
+                    MarketService.buy_from_ipo(user, meal, quantity)
+                elif roll < 0.55:
+                    MarketService.place_buy_order(user, meal, price, quantity)
+                elif roll < 0.9:
+                    MarketService.place_sell_order(user, meal, price, quantity, is_short=True)
+                else:
+                    MarketService.cancel_all_orders(user, meal)
+            except Exception:
+                # e.g. SQLite giving up on a busy lock; counted, not fatal
+                db.session.rollback()
+                errors += 1
+            db.session.remove()
+        results.put((time.perf_counter() - began, errors, read_count))
+
+
+def check_invariants(supply):
+    """Describe every violated market invariant"""
+    violations = []
+    users = {user.id: user for user in User.query}
+    meals = {meal.id: meal for meal in Meal.query}
+    trades = Trade.query.all()
+
+    cash = defaultdict(float)
+    shares = defaultdict(int)
+    ipo_shares = defaultdict(int)
+    ipo_cash = 0.0
+    for trade in trades:
+        cost = trade.price * trade.quantity
+        cash[trade.buyer_id] -= cost
+        shares[(trade.buyer_id, trade.meal_id)] += trade.quantity
+        if trade.seller_id:
+            cash[trade.seller_id] += cost
+            shares[(trade.seller_id, trade.meal_id)] -= trade.quantity
+        else:
+            ipo_shares[trade.meal_id] += trade.quantity
+            ipo_cash += cost
+
+    for user in users.values():
+        if user.balance < -EPSILON:
+            violations.append(f"{user.username} overdrawn: {user.balance:.2f}")
+        if abs(user.balance - (INITIAL_BALANCE + cash[user.id])) > EPSILON * INITIAL_BALANCE:
+            violations.append(f"{user.username} balance {user.balance:.2f} != trade tape {INITIAL_BALANCE + cash[user.id]:.2f}")
+
+    total_cash = sum(user.balance for user in users.values())
+    if abs(total_cash - (INITIAL_BALANCE * len(users) - ipo_cash)) > EPSILON * INITIAL_BALANCE * len(users):
+        violations.append(f"cash not conserved: {total_cash:.2f}")
+
+    for meal in meals.values():
+        if meal.house_supply < 0:
+            violations.append(f"{meal.name} oversold: supply {meal.house_supply}")
+        if meal.house_supply + ipo_shares[meal.id] != supply:
+            violations.append(f"{meal.name} supply {meal.house_supply} + IPO fills {ipo_shares[meal.id]} != {supply}")
+
+    held = defaultdict(int)
+    for position in Position.query:
+        held[position.meal_id] += position.shares
+        if position.shares != shares[(position.user_id, position.meal_id)]:
+            violations.append(f"position {position.user_id}/{position.meal_id} {position.shares} != trade tape")
+    for meal_id, quantity in ipo_shares.items():
+        if held[meal_id] != quantity:
+            violations.append(f"{meals[meal_id].name} shares held {held[meal_id]} != IPO fills {quantity}")
+
+    for order in Order.query:
+        if order.remaining_quantity < 0:
+            violations.append(f"order {order.id} overfilled: {order.remaining_quantity}")
+        if (order.status == 'FILLED') != (order.remaining_quantity == 0):
+            violations.append(f"order {order.id} is {order.status} with {order.remaining_quantity} left")
+
+    return violations
+
+
+def run(workers, ops, reads, meal_count, supply):
+    database_url = scratch_database_url()
+    app = create_bench_app(database_url)
+    meals = ALL_MEALS[:meal_count]
+    with app.app_context():
+        # Scarce supply so IPO buys actually race for the last shares
+        db.session.execute(update(Meal).values(house_supply=supply))
+        db.session.commit()
+        MarketService.start_ipo()
+        db.session.remove()
+
+    context = multiprocessing.get_context('spawn')
+    start = context.Event()
+    results = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(database_url, seed, ops, reads, meals, start, results))
+        for seed in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    time.sleep(1.0)  # let every worker import and connect before the clock starts
+    start.set()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    elapsed = max(seconds for seconds, _, _ in outcomes)
+    read_count = sum(count for _, _, count in outcomes)
+    with app.app_context():
+        violations = check_invariants(supply)
+        trades = Trade.query.count()
+    return {
+        'workers': workers,
+        'ops': workers * ops,
+        'reads_per_sec': read_count / elapsed,
+        'writes_per_sec': (workers * ops - read_count) / elapsed,
+        'trades': trades,
+        'errors': sum(errors for _, errors, _ in outcomes),
+        'violations': violations
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('workers', nargs='*', type=int, default=[1, 2, 4])
+    parser.add_argument('--ops', type=int, default=300, help='operations per worker')
+    parser.add_argument('--reads', type=float, default=0.0, help='fraction of operations that are reads')
+    parser.add_argument('--meals', type=int, default=2, help='number of meals traded')
+    parser.add_argument('--supply', type=int, default=100, help='house supply per meal')
+    args = parser.parse_args()
+
+    cores = usable_cores()
+    print(f"{cores} usable CPU core(s); * marks rows with more workers than cores")
+    print(f"{'Workers':>7} | {'Ops':>6} | {'Reads/sec':>9} | {'Writes/sec':>10} | {'Trades':>6} | {'Errors':>6} | {'Violations':>10}")
+    print("-" * 74)
+    failed = False
+    for workers in args.workers:
+        row = run(workers, args.ops, args.reads, args.meals, args.supply)
+        label = f"{row['workers']}{'*' if workers > cores else ''}"
+        print(f"{label:>7} | {row['ops']:>6} | {row['reads_per_sec']:>9.1f} | {row['writes_per_sec']:>10.1f} | "
+              f"{row['trades']:>6} | {row['errors']:>6} | {len(row['violations']):>10}")
+        for violation in row['violations'][:20]:
+            print(f"    {violation}")
+        failed = failed or bool(row['violations'])
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Microbenchmark the in-memory Market used by cli.py
+
+Rests N non-crossing orders spread over every meal, then times a stream
+of incoming orders that cross the spread and match. Only the public
+Market API is used.
+
+Usage: python -m bench.market_model [resting order counts...] [--orders N]
+"""
+import argparse
+import random
+import time
+from models import Market
+from config import FRIENDS, ALL_MEALS
+
+
+def seed_market(count, seed=0):
+    """A market with `count` resting orders, asks above 100 and bids below it"""
+    rng = random.Random(seed)
+    market = Market()
+    for user in FRIENDS:
+        market.balances[user] = 1e15
+    for _ in range(count):
+        user = rng.choice(FRIENDS)
+        meal = rng.choice(ALL_MEALS)
+        quantity = rng.randint(1, 10)
+        if rng.random() < 0.5:
+            market.place_sell_order(user, meal, round(rng.uniform(100.5, 150), 2), quantity, is_short=True)
+        else:
+            market.place_buy_order(user, meal, round(rng.uniform(50, 99.5), 2), quantity)
+    return market
+
+
+def run(resting, orders, seed=1):
+    began = time.perf_counter()
+    market = seed_market(resting)
+    seeded = time.perf_counter() - began
+
+    rng = random.Random(seed)
+    incoming = [
+        (rng.choice(FRIENDS), rng.choice(ALL_MEALS), rng.random() < 0.5, rng.randint(1, 20))
+        for _ in range(orders)
+    ]
+    trades = 0
+    began = time.perf_counter()
+    for user, meal, is_buy, quantity in incoming:
+        # Aggressive enough to sweep a few levels, never so far as to clear the book
+        if is_buy:
+            _, _, executed = market.place_buy_order(user, meal, 101.0, quantity, snap_buy=True)
+        else:
+            _, _, executed = market.place_sell_order(user, meal, 99.0, quantity, is_short=True)
+        trades += len(executed)
+    elapsed = time.perf_counter() - began
+
+    return {
+        'resting': resting,
+        'seed_per_sec': resting / seeded if seeded else 0.0,
+        'orders_per_sec': orders / elapsed,
+        'trades': trades
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('resting', nargs='*', type=int, default=[10000, 100000, 1000000])
+    parser.add_argument('--orders', type=int, default=10000, help='incoming crossing orders to time')
+    args = parser.parse_args()
+
+    print(f"{'Resting':>8} | {'Rests/sec':>10} | {'Orders/sec':>10} | {'Trades':>7}")
+    print("-" * 46)
+    for resting in args.resting:
+        row = run(resting, args.orders)
+        print(f"{row['resting']:>8} | {row['seed_per_sec']:>10.0f} | {row['orders_per_sec']:>10.0f} | {row['trades']:>7}")
+
+
+if __name__ == '__main__':
+    main()
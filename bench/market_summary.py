@@ -0,0 +1,75 @@
+"""
+Benchmark get_market_summary: queries per request and latency
+
+Compares the original per-meal implementation (one best-ask and one
+best-bid query per meal) with the grouped aggregate in MarketService.
+
+Usage: python -m bench.market_summary [order counts...] [--iterations N]
+"""
+import argparse
+from database import db, Meal
+from market_service import MarketService
+from bench.common import create_bench_app, seed_orders, QueryCounter, percentile, time_call
+
+
+def legacy_market_summary():
+    """The original get_market_summary: 1 + 2 x meals queries"""
+    state = MarketService.get_or_create_market_state()
+    summary = {
+        'ipo_price': MarketService.get_current_ipo_price(state),
+        'ipo_active': state.ipo_active,
+        'meals': []
+    }
+    for meal in Meal.query.all():
+        best_ask = MarketService.get_best_ask(meal.id)
+        best_bid = MarketService.get_best_bid(meal.id)
+        summary['meals'].append({
+            'id': meal.id,
+            'name': meal.name,
+            'category': meal.category,
+            'house_supply': meal.house_supply,
+            'best_ask': best_ask.price if best_ask else None,
+            'best_bid': best_bid.price if best_bid else None,
+            'spread': (best_ask.price - best_bid.price) if (best_ask and best_bid) else None
+        })
+    return summary
+
+
+def run(order_count, iterations):
+    app = create_bench_app()
+    results = []
+    with app.app_context():
+        seed_orders(order_count)
+        assert legacy_market_summary()['meals'] == MarketService.get_market_summary()['meals']
+
+        for name, func in (('before', legacy_market_summary), ('after', MarketService.get_market_summary)):
+            with QueryCounter(db.engine) as counter:
+                func()
+            db.session.remove()
+            samples = time_call(func, iterations)
+            results.append({
+                'implementation': name,
+                'active_orders': order_count,
+                'queries_per_request': counter.queries,
+                'p50_ms': percentile(samples, 50),
+                'p99_ms': percentile(samples, 99)
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('orders', nargs='*', type=int, default=[1000, 100000])
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'Impl':<8} | {'Orders':>8} | {'Queries':>7} | {'p50 ms':>9} | {'p99 ms':>9}")
+    print("-" * 52)
+    for order_count in args.orders:
+        for row in run(order_count, args.iterations):
+            print(f"{row['implementation']:<8} | {row['active_orders']:>8} | {row['queries_per_request']:>7} | "
+                  f"{row['p50_ms']:>9.2f} | {row['p99_ms']:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
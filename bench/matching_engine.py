@@ -0,0 +1,80 @@
+"""
+Benchmark the group-commit matching thread against matching on the request thread
+
+Client threads (standing in for gunicorn's request threads) place limit
+buys and short sells across every meal. Compares orders per second and
+commits per order with the engine off and on.
+
+Usage: python -m bench.matching_engine [--clients N] [--orders N]
+"""
+import argparse
+import random
+import threading
+import time
+from database import db
+from market_service import MarketService
+from matching_engine import engine
+from config import FRIENDS, ALL_MEALS
+from bench.common import create_bench_app, QueryCounter
+
+
+def client(app, seed, orders, start):
+    rng = random.Random(seed)
+    with app.app_context():
+        start.wait()
+        for _ in range(orders):
+            user = rng.choice(FRIENDS)
+            meal = rng.choice(ALL_MEALS)
+            price = round(rng.uniform(40, 60), 2)
+            quantity = rng.randint(1, 5)
+            if rng.random() < 0.5:
+                MarketService.place_buy_order(user, meal, price, quantity)
+            else:
+                MarketService.place_sell_order(user, meal, price, quantity, is_short=True)
+            db.session.remove()
+
+
+def run(enabled, clients, orders):
+    app = create_bench_app()
+    if enabled:
+        engine.start(app, MarketService._run_write)
+    start = threading.Event()
+    threads = [
+        threading.Thread(target=client, args=(app, seed, orders, start))
+        for seed in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+
+    with app.app_context(), QueryCounter(db.engine) as counter:
+        began = time.perf_counter()
+        start.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - began
+    engine.stop()
+
+    total = clients * orders
+    return {
+        'engine': 'on' if enabled else 'off',
+        'orders': total,
+        'orders_per_sec': total / elapsed,
+        'commits_per_order': counter.commits / total
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=16, help='concurrent client threads')
+    parser.add_argument('--orders', type=int, default=100, help='orders per client')
+    args = parser.parse_args()
+
+    print(f"{'Engine':>6} | {'Orders':>6} | {'Orders/sec':>10} | {'Commits/order':>13}")
+    print("-" * 46)
+    for enabled in (False, True):
+        row = run(enabled, args.clients, args.orders)
+        print(f"{row['engine']:>6} | {row['orders']:>6} | {row['orders_per_sec']:>10.1f} | {row['commits_per_order']:>13.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Synthetic order flow for the throughput benchmarks
+
+Produces a reproducible stream of market operations: IPO buying while the
+price decays, limit orders placed around a drifting per-meal mid price,
+occasional aggressive sweeps through several levels, short sells, cancels
+and market-summary reads. Every operation is a plain dict, so the same
+flow can drive MarketService, models.Market or the HTTP API.
+"""
+import random
+from config import FRIENDS, ALL_MEALS
+
+# Relative frequency of each kind of operation once the IPO phase is over
+MIX = (
+    ('limit_buy', 30),
+    ('limit_sell', 20),
+    ('short', 10),
+    ('sweep', 8),
+    ('cancel', 7),
+    ('read', 25),
+)
+
+
+class OrderFlow:
+    """Reproducible stream of market operations for a set of users and meals"""
+
+    def __init__(self, seed=0, users=FRIENDS, meals=ALL_MEALS, ipo_fraction=0.1):
+        self.rng = random.Random(seed)
+        self.users = list(users)
+        self.meals = list(meals)
+        self.ipo_fraction = ipo_fraction
+        self.mids = {meal: self.rng.uniform(40, 120) for meal in self.meals}
+        self.kinds = [kind for kind, _ in MIX]
+        self.weights = [weight for _, weight in MIX]
+
+    def operations(self, count):
+        """Yield `count` operations, the first ipo_fraction of them IPO buys"""
+        ipo_ops = int(count * self.ipo_fraction)
+        for index in range(count):
+            if index < ipo_ops:
+                yield self._ipo()
+            else:
+                yield self._next()
+
+    def _ipo(self):
+        return {
+            'type': 'ipo',
+            'user': self.rng.choice(self.users),
+            'meal': self.rng.choice(self.meals),
+            'qty': self.rng.randint(1, 5)
+        }
+
+    def _next(self):
+        rng = self.rng
+        kind = rng.choices(self.kinds, self.weights)[0]
+        user = rng.choice(self.users)
+        meal = rng.choice(self.meals)
+        if kind == 'read':
+            return {'type': 'read', 'user': user}
+        if kind == 'cancel':
+            return {'type': 'cancel', 'user': user, 'meal': meal}
+
+        # Random-walk the mid so the book keeps moving
+        mid = self.mids[meal] = max(5.0, self.mids[meal] + rng.gauss(0, 0.5))
+        if kind == 'sweep':
+            side = rng.choice(('buy', 'sell'))
+            offset = rng.uniform(3, 10)
+            price = mid + offset if side == 'buy' else mid - offset
+            return {'type': side, 'user': user, 'meal': meal, 'price': round(price, 2), 'qty': rng.randint(10, 40)}
+
+        offset = abs(rng.gauss(0, 2))
+        if kind == 'limit_buy':
+            return {'type': 'buy', 'user': user, 'meal': meal, 'price': round(mid - offset, 2), 'qty': rng.randint(1, 10)}
+        return {
+            'type': 'short' if kind == 'short' else 'sell',
+            'user': user,
+            'meal': meal,
+            'price': round(mid + offset, 2),
+            'qty': rng.randint(1, 10)
+        }
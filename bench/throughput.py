@@ -0,0 +1,305 @@
+"""
+Order-matching throughput benchmark and load generator
+
+Drives a reproducible order flow (bench.order_flow) through one of:
+
+  service  MarketService in-process, against a scratch SQLite file or
+           BENCH_DATABASE_URL (e.g. a local PostgreSQL)
+  model    the in-memory models.Market used by cli.py
+  http     the Flask API with many concurrent simulated users, either an
+           in-process server on a scratch database or --url for a running one
+
+Reports orders/sec, fills/sec, queries per order (in-process modes),
+p50/p99 latency and peak RSS. --json PATH appends one JSON line per run
+(--json - prints it) so results can be tracked across commits.
+
+Usage: python -m bench.throughput [service|model|http] [--ops N] [--concurrency N] [--json PATH]
+"""
+import argparse
+import http.cookiejar
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+from bench.common import QueryCounter, percentile
+from bench.order_flow import OrderFlow
+from config import FRIENDS
+
+RICH_BALANCE = 1e9
+
+
+def service_setup(args):
+    from sqlalchemy import update
+    from database import db, User
+    from market_service import MarketService
+    from bench.common import create_bench_app
+
+    app = create_bench_app()
+    with app.app_context():
+        db.session.execute(update(User).values(balance=RICH_BALANCE))
+        db.session.commit()
+        MarketService.start_ipo()
+        engine = db.engine
+        dialect = engine.dialect.name
+
+    def execute(op):
+        kind = op['type']
+        if kind == 'ipo':
+            success, _ = MarketService.buy_from_ipo(op['user'], op['meal'], op['qty'])
+            fills = 1 if success else 0
+        elif kind == 'buy':
+            fills = len(MarketService.place_buy_order(op['user'], op['meal'], op['price'], op['qty'])[2])
+        elif kind in ('sell', 'short'):
+            fills = len(MarketService.place_sell_order(
+                op['user'], op['meal'], op['price'], op['qty'], is_short=kind == 'short'
+            )[2])
+        elif kind == 'cancel':
+            MarketService.cancel_all_orders(op['user'], op['meal'])
+            fills = 0
+        else:
+            MarketService.get_market_summary_json()
+            fills = 0
+        db.session.remove()
+        return fills
+
+    return app, engine, dialect, execute
+
+
+def model_setup(args):
+    from models import Market
+
+    market = Market()
+    market.start_ipo()
+    for user in FRIENDS:
+        market.balances[user] = RICH_BALANCE
+    lock = threading.Lock()
+
+    def execute(op):
+        kind = op['type']
+        with lock:
+            if kind == 'ipo':
+                success, _ = market.buy_from_ipo(op['user'], op['meal'], op['qty'])
+                return 1 if success else 0
+            if kind == 'buy':
+                return len(market.place_buy_order(op['user'], op['meal'], op['price'], op['qty'])[2])
+            if kind in ('sell', 'short'):
+                return len(market.place_sell_order(
+                    op['user'], op['meal'], op['price'], op['qty'], is_short=kind == 'short'
+                )[2])
+            if kind == 'read':
+                market.get_market_summary()
+            # models.Market has no cancel; cancels are no-ops here
+            return 0
+
+    return None, None, 'memory', execute
+
+
+def http_setup(args):
+    engine = None
+    app = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+        dialect = 'remote'
+    else:
+        # The app reads DATABASE_URL at import, so point it at a scratch database first
+        fd, path = tempfile.mkstemp(prefix='bench_', suffix='.db')
+        os.close(fd)
+        os.environ['DATABASE_URL'] = os.environ.get('BENCH_DATABASE_URL') or 'sqlite:///' + path
+        from werkzeug.serving import make_server
+        from sqlalchemy import update
+        from app import app
+        from database import db, User
+
+        from init_db import init_database
+        from order_book import order_books
+        from reference_data import reference_data
+
+        with app.app_context():
+            # Importing the app initialized the database; start a PostgreSQL one from scratch too
+            db.drop_all()
+            init_database()
+            reference_data.clear()
+            order_books.load_all()
+            db.session.execute(update(User).values(balance=RICH_BALANCE))
+            db.session.commit()
+            engine = db.engine
+            dialect = engine.dialect.name
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+    openers = {}
+    for user in FRIENDS:
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        post(opener, base_url + '/api/login', {'username': user})
+        openers[user] = opener
+    post(openers['Josh'], base_url + '/api/start_ipo', {})
+
+    def execute(op):
+        kind = op['type']
+        opener = openers[op['user']]
+        if kind == 'ipo':
+            body = post(opener, base_url + '/api/buy_ipo', {'meal': op['meal'], 'qty': op['qty']})
+            return 1 if body.get('success') else 0
+        if kind == 'buy':
+            body = post(opener, base_url + '/api/secondary_buy', {'meal': op['meal'], 'price': op['price'], 'qty': op['qty']})
+            return len(body.get('trades', []))
+        if kind in ('sell', 'short'):
+            body = post(opener, base_url + '/api/sell', {
+                'meal': op['meal'], 'price': op['price'], 'qty': op['qty'], 'is_short': kind == 'short'
+            })
+            return len(body.get('trades', []))
+        if kind == 'cancel':
+            post(opener, base_url + '/api/orders/cancel_all', {'meal': op['meal']})
+            return 0
+        with opener.open(base_url + '/api/market_summary') as response:
+            response.read()
+        return 0
+
+    return app, engine, dialect, execute
+
+
+def post(opener, url, payload):
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}, method='POST'
+    )
+    try:
+        with opener.open(request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return json.loads(error.read() or b'{}')
+
+
+def drive(app, execute, ops, concurrency):
+    """Run the operations on `concurrency` threads; returns per-op (type, fills, ms)"""
+    samples = []
+    position = iter(range(len(ops)))
+    lock = threading.Lock()
+
+    def worker():
+        context = app.app_context() if app is not None else None
+        if context:
+            context.push()
+        try:
+            while True:
+                with lock:
+                    index = next(position, None)
+                if index is None:
+                    return
+                op = ops[index]
+                began = time.perf_counter()
+                fills = execute(op)
+                elapsed = (time.perf_counter() - began) * 1000.0
+                with lock:
+                    samples.append((op['type'], fills, elapsed))
+        finally:
+            if context:
+                context.pop()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    setup = {'service': service_setup, 'model': model_setup, 'http': http_setup}[args.mode]
+    app, engine, dialect, execute = setup(args)
+    ops = list(OrderFlow(seed=args.seed).operations(args.ops))
+
+    counter = QueryCounter(engine) if engine is not None else None
+    if counter:
+        counter.__enter__()
+    began = time.perf_counter()
+    samples = drive(app, execute, ops, args.concurrency)
+    elapsed = time.perf_counter() - began
+    if counter:
+        counter.__exit__(None, None, None)
+
+    orders = sum(1 for kind, _, _ in samples if kind != 'read')
+    fills = sum(count for _, count, _ in samples)
+    latencies = [ms for _, _, ms in samples]
+    by_type = {}
+    for kind in sorted({kind for kind, _, _ in samples}):
+        kind_ms = [ms for sample_kind, _, ms in samples if sample_kind == kind]
+        by_type[kind] = {
+            'count': len(kind_ms),
+            'p50_ms': round(percentile(kind_ms, 50), 3),
+            'p99_ms': round(percentile(kind_ms, 99), 3)
+        }
+
+    return {
+        'benchmark': 'throughput',
+        'mode': args.mode,
+        'database': dialect,
+        'revision': git_revision(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'seed': args.seed,
+        'concurrency': args.concurrency,
+        'ops': len(samples),
+        'orders': orders,
+        'fills': fills,
+        'elapsed_s': round(elapsed, 3),
+        'orders_per_sec': round(orders / elapsed, 1),
+        'fills_per_sec': round(fills / elapsed, 1),
+        'queries_per_order': round(counter.queries / orders, 2) if counter and orders else None,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'latency_by_type': by_type
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('mode', nargs='?', choices=('service', 'model', 'http'), default='service')
+    parser.add_argument('--ops', type=int, default=2000, help='operations in the generated flow')
+    parser.add_argument('--concurrency', type=int, default=1, help='threads (simulated clients) issuing operations')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--url', help='http mode: base URL of a running server instead of an in-process one')
+    parser.add_argument('--json', help="append the result as one JSON line to this file ('-' for stdout)")
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json == '-':
+        print(json.dumps(result))
+        return
+    if args.json:
+        with open(args.json, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+    print(f"{result['mode']} on {result['database']}, {result['concurrency']} client(s), {result['ops']} ops")
+    print(f"  orders/sec        {result['orders_per_sec']:>10.1f}")
+    print(f"  fills/sec         {result['fills_per_sec']:>10.1f}")
+    if result['queries_per_order'] is not None:
+        print(f"  queries/order     {result['queries_per_order']:>10.2f}")
+    print(f"  p50 / p99 ms      {result['p50_ms']:>10.2f} / {result['p99_ms']:.2f}")
+    print(f"  peak RSS          {result['peak_rss_kb'] / 1024:>10.1f} MB")
+    for kind, stats in result['latency_by_type'].items():
+        print(f"    {kind:<8} {stats['count']:>6} ops  p50 {stats['p50_ms']:>8.2f} ms  p99 {stats['p99_ms']:>8.2f} ms")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+"""
+Order books and order rules for the Dining Exchange
+
+Pure in-memory structures with no database access: the price-time
+priority OrderBook and the checks that decide how an incoming order may
+trade. The web app keeps one book per meal in order_book.py, loaded from
+the database; the CLI's Market (models.py) builds its own.
+"""
+import math
+import threading
+from datetime import timedelta
+from bisect import bisect_left, insort
+from collections import deque
+from config import MARKET_ORDER_BAND, DAY_ORDER_CLOSE_HOUR
+
+# How an incoming order may trade: GTC rests whatever it cannot fill, IOC
+# drops it, FOK fills completely or not at all, POST_ONLY only rests (it is
+# rejected if it would trade) and MARKET is an IOC whose limit is the best
+# opposite price moved MARKET_ORDER_BAND against the order. DAY and GTD rest
+# like GTC until DAY_ORDER_CLOSE_HOUR or their own expiry time
+TIME_IN_FORCE = ('GTC', 'IOC', 'FOK', 'POST_ONLY', 'MARKET', 'DAY', 'GTD')
+RESTING_TIME_IN_FORCE = ('GTC', 'POST_ONLY', 'DAY', 'GTD')
+
+
+class BookOrder:
+    """A resting order held in an in-memory book"""
+    __slots__ = ('id', 'side', 'price', 'remaining', 'user', 'short', 'expires_at')
+
+    def __init__(self, order_id, side, price, remaining, user, short=False, expires_at=None):
+        self.id = order_id
+        self.side = side
+        self.price = price
+        self.remaining = remaining
+        self.user = user
+        self.short = short  # a short-sale ask, holding no shares
+        self.expires_at = expires_at
+
+
+class PriceLevel:
+    """FIFO queue of resting orders at a single price"""
+    __slots__ = ('price', 'orders', 'quantity')
+
+    def __init__(self, price):
+        self.price = price
+        self.orders = deque()
+        self.quantity = 0
+
+
+class OrderBook:
+    """Price-time priority order book for a single meal
+
+    Each side keeps its price levels in a dict plus a sorted list of level
+    keys arranged so that the best price is always the last element. Bids
+    are keyed by price and asks by negated price, so finding the best level
+    is O(1), opening a level is a binary search and draining one is a pop.
+    next_expiry is never later than the earliest expiry on the book, so
+    checking it is all an order costs until something may have expired.
+    """
+
+    def __init__(self):
+        self.levels = {'BID': {}, 'ASK': {}}
+        self.keys = {'BID': [], 'ASK': []}
+        self.orders = {}
+        self.next_expiry = None
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _key(side, price):
+        return price if side == 'BID' else -price
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __contains__(self, order_id):
+        return order_id in self.orders
+
+    def add(self, order):
+        """Rest an order at the back of its price level"""
+        key = self._key(order.side, order.price)
+        levels = self.levels[order.side]
+        level = levels.get(key)
+        if level is None:
+            level = levels[key] = PriceLevel(order.price)
+            insort(self.keys[order.side], key)
+        level.orders.append(order)
+        level.quantity += order.remaining
+        self.orders[order.id] = order
+        if order.expires_at and (self.next_expiry is None or order.expires_at < self.next_expiry):
+            self.next_expiry = order.expires_at
+        return order
+
+    def best(self, side):
+        """Get the oldest order at the best price on one side"""
+        keys = self.keys[side]
+        if not keys:
+            return None
+        return self.levels[side][keys[-1]].orders[0]
+
+    def best_ask(self):
+        return self.best('ASK')
+
+    def best_bid(self):
+        return self.best('BID')
+
+    def depth(self, side):
+        """Iterate price levels on one side from best to worst"""
+        levels = self.levels[side]
+        for key in reversed(self.keys[side]):
+            yield levels[key]
+
+    def crosses(self, side, price):
+        """Whether an incoming order on side at price would trade against the book"""
+        best = self.best('ASK' if side == 'BID' else 'BID')
+        if best is None:
+            return False
+        return best.price <= price if side == 'BID' else best.price >= price
+
+    def fillable(self, side, price, quantity):
+        """Whether the opposite side holds quantity at price or better, from the level totals alone"""
+        available = 0
+        for level in self.depth('ASK' if side == 'BID' else 'BID'):
+            if (level.price > price) if side == 'BID' else (level.price < price):
+                break
+            available += level.quantity
+            if available >= quantity:
+                return True
+        return False
+
+    def fill(self, order, quantity):
+        """Reduce a resting order, dropping it once fully filled"""
+        key = self._key(order.side, order.price)
+        level = self.levels[order.side][key]
+        order.remaining -= quantity
+        level.quantity -= quantity
+        if order.remaining <= 0:
+            if level.orders[0] is order:
+                level.orders.popleft()
+            else:
+                level.orders.remove(order)
+            del self.orders[order.id]
+            if not level.orders:
+                self._drop_level(order.side, key)
+
+    def remove(self, order_id):
+        """Remove a resting order from the book (e.g. on cancel)"""
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return None
+        key = self._key(order.side, order.price)
+        level = self.levels[order.side][key]
+        level.orders.remove(order)
+        level.quantity -= order.remaining
+        if not level.orders:
+            self._drop_level(order.side, key)
+        return order
+
+    def due(self, now):
+        """Ids of resting orders that expired by now; removing them is up to the caller"""
+        if self.next_expiry is None or self.next_expiry > now:
+            return []
+        expired, upcoming = [], None
+        for order in self.orders.values():
+            if order.expires_at is None:
+                continue
+            if order.expires_at <= now:
+                expired.append(order.id)
+            elif upcoming is None or order.expires_at < upcoming:
+                upcoming = order.expires_at
+        self.next_expiry = upcoming
+        return expired
+
+    def _drop_level(self, side, key):
+        del self.levels[side][key]
+        keys = self.keys[side]
+        if keys[-1] == key:
+            keys.pop()
+        else:
+            del keys[bisect_left(keys, key)]
+
+
+def valid_quantity(quantity):
+    """Whether quantity is a positive whole number of shares"""
+    return isinstance(quantity, int) and not isinstance(quantity, bool) and quantity > 0
+
+
+def valid_price(price):
+    """Whether price is a positive, finite number"""
+    return (isinstance(price, (int, float)) and not isinstance(price, bool)
+            and math.isfinite(price) and price > 0)
+
+
+def order_error(price, quantity, time_in_force):
+    """Why an order's own fields are invalid, whatever the book holds, or None"""
+    if time_in_force not in TIME_IN_FORCE:
+        return "Unknown time in force"
+    if not valid_quantity(quantity):
+        return "Quantity must be a positive whole number"
+    if time_in_force == 'MARKET':
+        return None
+    if price is None:
+        return "Price required"
+    if not valid_price(price):
+        return "Price must be a positive number"
+    return None
+
+
+def prepare_order(book, side, price, quantity, time_in_force):
+    """Decide how an incoming order may trade before anything is filled or reserved
+
+    FOK and POST_ONLY are settled here with one look at the book's depth,
+    so an order that cannot go ahead never touches the book or the
+    database. Must be called with the book locked. Returns (limit price,
+    whether the unfilled rest goes on the book, rejection message or None).
+    """
+    invalid = order_error(price, quantity, time_in_force)
+    if invalid:
+        return price, False, invalid
+    if time_in_force == 'MARKET':
+        best = book.best('ASK' if side == 'BID' else 'BID')
+        if best is None:
+            return price, False, "No matching orders"
+        band = 1 + MARKET_ORDER_BAND if side == 'BID' else 1 - MARKET_ORDER_BAND
+        return round(best.price * band, 2), False, None
+    if time_in_force == 'POST_ONLY' and book.crosses(side, price):
+        return price, False, "Post-only order would trade immediately"
+    if time_in_force == 'FOK' and not book.fillable(side, price, quantity):
+        return price, False, "Not enough liquidity to fill the whole order"
+    return price, time_in_force in RESTING_TIME_IN_FORCE, None
+
+
+def order_expiry(time_in_force, expires_at, now):
+    """When a resting order lapses: (naive UTC expiry or None, rejection message or None)"""
+    if time_in_force == 'DAY':
+        close = now.replace(hour=DAY_ORDER_CLOSE_HOUR, minute=0, second=0, microsecond=0)
+        return (close if close > now else close + timedelta(days=1)), None
+    if time_in_force == 'GTD':
+        if expires_at is None:
+            return None, "Expiry time required"
+        if expires_at <= now:
+            return None, "Expiry time has already passed"
+        return expires_at, None
+    return None, None
@@ -0,0 +1,138 @@
+"""
+OHLCV candles rolled up from the trade tape
+
+Every batch of fills updates the bar it lands in at each width in
+CANDLE_INTERVALS, inside the same market write as the trades themselves,
+so the bars never disagree with the trade tape and /api/candles is a
+single indexed range read. backfill() rebuilds every bar from the trades
+table and its archive in one pass, for databases that had trades before
+candles existed or after a journal replay.
+"""
+from datetime import timedelta
+from sqlalchemy import and_, delete, insert, or_, select, union_all
+from database import db, Candle, Trade, ArchivedTrade, EPOCH
+from market_cache import bump_sequence
+import journal
+from config import CANDLE_INTERVALS
+
+BACKFILL_BATCH_SIZE = 10000
+
+
+def bucket_start(timestamp, seconds):
+    """Start of the bar `seconds` wide that contains a naive UTC timestamp"""
+    elapsed = int((timestamp - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=elapsed - elapsed % seconds)
+
+
+def _roll(bars, key, price, quantity):
+    """Fold one trade into an [open, high, low, close, volume, trades] bar"""
+    bar = bars.get(key)
+    if bar is None:
+        bars[key] = [price, price, price, price, quantity, 1]
+        return
+    if price > bar[1]:
+        bar[1] = price
+    if price < bar[2]:
+        bar[2] = price
+    bar[3] = price
+    bar[4] += quantity
+    bar[5] += 1
+
+
+def record(meal_id, rows):
+    """Fold freshly inserted trade rows for one meal into their candles
+
+    Must run inside the market write that inserted the trades; the write
+    lock means no other process is updating the same bars.
+    """
+    bars = {}
+    for row in rows:
+        for seconds in CANDLE_INTERVALS.values():
+            _roll(bars, (seconds, bucket_start(row['timestamp'], seconds)), row['price'], row['quantity'])
+
+    existing = {
+        (candle.interval_seconds, candle.bucket_start): candle
+        for candle in Candle.query.filter(
+            Candle.meal_id == meal_id,
+            or_(*(
+                and_(Candle.interval_seconds == seconds, Candle.bucket_start == start)
+                for seconds, start in bars
+            ))
+        ).populate_existing()
+    }
+    for (seconds, start), (open_, high, low, close, volume, count) in bars.items():
+        candle = existing.get((seconds, start))
+        if candle is None:
+            db.session.add(Candle(
+                meal_id=meal_id, interval_seconds=seconds, bucket_start=start,
+                open=open_, high=high, low=low, close=close, volume=volume, trade_count=count
+            ))
+            continue
+        candle.high = max(candle.high, high)
+        candle.low = min(candle.low, low)
+        candle.close = close
+        candle.volume += volume
+        candle.trade_count += count
+
+
+def backfill():
+    """Rebuild every candle from the trades table as one market write; returns the bar count
+
+    Holding the market write lock means no fills land mid-rebuild, and the
+    sequence bump moves every cached ETag past the old bars.
+    """
+    sequence = bump_sequence()
+    count = rebuild()
+    db.session.commit()
+    journal.append_staged(sequence)
+    return count
+
+
+def rebuild():
+    """Replace every candle with bars rolled up in a single pass over the trades and their archive
+
+    Stages the rows in the current transaction without committing.
+    """
+    db.session.execute(delete(Candle))
+
+    bars = {}
+    # Archived trades keep their ids, so one ordering covers both tables
+    tape = union_all(
+        select(ArchivedTrade.id, ArchivedTrade.meal_id, ArchivedTrade.timestamp, ArchivedTrade.price, ArchivedTrade.quantity),
+        select(Trade.id, Trade.meal_id, Trade.timestamp, Trade.price, Trade.quantity)
+    ).subquery()
+    trades = db.session.execute(
+        select(tape.c.meal_id, tape.c.timestamp, tape.c.price, tape.c.quantity)
+        .order_by(tape.c.id)
+        .execution_options(yield_per=BACKFILL_BATCH_SIZE)
+    )
+    for meal_id, timestamp, price, quantity in trades:
+        for seconds in CANDLE_INTERVALS.values():
+            _roll(bars, (meal_id, seconds, bucket_start(timestamp, seconds)), price, quantity)
+
+    rows = [
+        {
+            'meal_id': meal_id, 'interval_seconds': seconds, 'bucket_start': start,
+            'open': open_, 'high': high, 'low': low, 'close': close,
+            'volume': volume, 'trade_count': count
+        }
+        for (meal_id, seconds, start), (open_, high, low, close, volume, count) in bars.items()
+    ]
+    for offset in range(0, len(rows), BACKFILL_BATCH_SIZE):
+        db.session.execute(insert(Candle), rows[offset:offset + BACKFILL_BATCH_SIZE])
+    return len(rows)
+
+
+def get_candles(meal_id, seconds, start=None, end=None, limit=None):
+    """A meal's bars at one width, oldest first
+
+    start and end are naive UTC datetimes bounding the bucket starts
+    (end exclusive); with a limit, the latest bars in the range are kept.
+    """
+    query = Candle.query.filter(Candle.meal_id == meal_id, Candle.interval_seconds == seconds)
+    if start is not None:
+        query = query.filter(Candle.bucket_start >= start)
+    if end is not None:
+        query = query.filter(Candle.bucket_start < end)
+    candles = query.order_by(Candle.bucket_start.desc()).limit(limit).all()
+    return [candle.to_dict() for candle in reversed(candles)]
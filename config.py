@@ -1,4 +1,6 @@
 # --- CONFIGURATION ---
+import os
+
 FRIENDS = ["Josh", "Jack", "Levi", "Shap", "Eitan", "Jonny", "Fisher", "Isaac", 
            "Charlie", "James", "Max", "Matan", "Sam", "Noah", "Jamie", "Oliver"]
 
@@ -37,4 +39,43 @@ INITIAL_BALANCE = 10000.0
 INITIAL_HOUSE_SUPPLY = 500
 IPO_START_PRICE = 200.0
 IPO_DECAY_RATE = 1.0  # dollars per 3 seconds
-IPO_DECAY_INTERVAL = 3  # seconds
\ No newline at end of file
+IPO_DECAY_INTERVAL = 3  # seconds
+MAX_BATCH_ORDERS = 100  # orders accepted by one /api/orders/batch call
+MARKET_ORDER_BAND = 0.10  # market orders fill at most 10% through the best opposite price
+DAY_ORDER_CLOSE_HOUR = 0  # UTC hour at which DAY orders expire
+# Live market stream (/api/stream)
+STREAM_POLL_INTERVAL = 1  # seconds between checks for writes made by other workers
+STREAM_HEARTBEAT_INTERVAL = 15  # seconds between keep-alive comments
+STREAM_MAX_DURATION = 300  # seconds before a stream closes and the browser reconnects
+# Group-commit matching thread (matching_engine.py); off unless MATCHING_ENGINE=1
+MATCHING_ENGINE = os.environ.get('MATCHING_ENGINE', '') == '1'  # match on one thread per process
+MATCHING_BATCH_SIZE = 50  # most queued orders the matching thread commits together
+# Batched IPO fills (ipo_auction.py); off unless IPO_BATCHING=1
+IPO_BATCHING = os.environ.get('IPO_BATCHING', '') == '1'  # fill each decay tick's IPO buys together
+# Market journal (journal.py); unset JOURNAL_PATH to disable it
+JOURNAL_PATH = os.environ.get('JOURNAL_PATH', '')
+JOURNAL_SNAPSHOT_INTERVAL = 1000  # journal entries between snapshots
+JOURNAL_FSYNC = os.environ.get('JOURNAL_FSYNC', '') == '1'  # fsync every entry
+# Request instrumentation and /metrics (instrumentation.py); off unless INSTRUMENTATION=1
+INSTRUMENTATION = os.environ.get('INSTRUMENTATION', '') == '1'
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '500'))  # requests logged with their SQL
+SLOW_REQUEST_MAX_STATEMENTS = 50  # most statements kept for one slow-request log entry
+# OHLCV candles (candles.py) kept for every meal at each of these bar widths
+CANDLE_INTERVALS = {'1s': 1, '1m': 60, '5m': 300, '1h': 3600}
+CANDLE_DEFAULT_LIMIT = 300  # bars returned by /api/candles without ?limit=
+CANDLE_MAX_LIMIT = 2000
+# Net worth and leaderboard (valuation.py)
+LEADERBOARD_SIZE = 10  # users shown by /api/leaderboard without ?limit=
+# Short-selling risk (risk.py): net worth required per dollar of short exposure
+SHORT_INITIAL_MARGIN = 0.5  # to open or add to a short
+SHORT_MAINTENANCE_MARGIN = 0.3  # below this the liquidation pass buys the shorts back
+RISK_LIQUIDATION_INTERVAL = int(os.environ.get('RISK_LIQUIDATION_INTERVAL', '0'))  # seconds between passes; 0 runs none in the app
+# Order expiry and history archiving (maintenance.py)
+MAINTENANCE_INTERVAL = int(os.environ.get('MAINTENANCE_INTERVAL', '60'))  # seconds between passes; 0 runs none in the app
+ORDER_ARCHIVE_AGE = 3600  # seconds a filled, cancelled or expired order stays in orders
+TRADE_ARCHIVE_AGE = 7 * 24 * 3600  # seconds a trade stays in trades (each meal's last trade always stays)
+ARCHIVE_BATCH_SIZE = 5000  # rows moved per market write
+# Trade history paging (/api/trade_history)
+TRADE_PAGE_DEFAULT = 20  # trades per page without ?limit=
+TRADE_PAGE_MAX = 500
+TRADE_STREAM_BATCH = 1000  # rows fetched per keyset query while streaming NDJSON
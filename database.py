@@ -5,12 +5,16 @@ from sqlalchemy import event
 
 db = SQLAlchemy()
 
+# Trade and candle timestamps are naive UTC
+EPOCH = datetime(1970, 1, 1)
+
 class User(db.Model):
     __tablename__ = 'users'
     
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
     balance = db.Column(db.Float, default=10000.0, nullable=False)
+    held_balance = db.Column(db.Float, default=0.0, server_default='0', nullable=False)  # reserved by resting bids
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -24,7 +28,9 @@ class User(db.Model):
         return {
             'id': self.id,
             'username': self.username,
-            'balance': self.balance
+            'balance': self.balance,
+            'held_balance': self.held_balance,
+            'available_balance': self.balance - self.held_balance
         }
 
 class Meal(db.Model):
@@ -55,6 +61,7 @@ class Position(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     meal_id = db.Column(db.Integer, db.ForeignKey('meals.id'), nullable=False)
     shares = db.Column(db.Integer, default=0, nullable=False)
+    held_shares = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # reserved by resting asks
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationships
@@ -71,6 +78,7 @@ class Position(db.Model):
             'meal_id': self.meal_id,
             'meal_name': self.meal.name,
             'shares': self.shares,
+            'held_shares': self.held_shares,
             'is_short': self.shares < 0
         }
 
@@ -87,8 +95,11 @@ class Order(db.Model):
     # For bids, buyer_id is set; for asks, seller_id is set
     buyer_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
     seller_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    # Short-sale asks hold no shares; every other resting order holds what it could still trade
+    short = db.Column(db.Boolean, default=False, server_default=db.false(), nullable=False)
     
-    status = db.Column(db.String(20), default='ACTIVE', nullable=False)  # ACTIVE, FILLED, CANCELLED
+    status = db.Column(db.String(20), default='ACTIVE', nullable=False)  # ACTIVE, FILLED, CANCELLED, EXPIRED
+    expires_at = db.Column(db.DateTime, nullable=True)  # DAY and GTD orders lapse at this time
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -97,6 +108,27 @@ class Order(db.Model):
     buyer = db.relationship('User', foreign_keys=[buyer_id], back_populates='buy_orders')
     seller = db.relationship('User', foreign_keys=[seller_id], back_populates='sell_orders')
     
+    __table_args__ = (
+        # Best bid/ask and order book lookups
+        db.Index('ix_orders_book', 'meal_id', 'order_type', 'status', 'price'),
+        # Same lookups over the live book only, where the backend supports partial indexes
+        db.Index(
+            'ix_orders_active_book', 'meal_id', 'order_type', 'price', 'id',
+            postgresql_where=db.text("status = 'ACTIVE'"),
+            sqlite_where=db.text("status = 'ACTIVE'")
+        ),
+        db.Index('ix_orders_created_at', 'created_at'),
+        # Resting orders due to expire
+        db.Index(
+            'ix_orders_active_expiry', 'expires_at',
+            postgresql_where=db.text("status = 'ACTIVE' AND expires_at IS NOT NULL"),
+            sqlite_where=db.text("status = 'ACTIVE' AND expires_at IS NOT NULL")
+        ),
+        # A user's own resting orders
+        db.Index('ix_orders_buyer_status', 'buyer_id', 'status'),
+        db.Index('ix_orders_seller_status', 'seller_id', 'status'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -107,7 +139,9 @@ class Order(db.Model):
             'quantity': self.quantity,
             'remaining_quantity': self.remaining_quantity,
             'user': self.buyer.username if self.buyer_id else self.seller.username,
+            'short': self.short,
             'status': self.status,
+            'expires_at': self.expires_at.isoformat() if self.expires_at else None,
             'created_at': self.created_at.isoformat()
         }
 
@@ -128,6 +162,15 @@ class Trade(db.Model):
     buyer = db.relationship('User', foreign_keys=[buyer_id], back_populates='trades_as_buyer')
     seller = db.relationship('User', foreign_keys=[seller_id], back_populates='trades_as_seller')
     
+    __table_args__ = (
+        # Trade tape, newest first
+        db.Index('ix_trades_timestamp', 'timestamp', 'id'),
+        db.Index('ix_trades_meal_timestamp', 'meal_id', 'timestamp'),
+        # One user's fills, paged by (timestamp, id)
+        db.Index('ix_trades_buyer_timestamp', 'buyer_id', 'timestamp', 'id'),
+        db.Index('ix_trades_seller_timestamp', 'seller_id', 'timestamp', 'id'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -140,6 +183,74 @@ class Trade(db.Model):
             'timestamp': self.timestamp.isoformat()
         }
 
+class ArchivedOrder(db.Model):
+    __tablename__ = 'orders_archive'
+    
+    # Filled, cancelled and expired orders moved out of orders by maintenance.py; ids are kept
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    meal_id = db.Column(db.Integer, nullable=False)
+    order_type = db.Column(db.String(4), nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    remaining_quantity = db.Column(db.Integer, nullable=False)
+    buyer_id = db.Column(db.Integer, nullable=True)
+    seller_id = db.Column(db.Integer, nullable=True)
+    short = db.Column(db.Boolean, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+class ArchivedTrade(db.Model):
+    __tablename__ = 'trades_archive'
+    
+    # Trades older than TRADE_ARCHIVE_AGE moved out of trades by maintenance.py; ids are kept
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    meal_id = db.Column(db.Integer, nullable=False)
+    buyer_id = db.Column(db.Integer, nullable=True)
+    seller_id = db.Column(db.Integer, nullable=True)
+    seller_name = db.Column(db.String(50), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_trades_archive_meal_timestamp', 'meal_id', 'timestamp'),
+    )
+
+class Candle(db.Model):
+    __tablename__ = 'candles'
+    
+    # One OHLCV bar per meal, bar width and bucket, rolled up from trades as they happen
+    id = db.Column(db.Integer, primary_key=True)
+    meal_id = db.Column(db.Integer, db.ForeignKey('meals.id'), nullable=False)
+    interval_seconds = db.Column(db.Integer, nullable=False)
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    open = db.Column(db.Float, nullable=False)
+    high = db.Column(db.Float, nullable=False)
+    low = db.Column(db.Float, nullable=False)
+    close = db.Column(db.Float, nullable=False)
+    volume = db.Column(db.Integer, nullable=False)
+    trade_count = db.Column(db.Integer, nullable=False)
+    
+    __table_args__ = (
+        # Also serves range reads of one meal's bars
+        db.UniqueConstraint('meal_id', 'interval_seconds', 'bucket_start', name='_meal_interval_bucket_uc'),
+    )
+    
+    def to_dict(self):
+        return {
+            'time': int((self.bucket_start - EPOCH).total_seconds()),
+            'open': self.open,
+            'high': self.high,
+            'low': self.low,
+            'close': self.close,
+            'volume': self.volume,
+            'trades': self.trade_count
+        }
+
 class MarketState(db.Model):
     __tablename__ = 'market_state'
     
@@ -153,4 +264,33 @@ class MarketState(db.Model):
             'id': self.id,
             'ipo_start_time': self.ipo_start_time.isoformat() if self.ipo_start_time else None,
             'ipo_active': self.ipo_active
-        }
\ No newline at end of file
+        }
+
+
+class MarketSequence(db.Model):
+    __tablename__ = 'market_sequence'
+    
+    # Single row bumped by every market write; shared by all workers
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'value': self.value
+        }
+
+class JobLease(db.Model):
+    __tablename__ = 'job_leases'
+    
+    # Which process runs each background job (periodic.py); one row per job
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(100), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'holder': self.holder,
+            'expires_at': self.expires_at.isoformat()
+        }
@@ -1,4 +1,6 @@
 from database import db, User, Meal, MarketState
+from market_cache import ensure_sequence
+from schema import upgrade_schema
 from config import FRIENDS, CHICKEN_INDEX, BEEF_INDEX, MISC_INDEX, INITIAL_BALANCE, INITIAL_HOUSE_SUPPLY
 
 def init_database():
@@ -7,6 +9,14 @@ def init_database():
     # Create all tables
     db.create_all()
     
+    # Add columns and indexes introduced since the database was created
+    for change in upgrade_schema():
+        print(f"Schema upgrade: added {change}")
+    
+    # Databases created before the market sequence existed need its row
+    ensure_sequence()
+    db.session.commit()
+    
     # Check if already initialized
     if User.query.first() is not None:
         return  # Database already has data
@@ -0,0 +1,266 @@
+"""
+Opt-in request and query instrumentation
+
+With INSTRUMENTATION=1 every request records its query count, time spent
+in the database, time spent serializing JSON and total latency, labelled
+by endpoint, and MarketService reports how many price levels each order
+swept, how many fills it produced and every market commit. Everything is
+exported in the Prometheus text format at /metrics. Requests slower than
+SLOW_REQUEST_MS are logged along with the SQL they issued.
+
+Metrics live in the process that recorded them; under gunicorn each worker
+serves its own /metrics and the scraper sums them. With instrumentation
+off the hooks are never installed and the MarketService calls return
+immediately.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from config import INSTRUMENTATION, SLOW_REQUEST_MS, SLOW_REQUEST_MAX_STATEMENTS
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Counter:
+    """A monotonically increasing value per label set"""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label set"""
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (counts, total, count) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _labels(self.labels + ('le',), label_values + (_number(bound),))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _labels(self.labels + ('le',), label_values + ('+Inf',))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {total}")
+                lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+requests_total = Counter(
+    'dining_requests_total', 'HTTP requests handled', ('endpoint', 'method', 'status')
+)
+request_seconds = Histogram(
+    'dining_request_duration_seconds', 'Total request latency', ('endpoint',)
+)
+request_queries = Histogram(
+    'dining_request_queries', 'SQL statements issued per request', ('endpoint',), COUNT_BUCKETS
+)
+request_db_seconds = Histogram(
+    'dining_request_db_seconds', 'Time spent executing SQL per request', ('endpoint',)
+)
+request_serialize_seconds = Histogram(
+    'dining_request_serialize_seconds', 'Time spent serializing JSON per request', ('endpoint',)
+)
+slow_requests_total = Counter(
+    'dining_slow_requests_total', 'Requests slower than SLOW_REQUEST_MS', ('endpoint',)
+)
+match_levels = Histogram(
+    'dining_match_levels_swept', 'Price levels an incoming order matched against', (), COUNT_BUCKETS
+)
+match_fills = Histogram(
+    'dining_match_fills_per_order', 'Fills produced by one incoming order', (), COUNT_BUCKETS
+)
+market_commits_total = Counter(
+    'dining_market_commits_total', 'Market writes committed'
+)
+
+METRICS = (
+    requests_total, request_seconds, request_queries, request_db_seconds,
+    request_serialize_seconds, slow_requests_total, match_levels, match_fills,
+    market_commits_total
+)
+
+
+class RequestMetrics:
+    """What one request has spent so far"""
+    __slots__ = ('started', 'queries', 'db_seconds', 'serialize_seconds', 'statements')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.statements = []
+
+
+# The request being handled on this thread, if it is being measured
+_current = threading.local()
+
+
+def enabled():
+    return INSTRUMENTATION
+
+
+def current():
+    return getattr(_current, 'metrics', None)
+
+
+@contextmanager
+def serializing():
+    """Attribute the time spent in the block to the current request's serialization"""
+    metrics = current()
+    if metrics is None:
+        yield
+        return
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.serialize_seconds += time.perf_counter() - began
+
+
+def observe_match(levels, fills):
+    """Record one incoming order's sweep of the book"""
+    if INSTRUMENTATION:
+        match_levels.observe(levels)
+        match_fills.observe(fills)
+
+
+def count_commit():
+    if INSTRUMENTATION:
+        market_commits_total.inc()
+
+
+def render():
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, timing jsonify() as serialization"""
+
+    def dumps(self, obj, **kwargs):
+        with serializing():
+            return super().dumps(obj, **kwargs)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current() is not None:
+        conn.info['query_started'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics = current()
+    if metrics is None:
+        return
+    started = conn.info.pop('query_started', None)
+    if started is None:
+        return
+    metrics.queries += 1
+    metrics.db_seconds += time.perf_counter() - started
+    if len(metrics.statements) < SLOW_REQUEST_MAX_STATEMENTS:
+        metrics.statements.append(statement)
+
+
+def _start_request():
+    _current.metrics = RequestMetrics()
+
+
+def _finish_request(app, response):
+    metrics = current()
+    _current.metrics = None
+    if metrics is None:
+        return response
+
+    elapsed = time.perf_counter() - metrics.started
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    requests_total.inc(endpoint, request.method, str(response.status_code))
+    request_seconds.observe(elapsed, endpoint)
+    request_queries.observe(metrics.queries, endpoint)
+    request_db_seconds.observe(metrics.db_seconds, endpoint)
+    request_serialize_seconds.observe(metrics.serialize_seconds, endpoint)
+
+    if elapsed * 1000.0 >= SLOW_REQUEST_MS:
+        slow_requests_total.inc(endpoint)
+        app.logger.warning(
+            "Slow request %s %s: %.1f ms total, %d queries in %.1f ms, %.1f ms serializing\n%s",
+            request.method, request.full_path.rstrip('?'), elapsed * 1000.0,
+            metrics.queries, metrics.db_seconds * 1000.0, metrics.serialize_seconds * 1000.0,
+            '\n'.join('  ' + ' '.join(statement.split()) for statement in metrics.statements)
+        )
+    return response
+
+
+def _abandon_request(exc):
+    _current.metrics = None
+
+
+def init_app(app, db):
+    """Install the request hooks and engine listeners if instrumentation is on"""
+    if not INSTRUMENTATION:
+        return
+    app.json = TimedJSONProvider(app)
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_start_request)
+    app.after_request(lambda response: _finish_request(app, response))
+    app.teardown_request(_abandon_request)
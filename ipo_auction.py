@@ -0,0 +1,81 @@
+"""
+Optional batched IPO fills, one uniform-price batch per decay tick
+
+The IPO price steps down every IPO_DECAY_INTERVAL seconds. With
+IPO_BATCHING=1 an IPO buy is not filled on the request thread: it joins
+the batch for the tick it arrived in, at that tick's price, and the
+request waits. When the tick ends every buy queued for it is filled in
+arrival order as one market write, so the opening rush costs one sequence
+bump and one commit per tick in each process instead of one per buyer.
+Each buy is still all-or-nothing against the remaining supply and the
+buyer's cash.
+"""
+import threading
+import time
+from matching_engine import MatchRequest, run_batch
+
+
+class IpoAuction:
+    """Collects IPO buys and fills each tick's buys together when the tick closes"""
+
+    def __init__(self):
+        self.app = None
+        self.run_write = None
+        self._pending = []  # (deadline, request) in arrival order
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, app, run_write):
+        """Start the auction thread; run_write runs a list of buys as one market write"""
+        with self._condition:
+            if self._thread:
+                return
+            self.app = app
+            self.run_write = run_write
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='ipo-auction', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Fill whatever is queued now and stop the auction thread"""
+        with self._condition:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._condition.notify()
+        if thread:
+            thread.join()
+
+    def submit(self, seconds_left, work, exhausted_result):
+        """Queue work() for the batch that closes in seconds_left and wait for its result"""
+        request = MatchRequest(work, exhausted_result)
+        with self._condition:
+            self._pending.append((time.monotonic() + seconds_left, request))
+            self._condition.notify()
+        return request.future.result()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    due = [request for deadline, request in self._pending if self._stopping or deadline <= now]
+                    if due:
+                        self._pending = [
+                            (deadline, request) for deadline, request in self._pending
+                            if not self._stopping and deadline > now
+                        ]
+                        break
+                    if self._stopping:
+                        return
+                    timeout = min(deadline for deadline, _ in self._pending) - now if self._pending else None
+                    self._condition.wait(timeout)
+            with self.app.app_context():
+                run_batch(self.run_write, due)
+
+
+ipo_auction = IpoAuction()
@@ -0,0 +1,333 @@
+"""
+Append-only market journal with snapshots and replay
+
+When JOURNAL_PATH is set, every committed market write appends one line of
+JSON to the journal: its market sequence number and the events it made
+(users created, orders rested, resting orders filled, cancels and expiries,
+trades, house supply and IPO clock changes). The database stays the source of
+truth; the journal lets the whole market be rebuilt from scratch
+(manage_db.py replay) and lets startup build the order books without
+scanning the orders table.
+
+The first line of a journal is a full snapshot of the market. Every
+JOURNAL_SNAPSHOT_INTERVAL entries a fresh snapshot is written beside it
+(<JOURNAL_PATH>.snapshot) together with the journal offset it covers, so
+loading the current state only has to read the tail.
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import event, insert, select, text
+from sqlalchemy.orm import Session
+from database import db, User, Meal, Position, Order, Trade, MarketState, MarketSequence
+from market_cache import SEQUENCE_ROW_ID, to_json
+from config import JOURNAL_PATH, JOURNAL_SNAPSHOT_INTERVAL, JOURNAL_FSYNC
+
+PENDING_KEY = 'journal_events'
+
+
+def enabled():
+    return bool(JOURNAL_PATH)
+
+
+def stage(kind, data):
+    """Queue a journal event to append when the current transaction commits"""
+    if JOURNAL_PATH:
+        db.session.info.setdefault(PENDING_KEY, []).append((kind, data))
+
+
+def append_staged(sequence):
+    """Append the events staged by a write that just committed
+
+    Returns True when enough entries have been written that a new snapshot
+    is due.
+    """
+    events = db.session.info.pop(PENDING_KEY, [])
+    if not JOURNAL_PATH:
+        return False
+    return journal.append(sequence, events)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_staged(session, previous_transaction):
+    session.info.pop(PENDING_KEY, None)
+
+
+def _timestamp(value):
+    return value.isoformat() if value else None
+
+
+def _datetime(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def capture_state():
+    """Read the full market state from the database as plain data"""
+    users = [
+        {'id': row.id, 'username': row.username, 'balance': row.balance, 'created_at': _timestamp(row.created_at)}
+        for row in db.session.execute(select(User.id, User.username, User.balance, User.created_at))
+    ]
+    meals = [
+        {'id': row.id, 'name': row.name, 'category': row.category, 'house_supply': row.house_supply}
+        for row in db.session.execute(select(Meal.id, Meal.name, Meal.category, Meal.house_supply))
+    ]
+    positions = [
+        {'user_id': row.user_id, 'meal_id': row.meal_id, 'shares': row.shares}
+        for row in db.session.execute(select(Position.user_id, Position.meal_id, Position.shares))
+    ]
+    orders = [
+        order_event(order)
+        for order in Order.query.filter_by(status='ACTIVE').order_by(Order.id.asc())
+    ]
+    state = MarketState.query.first()
+    return {
+        'users': users,
+        'meals': meals,
+        'positions': positions,
+        'orders': orders,
+        'market': {
+            'ipo_start_time': _timestamp(state.ipo_start_time) if state else None,
+            'ipo_active': state.ipo_active if state else False
+        }
+    }
+
+
+def order_event(order):
+    """Journal form of a newly rested order"""
+    return {
+        'id': order.id,
+        'meal_id': order.meal_id,
+        'order_type': order.order_type,
+        'price': float(order.price),
+        'quantity': order.quantity,
+        'remaining_quantity': order.remaining_quantity,
+        'buyer_id': order.buyer_id,
+        'seller_id': order.seller_id,
+        'short': order.short,
+        'status': order.status,
+        'expires_at': _timestamp(order.expires_at),
+        'created_at': _timestamp(order.created_at)
+    }
+
+
+def trade_event(trade_id, row):
+    """Journal form of a trade row as inserted by MarketService._settle_fills"""
+    return dict(row, id=trade_id, timestamp=_timestamp(row['timestamp']))
+
+
+class MarketImage:
+    """The market rebuilt in memory from a snapshot and the journal entries after it"""
+
+    def __init__(self, sequence, state):
+        self.sequence = sequence
+        self.users = {user['id']: dict(user) for user in state['users']}
+        self.meals = {meal['id']: dict(meal) for meal in state['meals']}
+        self.positions = {
+            (position['user_id'], position['meal_id']): position['shares']
+            for position in state['positions']
+        }
+        self.orders = {order['id']: dict(order) for order in state['orders']}
+        self.trades = []
+        self.market = dict(state['market'])
+
+    def apply(self, sequence, events):
+        for kind, data in events:
+            getattr(self, '_apply_' + kind)(data)
+        self.sequence = max(self.sequence, sequence)
+
+    def _apply_user(self, data):
+        self.users[data['id']] = dict(data)
+
+    def _apply_order(self, data):
+        self.orders[data['id']] = dict(data)
+
+    def _apply_order_update(self, data):
+        order = self.orders[data['id']]
+        order['remaining_quantity'] = data['remaining_quantity']
+        order['status'] = data['status']
+
+    def _apply_cancel(self, data):
+        # Expired orders are journalled as cancels with their own status
+        status = data.get('status', 'CANCELLED')
+        for order_id in data['ids']:
+            self.orders[order_id]['status'] = status
+
+    def _apply_trade(self, data):
+        meal_id = data['meal_id']
+        cost = data['price'] * data['quantity']
+        buyer = (data['buyer_id'], meal_id)
+        self.users[data['buyer_id']]['balance'] -= cost
+        self.positions[buyer] = self.positions.get(buyer, 0) + data['quantity']
+        if data['seller_id']:
+            seller = (data['seller_id'], meal_id)
+            self.users[data['seller_id']]['balance'] += cost
+            self.positions[seller] = self.positions.get(seller, 0) - data['quantity']
+        self.trades.append(data)
+
+    def _apply_supply(self, data):
+        self.meals[data['meal_id']]['house_supply'] = data['house_supply']
+
+    def _apply_ipo(self, data):
+        self.market = dict(data)
+
+    def active_orders(self):
+        return [order for _, order in sorted(self.orders.items()) if order['status'] == 'ACTIVE']
+
+    def state(self):
+        """Plain data for a snapshot of this image"""
+        return {
+            'users': list(self.users.values()),
+            'meals': list(self.meals.values()),
+            'positions': [
+                {'user_id': user_id, 'meal_id': meal_id, 'shares': shares}
+                for (user_id, meal_id), shares in self.positions.items()
+            ],
+            'orders': self.active_orders(),
+            'market': self.market
+        }
+
+
+class Journal:
+    """An append-only journal file shared by every worker process"""
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self._lock = threading.Lock()
+        self._since_snapshot = 0
+
+    def append(self, sequence, events):
+        """Append one committed write; returns True when a snapshot is due"""
+        entry = {'seq': sequence}
+        if events:
+            entry['events'] = events
+        self._write(to_json(entry) + b'\n')
+        with self._lock:
+            self._since_snapshot += 1
+            return self._since_snapshot >= JOURNAL_SNAPSHOT_INTERVAL
+
+    def _write(self, data):
+        # One O_APPEND write per entry keeps lines whole across processes
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+            if JOURNAL_FSYNC:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def is_empty(self):
+        return not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+
+    def write_base(self, sequence):
+        """Start a new journal with a full snapshot, inside a market write"""
+        if self.is_empty():
+            self._write(to_json({'seq': sequence, 'snapshot': capture_state()}) + b'\n')
+
+    def write_snapshot(self, sequence):
+        """Write the latest snapshot, inside a market write
+
+        The offset is taken while this process holds the market write lock,
+        so every entry after a later sequence number is further on in the
+        file.
+        """
+        offset = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        payload = to_json({'seq': sequence, 'offset': offset, 'snapshot': capture_state()})
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        with self._lock:
+            self._since_snapshot = 0
+
+    def load(self, full=False):
+        """Rebuild the market from the latest snapshot (or the very first, if full)"""
+        if self.is_empty():
+            return None
+
+        with open(self.path, 'rb') as f:
+            base = json.loads(f.readline())
+            offset = f.tell()
+        sequence, state = base['seq'], base['snapshot']
+        if not full and os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as f:
+                latest = json.load(f)
+            if latest['seq'] > sequence:
+                sequence, state, offset = latest['seq'], latest['snapshot'], latest['offset']
+
+        image = MarketImage(sequence, state)
+        # Workers append after they commit, so neighbouring entries can be out of order
+        for entry in sorted(self._entries(offset, sequence), key=lambda entry: entry['seq']):
+            image.apply(entry['seq'], entry.get('events', ()))
+        return image
+
+    def _entries(self, offset, after):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # torn final write
+                entry = json.loads(line)
+                if entry['seq'] > after:
+                    yield entry
+
+    def rotate(self):
+        """Move the journal aside so the next start begins a fresh one"""
+        suffix = time.strftime('%Y%m%d_%H%M%S')
+        for path in (self.path, self.snapshot_path):
+            if os.path.exists(path):
+                os.replace(path, f"{path}.{suffix}")
+        with self._lock:
+            self._since_snapshot = 0
+
+
+def restore(image):
+    """Replace every table's contents with a rebuilt market image"""
+    db.drop_all()
+    db.create_all()
+
+    def rows(items, *datetime_fields):
+        return [
+            dict(item, **{field: _datetime(item.get(field)) for field in datetime_fields})
+            for item in items
+        ]
+
+    tables = (
+        (User, rows(image.users.values(), 'created_at')),
+        (Meal, list(image.meals.values())),
+        (Position, [
+            {'user_id': user_id, 'meal_id': meal_id, 'shares': shares}
+            for (user_id, meal_id), shares in image.positions.items()
+        ]),
+        # Journals from before the reservation ledger carry no short flag
+        (Order, [
+            dict(order, short=order.get('short', False))
+            for order in rows(sorted(image.orders.values(), key=lambda order: order['id']), 'created_at', 'expires_at')
+        ]),
+        (Trade, rows(image.trades, 'timestamp')),
+    )
+    for model, items in tables:
+        for start in range(0, len(items), 10000):
+            db.session.execute(insert(model), items[start:start + 10000])
+
+    db.session.add(MarketState(
+        ipo_start_time=_datetime(image.market['ipo_start_time']),
+        ipo_active=image.market['ipo_active']
+    ))
+    db.session.add(MarketSequence(id=SEQUENCE_ROW_ID, value=image.sequence))
+
+    if db.engine.dialect.name == 'postgresql':
+        # Explicit ids leave the serial sequences behind
+        for table in ('users', 'meals', 'orders', 'trades'):
+            db.session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)"
+            ))
+    db.session.commit()
+
+
+journal = Journal(JOURNAL_PATH) if JOURNAL_PATH else None
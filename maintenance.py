@@ -0,0 +1,69 @@
+"""
+Order expiry and history archiving
+
+DAY and GTD orders carry an expires_at. A maintenance pass
+(MarketService.run_maintenance) first expires every resting order past it
+with one UPDATE, releasing what the orders held, then keeps the hot tables
+sized to the live market: filled, cancelled and expired orders older than
+ORDER_ARCHIVE_AGE move to orders_archive, and trades older than
+TRADE_ARCHIVE_AGE move to trades_archive. Each meal's last trade always
+stays, since marks and margin read it. Rows move ARCHIVE_BATCH_SIZE at a
+time, one market write per batch, so a large backlog never holds the
+write lock for long.
+
+With MAINTENANCE_INTERVAL set, the pass runs on a background thread
+(periodic.py); `python manage_db.py maintain` runs one by hand.
+"""
+from datetime import datetime
+from sqlalchemy import delete, func, insert, literal, select
+from database import db, Order, Trade, ArchivedOrder, ArchivedTrade
+from periodic import PeriodicJob
+from config import ARCHIVE_BATCH_SIZE
+
+
+def archive_orders(run_write, before):
+    """Move closed orders last changed before `before` to orders_archive; returns how many moved"""
+    # The newest order stays so SQLite never hands its id out again
+    newest = select(func.max(Order.id)).scalar_subquery()
+    return _archive(run_write, Order, ArchivedOrder, [
+        Order.status != 'ACTIVE', Order.updated_at < before, Order.id < newest
+    ])
+
+
+def archive_trades(run_write, before):
+    """Move trades made before `before`, except each meal's last, to trades_archive; returns how many moved"""
+    latest = select(func.max(Trade.id)).group_by(Trade.meal_id)
+    return _archive(run_write, Trade, ArchivedTrade, [Trade.timestamp < before, Trade.id.notin_(latest)])
+
+
+def _archive(run_write, model, archive, conditions):
+    moved = 0
+    while True:
+        # Look before taking the write lock, so an idle pass writes nothing
+        if db.session.scalar(select(model.id).where(*conditions).limit(1)) is None:
+            return moved
+        count = run_write(lambda: _move_batch(model, archive, conditions), None)
+        if not count:
+            return moved
+        moved += count
+        if count < ARCHIVE_BATCH_SIZE:
+            return moved
+
+
+def _move_batch(model, archive, conditions):
+    """Copy one batch of rows into the archive table and delete them, inside the current write"""
+    ids = db.session.scalars(
+        select(model.id).where(*conditions).order_by(model.id).limit(ARCHIVE_BATCH_SIZE)
+    ).all()
+    if not ids:
+        return 0
+    columns = list(model.__table__.columns)
+    db.session.execute(insert(archive).from_select(
+        [column.name for column in columns] + ['archived_at'],
+        select(*columns, literal(datetime.utcnow(), db.DateTime)).where(model.id.in_(ids))
+    ))
+    db.session.execute(delete(model).where(model.id.in_(ids)).execution_options(synchronize_session=False))
+    return len(ids)
+
+
+maintainer = PeriodicJob('maintainer')
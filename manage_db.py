@@ -2,14 +2,19 @@
 """
 Database management script for the Dining Exchange
 """
+import os
 import sys
 from flask import Flask
-from database import db, User, Meal, Position, Order, Trade, MarketState
+from database import db, User, Meal, Position, Order, Trade, MarketState, ArchivedOrder, ArchivedTrade
 from init_db import init_database
+from schema import upgrade_schema, check_query_plans
+import journal
+import candles
+import reservations
 from config import FRIENDS, CHICKEN_INDEX, BEEF_INDEX, MISC_INDEX
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///dining_exchange.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///dining_exchange.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db.init_app(app)
@@ -21,6 +26,10 @@ def reset_database():
         db.drop_all()
         print("Creating fresh tables...")
         init_database()
+        if journal.enabled():
+            # The old journal describes a market that no longer exists
+            journal.journal.rotate()
+            print("Journal moved aside; the app starts a new one")
         print("Database reset complete!")
 
 def show_stats():
@@ -31,6 +40,8 @@ def show_stats():
         positions = Position.query.filter(Position.shares != 0).count()
         active_orders = Order.query.filter_by(status='ACTIVE').count()
         trades = Trade.query.count()
+        archived_orders = ArchivedOrder.query.count()
+        archived_trades = ArchivedTrade.query.count()
         
         print("\n=== Database Statistics ===")
         print(f"Users: {users}")
@@ -38,6 +49,8 @@ def show_stats():
         print(f"Active Positions: {positions}")
         print(f"Active Orders: {active_orders}")
         print(f"Total Trades: {trades}")
+        print(f"Archived Orders: {archived_orders}")
+        print(f"Archived Trades: {archived_trades}")
         
         # Show top traders
         print("\n=== Top Traders (by trade count) ===")
@@ -49,6 +62,14 @@ def show_stats():
         
         for i, (username, count) in enumerate(top_buyers, 1):
             print(f"{i}. {username}: {count} trades")
+        
+        print("\n=== Top Traders (by net worth) ===")
+        from market_cache import current_sequence
+        from valuation import Valuations
+        valuations = Valuations()
+        valuations.load(current_sequence())
+        for entry in valuations.leaderboard(5):
+            print(f"{entry['rank']}. {entry['username']}: ${entry['net_worth']:.2f}")
 
 def list_users():
     """List all users and their balances"""
@@ -79,15 +100,90 @@ def reset_ipo():
     """Reset IPO state (stop IPO and reset price to 200)"""
     with app.app_context():
         from database import MarketState
+        from market_cache import bump_sequence
         state = MarketState.query.first()
         if state:
             state.ipo_start_time = None
             state.ipo_active = False
+            # Tell running app workers to drop their cached snapshots and IPO clock
+            sequence = bump_sequence()
+            journal.stage('ipo', {'ipo_start_time': None, 'ipo_active': False})
             db.session.commit()
+            journal.append_staged(sequence)
             print("IPO state reset - price back to $200.00")
         else:
             print("No market state found")
 
+def migrate_schema():
+    """Add missing columns and indexes to an existing database"""
+    with app.app_context():
+        db.create_all()
+        added = upgrade_schema()
+        if added:
+            for change in added:
+                print(f"Added {change}")
+        else:
+            print("Schema already up to date")
+
+def check_plans():
+    """Fail if any hot market query falls back to a full table scan"""
+    with app.app_context():
+        # A fresh checkout has no tables yet; plans only need the schema
+        db.create_all()
+        failures = check_query_plans()
+        if not failures:
+            print("All hot queries use an index")
+            return True
+        for name, plan in failures:
+            print(f"\nFull scan in {name}:")
+            for line in plan:
+                print(f"  {line}")
+        return False
+
+def replay_journal(full):
+    """Rebuild every table from the market journal"""
+    if not journal.enabled():
+        print("Set JOURNAL_PATH to the journal to replay")
+        return False
+    image = journal.journal.load(full=full)
+    if image is None:
+        print(f"Journal {journal.JOURNAL_PATH} is empty")
+        return False
+    with app.app_context():
+        journal.restore(image)
+        candles.rebuild()
+        reservations.rebuild()
+        db.session.commit()
+    print(f"Rebuilt {len(image.users)} users, {len(image.meals)} meals, "
+          f"{len(image.active_orders())} active orders and {len(image.trades)} trades "
+          f"at sequence {image.sequence}")
+    return True
+
+def backfill_candles():
+    """Rebuild every OHLCV candle from the trades table"""
+    with app.app_context():
+        db.create_all()
+        count = candles.backfill()
+        print(f"Rebuilt {count} candles from {Trade.query.count()} trades")
+
+def liquidate():
+    """Buy back the shorts of every user below the maintenance margin"""
+    from market_service import MarketService
+    with app.app_context():
+        liquidated = MarketService.liquidate_margin_breaches()
+        if not liquidated:
+            print("No users below the maintenance margin")
+        for username, covered in liquidated.items():
+            bought = ", ".join(f"{quantity} {meal}" for meal, quantity in covered.items()) or "nothing on the book"
+            print(f"{username}: bought back {bought}")
+
+def maintain():
+    """Expire lapsed orders and archive old closed orders and trades"""
+    from market_service import MarketService
+    with app.app_context():
+        expired, orders, trades = MarketService.run_maintenance()
+        print(f"Expired {expired} orders; archived {orders} closed orders and {trades} trades")
+
 def main():
     if len(sys.argv) < 2:
         print("Usage: python manage_db.py [command]")
@@ -98,6 +194,12 @@ def main():
         print("  meals       - List all meals")
         print("  backup      - Create a database backup")
         print("  reset_ipo   - Reset IPO state (price back to $200)")
+        print("  migrate     - Add missing columns and indexes to an existing database")
+        print("  check_plans - Fail if hot queries regress to full table scans")
+        print("  replay      - Rebuild all tables from the journal (--snapshot: start at the latest snapshot, keeping only later trades)")
+        print("  candles     - Rebuild OHLCV candles from the trade history in one pass")
+        print("  liquidate   - Buy back the shorts of users below the maintenance margin")
+        print("  maintain    - Expire lapsed orders and archive old closed orders and trades")
         return
     
     command = sys.argv[1]
@@ -118,6 +220,24 @@ def main():
         backup_database()
     elif command == "reset_ipo":
         reset_ipo()
+    elif command == "migrate":
+        migrate_schema()
+    elif command == "check_plans":
+        if not check_plans():
+            sys.exit(1)
+    elif command == "replay":
+        confirm = input("This will REPLACE all data with the journal's. Are you sure? (yes/no): ")
+        if confirm.lower() == 'yes':
+            if not replay_journal(full="--snapshot" not in sys.argv[2:]):
+                sys.exit(1)
+        else:
+            print("Replay cancelled.")
+    elif command == "candles":
+        backfill_candles()
+    elif command == "liquidate":
+        liquidate()
+    elif command == "maintain":
+        maintain()
     else:
         print(f"Unknown command: {command}")
 
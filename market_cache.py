@@ -0,0 +1,86 @@
+"""
+Market sequence number and serialized snapshot cache
+
+Every market write (order placement, fills, cancels, IPO changes) bumps a
+single shared sequence row inside its own transaction. Readers compare the
+current sequence with the version their cached snapshot was built at and
+only rebuild when something has changed, so all gunicorn workers invalidate
+consistently without talking to each other.
+"""
+import json
+import threading
+import time
+from sqlalchemy import select, update
+from database import db, MarketSequence
+from instrumentation import serializing
+
+SEQUENCE_ROW_ID = 1
+
+
+def current_sequence():
+    """Read the shared market sequence number"""
+    value = db.session.scalar(
+        select(MarketSequence.value).where(MarketSequence.id == SEQUENCE_ROW_ID)
+    )
+    if value is None:
+        return _create_sequence()
+    return value
+
+
+def ensure_sequence():
+    """Create the sequence row if this database predates it"""
+    current_sequence()
+
+
+def bump_sequence():
+    """Advance the market sequence inside the current transaction and return the new value"""
+    updated = db.session.execute(
+        update(MarketSequence)
+        .where(MarketSequence.id == SEQUENCE_ROW_ID)
+        .values(value=MarketSequence.value + 1)
+    ).rowcount
+    if not updated:
+        _create_sequence()
+        return bump_sequence()
+    return db.session.scalar(
+        select(MarketSequence.value).where(MarketSequence.id == SEQUENCE_ROW_ID)
+    )
+
+
+def _create_sequence():
+    # Seed from the clock so a recreated database never repeats old versions
+    value = int(time.time() * 1000)
+    db.session.add(MarketSequence(id=SEQUENCE_ROW_ID, value=value))
+    db.session.flush()
+    return value
+
+
+def to_json(payload):
+    """Serialize a snapshot to compact JSON bytes"""
+    with serializing():
+        return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+
+class SnapshotCache:
+    """Process-level cache of snapshots keyed by the market sequence they were built at"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, version, build):
+        """Return the cached snapshot for key, rebuilding it if the version moved"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        value = build()
+        with self._lock:
+            self._entries[key] = (version, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+
+snapshot_cache = SnapshotCache()
@@ -0,0 +1,128 @@
+"""
+Market event fan-out for the live stream
+
+MarketService stages events (new trades, top-of-book changes, balance
+changes) on the database session while it works. They are published to
+subscribers only once the write commits, and are dropped on rollback.
+Writes made by other worker processes are detected by watching the shared
+market sequence, and subscribers are told to resync.
+"""
+import queue
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from database import db
+from market_cache import current_sequence
+from config import STREAM_POLL_INTERVAL
+
+PENDING_KEY = 'market_events'
+
+
+def stage(name, data, username=None):
+    """Queue an event to publish when the current transaction commits
+
+    Events with a username are only delivered to that user's streams.
+    """
+    db.session.info.setdefault(PENDING_KEY, []).append((name, data, username))
+
+
+def publish_staged(sequence):
+    """Publish the events staged by a write that just committed and return them"""
+    events = db.session.info.pop(PENDING_KEY, [])
+    broker.publish(events, sequence)
+    return events
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_staged(session, previous_transaction):
+    session.info.pop(PENDING_KEY, None)
+
+
+class Subscription:
+    """One open stream's queue of pending events"""
+
+    def __init__(self, username, maxsize=256):
+        self.username = username
+        self.events = queue.Queue(maxsize=maxsize)
+
+    def put(self, name, data):
+        try:
+            self.events.put_nowait((name, data))
+        except queue.Full:
+            # Slow consumer: throw away the backlog and have it start over
+            self.clear()
+            self.events.put_nowait(('resync', None))
+
+    def get(self, timeout):
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None, None
+
+    def clear(self):
+        while True:
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                return
+
+
+class MarketEventBroker:
+    """Process-wide registry of stream subscriptions"""
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._watcher = None
+        self.sequence = None
+
+    def subscribe(self, username):
+        subscription = Subscription(username)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, events, sequence=None):
+        if sequence is not None:
+            self.sequence = max(sequence, self.sequence or sequence)
+        if not events:
+            return
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            for name, data, username in events:
+                if username is None or username == subscription.username:
+                    subscription.put(name, data)
+
+    def watch(self, app):
+        """Start the background thread that notices other workers' writes"""
+        with self._lock:
+            if self._watcher is not None:
+                return
+            self._watcher = threading.Thread(target=self._watch, args=(app,), daemon=True)
+        self._watcher.start()
+
+    def _watch(self, app):
+        while True:
+            time.sleep(STREAM_POLL_INTERVAL)
+            if not self._subscribers:
+                continue
+            try:
+                with app.app_context():
+                    sequence = current_sequence()
+            except Exception:
+                continue
+            if self.sequence is None:
+                self.sequence = sequence
+            elif sequence != self.sequence:
+                # One cheap read per process per tick, however many streams are open
+                self.sequence = sequence
+                self.publish([('resync', None, None)])
+
+
+broker = MarketEventBroker()
@@ -1,11 +1,83 @@
+import base64
+import math
 import time
-from datetime import datetime
-from database import db, User, Meal, Position, Order, Trade, MarketState
+from datetime import datetime, timedelta
+from sqlalchemy import and_, bindparam, case, func, insert, or_, select, tuple_, union_all, update
+from sqlalchemy.orm import joinedload
+from database import db, User, Meal, Position, Order, Trade, ArchivedTrade, MarketState, EPOCH
+from order_book import order_books
+from book import BookOrder, prepare_order, order_expiry, order_error, valid_quantity
+from reference_data import reference_data
+from valuation import valuations, buy_back_limit, last_trades
+from market_cache import current_sequence, bump_sequence, snapshot_cache, to_json
+import market_events
+import journal
+import instrumentation
+import candles
+import reservations
+import risk
+import maintenance
+from matching_engine import engine
+from ipo_auction import ipo_auction
 from config import (
     FRIENDS, ALL_MEALS, INITIAL_BALANCE, INITIAL_HOUSE_SUPPLY,
-    IPO_START_PRICE, IPO_DECAY_RATE, IPO_DECAY_INTERVAL, MEAL_CATEGORIES
+    IPO_START_PRICE, IPO_DECAY_RATE, IPO_DECAY_INTERVAL, MEAL_CATEGORIES,
+    CANDLE_INTERVALS, CANDLE_DEFAULT_LIMIT, CANDLE_MAX_LIMIT, LEADERBOARD_SIZE,
+    TRADE_PAGE_DEFAULT, TRADE_STREAM_BATCH, SHORT_MAINTENANCE_MARGIN,
+    ORDER_ARCHIVE_AGE, TRADE_ARCHIVE_AGE
 )
 
+# How many times a match is retried after finding the in-memory book stale
+MATCH_RETRIES = 3
+
+# Eager loads for the relationships each model's to_dict touches, so
+# serializing N rows costs one query instead of 1 + N lazy loads
+ORDER_LOADS = (joinedload(Order.meal), joinedload(Order.buyer), joinedload(Order.seller))
+TRADE_LOADS = (joinedload(Trade.meal), joinedload(Trade.buyer))
+POSITION_LOADS = (joinedload(Position.meal),)
+
+def encode_trade_cursor(timestamp, trade_id):
+    """Opaque paging cursor for the trade at (timestamp, id)"""
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()},{trade_id}".encode('utf-8')).decode('ascii')
+
+def decode_trade_cursor(cursor):
+    """(timestamp, id) from a cursor; raises ValueError if it was not made by encode_trade_cursor"""
+    timestamp, trade_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split(',')
+    return datetime.fromisoformat(timestamp), int(trade_id)
+
+def time_from_unix(seconds):
+    """Unix seconds as naive UTC; raises ValueError unless they are a finite, representable time"""
+    if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or not math.isfinite(seconds):
+        raise ValueError("Not a time in unix seconds")
+    try:
+        return EPOCH + timedelta(seconds=seconds)
+    except OverflowError:
+        raise ValueError("Not a time in unix seconds") from None
+
+def expiry_from_unix(value):
+    """A GTD expires_at given in unix seconds as naive UTC, or None; raises ValueError if it is not a time"""
+    if value is None:
+        return None
+    try:
+        return time_from_unix(value)
+    except ValueError:
+        raise ValueError("expires_at must be a time in unix seconds") from None
+
+class StaleBookError(Exception):
+    """Raised when a resting order no longer matches the in-memory book"""
+
+class BatchRejected(Exception):
+    """Raised to roll back an all-or-nothing batch when one of its orders fails"""
+
+class InvalidBatch(Exception):
+    """Raised before an all-or-nothing batch runs if any of its orders is malformed
+
+    results holds one result dict per order, naming what is wrong with each.
+    """
+    def __init__(self, message, results):
+        super().__init__(message)
+        self.results = results
+
 class MarketService:
     """Service layer for market operations using database"""
     
@@ -20,15 +92,30 @@ class MarketService:
         return state
     
     @staticmethod
-    def get_current_ipo_price():
+    def get_ipo_state():
+        """Get (ipo_start_time, ipo_active), read from the database only when not cached"""
+        ipo_state = reference_data.ipo_state()
+        if ipo_state is None:
+            state = MarketService.get_or_create_market_state()
+            reference_data.set_ipo_state(state.ipo_start_time, state.ipo_active)
+            ipo_state = (state.ipo_start_time, state.ipo_active)
+        return ipo_state
+    
+    @staticmethod
+    def get_current_ipo_price(state=None):
         """Calculate current IPO price based on time elapsed"""
-        state = MarketService.get_or_create_market_state()
-        
+        if state is None:
+            return MarketService.ipo_price_at(*MarketService.get_ipo_state())
+        return MarketService.ipo_price_at(state.ipo_start_time, state.ipo_active)
+    
+    @staticmethod
+    def ipo_price_at(ipo_start_time, ipo_active):
+        """IPO price for a given start time, as of now"""
         # If IPO hasn't started or isn't active, return start price
-        if not state.ipo_start_time or not state.ipo_active:
+        if not ipo_start_time or not ipo_active:
             return IPO_START_PRICE
         
-        elapsed = (datetime.utcnow() - state.ipo_start_time).total_seconds()
+        elapsed = (datetime.utcnow() - ipo_start_time).total_seconds()
         decay = int(elapsed // IPO_DECAY_INTERVAL) * IPO_DECAY_RATE
         current_price = max(0.0, IPO_START_PRICE - decay)
         return current_price
@@ -38,42 +125,140 @@ class MarketService:
         """Start the IPO clock"""
         state = MarketService.get_or_create_market_state()
         if not state.ipo_start_time:
+            sequence = MarketService._begin_write()
             state.ipo_start_time = datetime.utcnow()
             state.ipo_active = True
-            db.session.commit()
+            market_events.stage('resync', None)
+            journal.stage('ipo', {'ipo_start_time': state.ipo_start_time.isoformat(), 'ipo_active': True})
+            MarketService._commit_write(sequence)
+        reference_data.set_ipo_state(state.ipo_start_time, state.ipo_active)
         return True
     
+    @staticmethod
+    def _begin_write():
+        """Claim the next market sequence number for the current transaction
+        
+        Bumping the shared sequence first serializes market writes across
+        workers. If another process wrote since this one last did, its
+        in-memory books and cached IPO clock are dropped and lazily reloaded
+        from the database.
+        """
+        sequence = bump_sequence()
+        if order_books.sync(sequence - 1):
+            reference_data.invalidate_ipo()
+        return sequence
+    
+    @staticmethod
+    def _commit_write(sequence):
+        """Commit a market write, record its sequence number as seen and publish its events"""
+        db.session.commit()
+        instrumentation.count_commit()
+        order_books.seen(sequence)
+        valuations.apply(sequence, market_events.publish_staged(sequence))
+        if journal.append_staged(sequence):
+            MarketService.snapshot_journal()
+    
+    @staticmethod
+    def start_journal():
+        """Begin the journal with a full snapshot if it is new or was rotated"""
+        if journal.enabled() and journal.journal.is_empty():
+            sequence = MarketService._begin_write()
+            journal.journal.write_base(sequence)
+            MarketService._commit_write(sequence)
+    
+    @staticmethod
+    def snapshot_journal():
+        """Write a fresh journal snapshot while holding the market write lock"""
+        sequence = MarketService._begin_write()
+        try:
+            journal.journal.write_snapshot(sequence)
+        except Exception:
+            MarketService._abort_write()
+            raise
+        MarketService._commit_write(sequence)
+    
+    @staticmethod
+    def _stage_book_event(meal, house_supply=None):
+        """Stage a top-of-book update for a meal from its in-memory book
+        
+        House supply only changes on IPO buys, so it is only sent by them.
+        """
+        book = order_books.get(meal.id)
+        best_ask = book.best_ask()
+        best_bid = book.best_bid()
+        update = {
+            'id': meal.id,
+            'name': meal.name,
+            'category': meal.category,
+            'best_ask': best_ask.price if best_ask else None,
+            'best_bid': best_bid.price if best_bid else None,
+            'spread': (best_ask.price - best_bid.price) if (best_ask and best_bid) else None
+        }
+        if house_supply is not None:
+            update['house_supply'] = house_supply
+        market_events.stage('book', update)
+    
     @staticmethod
     def get_user(username):
         """Get or create user"""
-        user = User.query.filter_by(username=username).first()
-        if not user:
+        ref = MarketService.get_user_ref(username)
+        return db.session.get(User, ref.id)
+    
+    @staticmethod
+    def get_user_ref(username):
+        """Get or create user, returning only its id and name from the reference cache"""
+        ref = reference_data.user(username)
+        if ref is None:
+            sequence = MarketService._begin_write()
             user = User(username=username, balance=INITIAL_BALANCE)
             db.session.add(user)
-            db.session.commit()
-        return user
+            db.session.flush()
+            journal.stage('user', {
+                'id': user.id,
+                'username': user.username,
+                'balance': user.balance,
+                'created_at': user.created_at.isoformat()
+            })
+            market_events.stage('balance', {'balance': user.balance}, username=user.username)
+            MarketService._commit_write(sequence)
+            ref = reference_data.add_user(user)
+        return ref
     
     @staticmethod
     def get_meal(meal_name):
-        """Get meal by name"""
-        return Meal.query.filter_by(name=meal_name).first()
+        """Get meal's id, name and category by name from the reference cache"""
+        return reference_data.meal(meal_name)
     
     @staticmethod
-    def get_or_create_position(user_id, meal_id):
-        """Get or create position for user and meal"""
-        position = Position.query.filter_by(user_id=user_id, meal_id=meal_id).first()
-        if not position:
-            position = Position(user_id=user_id, meal_id=meal_id, shares=0)
-            db.session.add(position)
-            db.session.commit()
-        return position
+    def get_portfolio(username, version=None):
+        """Get user's portfolio with non-zero positions, each marked to market"""
+        user = MarketService.get_user_ref(username)
+        positions = Position.query.options(*POSITION_LOADS).filter_by(
+            user_id=user.id
+        ).filter(Position.shares != 0).all()
+        if version is None:
+            version = current_sequence()
+        marks = valuations.marks_for([pos.meal_id for pos in positions], version)
+        portfolio = {}
+        for pos in positions:
+            entry = pos.to_dict()
+            entry['mark'] = marks[pos.meal_id]
+            entry['value'] = entry['mark'] * pos.shares
+            portfolio[pos.meal.name] = entry
+        return portfolio
     
     @staticmethod
-    def get_portfolio(username):
-        """Get user's portfolio with non-zero positions"""
-        user = MarketService.get_user(username)
-        positions = Position.query.filter_by(user_id=user.id).filter(Position.shares != 0).all()
-        return {pos.meal.name: pos.to_dict() for pos in positions}
+    def get_net_worth(username, version=None):
+        """A user's cash, marked positions value and net worth"""
+        MarketService.get_user_ref(username)
+        valuations.ensure_current(version)
+        return valuations.user(username)
+    
+    @staticmethod
+    def get_leaderboard(limit=LEADERBOARD_SIZE, version=None):
+        """Users ranked by net worth, richest first"""
+        valuations.ensure_current(version)
+        return valuations.leaderboard(limit)
     
     @staticmethod
     def get_best_ask(meal_id):
@@ -98,33 +283,47 @@ class MarketService:
     @staticmethod
     def get_market_summary():
         """Get market overview with all meals"""
-        ipo_price = MarketService.get_current_ipo_price()
         state = MarketService.get_or_create_market_state()
+        ipo_price = MarketService.get_current_ipo_price(state)
         
         summary = {
             'ipo_price': ipo_price,
             'ipo_active': state.ipo_active,
-            'meals': []
+            'meals': MarketService._meal_summaries()
         }
         
-        meals = Meal.query.all()
-        for meal in meals:
-            best_ask = MarketService.get_best_ask(meal.id)
-            best_bid = MarketService.get_best_bid(meal.id)
-            
-            meal_data = {
-                'id': meal.id,
-                'name': meal.name,
-                'category': meal.category,
-                'house_supply': meal.house_supply,
-                'best_ask': best_ask.price if best_ask else None,
-                'best_bid': best_bid.price if best_bid else None,
-                'spread': (best_ask.price - best_bid.price) if (best_ask and best_bid) else None
-            }
-            summary['meals'].append(meal_data)
-        
         return summary
     
+    @staticmethod
+    def _meal_summary_query():
+        """Top of book for every meal in one grouped pass over the active orders"""
+        best_ask = func.min(case((Order.order_type == 'ASK', Order.price)))
+        best_bid = func.max(case((Order.order_type == 'BID', Order.price)))
+        return db.session.query(
+            Meal.id, Meal.name, Meal.category, Meal.house_supply,
+            best_ask.label('best_ask'), best_bid.label('best_bid')
+        ).outerjoin(
+            Order, and_(Order.meal_id == Meal.id, Order.status == 'ACTIVE')
+        ).group_by(
+            Meal.id, Meal.name, Meal.category, Meal.house_supply
+        ).order_by(Meal.id)
+    
+    @staticmethod
+    def _meal_summaries():
+        rows = MarketService._meal_summary_query().all()
+        return [
+            {
+                'id': row.id,
+                'name': row.name,
+                'category': row.category,
+                'house_supply': row.house_supply,
+                'best_ask': row.best_ask,
+                'best_bid': row.best_bid,
+                'spread': (row.best_ask - row.best_bid) if (row.best_ask is not None and row.best_bid is not None) else None
+            }
+            for row in rows
+        ]
+    
     @staticmethod
     def get_order_book(meal_name):
         """Get full order book for a specific meal"""
@@ -132,13 +331,13 @@ class MarketService:
         if not meal:
             return None
         
-        asks = Order.query.filter_by(
+        asks = Order.query.options(*ORDER_LOADS).filter_by(
             meal_id=meal.id,
             order_type='ASK',
             status='ACTIVE'
         ).order_by(Order.price.asc()).all()
         
-        bids = Order.query.filter_by(
+        bids = Order.query.options(*ORDER_LOADS).filter_by(
             meal_id=meal.id,
             order_type='BID',
             status='ACTIVE'
@@ -151,123 +350,486 @@ class MarketService:
         }
     
     @staticmethod
-    def execute_trade(buyer_username, seller_username, meal_id, price, quantity):
-        """Execute a trade between buyer and seller"""
-        buyer = MarketService.get_user(buyer_username)
-        seller = MarketService.get_user(seller_username) if seller_username != "IPO_HOUSE" else None
-        meal = Meal.query.get(meal_id)
+    def _settle_fills(meal, fills):
+        """Stage cash, position and trade rows for a batch of fills without committing
         
-        cost = price * quantity
+        Each fill is a (buyer_id, seller_id, price, quantity, cash_released,
+        shares_released) tuple, with seller_id None for IPO fills; the last
+        two are what the fill frees from the buyer's held cash and the
+        seller's held shares. All involved users and their positions are
+        loaded with one query each, missing positions are created, and the
+        trades are inserted together so the whole batch lands in the
+        caller's transaction.
+        """
+        user_ids = {fill[0] for fill in fills} | {fill[1] for fill in fills if fill[1]}
+        # Fresh, locked copies: never apply a fill to a balance read before the write lock
+        users = {
+            user.id: user
+            for user in User.query.filter(User.id.in_(user_ids)).populate_existing().with_for_update()
+        }
+        positions = {
+            position.user_id: position
+            for position in Position.query.filter(
+                Position.meal_id == meal.id,
+                Position.user_id.in_(user_ids)
+            ).populate_existing().with_for_update()
+        }
         
-        # Update balances
-        buyer.balance -= cost
-        if seller:
-            seller.balance += cost
+        def position_for(user_id):
+            position = positions.get(user_id)
+            if position is None:
+                position = positions[user_id] = Position(user_id=user_id, meal_id=meal.id, shares=0, held_shares=0)
+                db.session.add(position)
+            return position
         
-        # Transfer shares
-        buyer_position = MarketService.get_or_create_position(buyer.id, meal_id)
-        buyer_position.shares += quantity
+        now = datetime.utcnow()
+        rows = []
+        for buyer_id, seller_id, price, quantity, cash_released, shares_released in fills:
+            cost = price * quantity
+            buyer = users[buyer_id]
+            seller = users[seller_id] if seller_id else None
+            
+            # Update balances, releasing what the orders held for this fill
+            buyer.balance -= cost
+            buyer.held_balance -= cash_released
+            if seller:
+                seller.balance += cost
+            
+            # Transfer shares
+            position_for(buyer_id).shares += quantity
+            if seller:
+                seller_position = position_for(seller_id)
+                seller_position.shares -= quantity
+                seller_position.held_shares -= shares_released
+            
+            rows.append({
+                'meal_id': meal.id,
+                'buyer_id': buyer_id,
+                'seller_id': seller_id,
+                'seller_name': seller.username if seller else "IPO_HOUSE",
+                'quantity': quantity,
+                'price': price,
+                'timestamp': now
+            })
         
-        if seller:
-            seller_position = MarketService.get_or_create_position(seller.id, meal_id)
-            seller_position.shares -= quantity
+        trades = MarketService._record_trades(meal, rows, {
+            user_id: user.username for user_id, user in users.items()
+        })
+        for user in users.values():
+            market_events.stage('balance', {
+                'balance': user.balance,
+                'held_balance': user.held_balance
+            }, username=user.username)
         
-        # Record trade
-        trade = Trade(
-            meal_id=meal_id,
-            buyer_id=buyer.id,
-            seller_id=seller.id if seller else None,
-            seller_name=seller.username if seller else "IPO_HOUSE",
-            quantity=quantity,
-            price=price,
-            timestamp=datetime.utcnow()
-        )
-        db.session.add(trade)
-        db.session.commit()
+        return trades
+    
+    @staticmethod
+    def _record_trades(meal, rows, usernames):
+        """Insert one meal's trade rows with a single multi-row INSERT and stage their events
         
-        return trade.to_dict()
+        usernames maps each buyer id to its username for the trade events.
+        """
+        trade_ids = db.session.scalars(
+            insert(Trade).returning(Trade.id, sort_by_parameter_order=True),
+            rows
+        ).all()
+        for trade_id, row in zip(trade_ids, rows):
+            journal.stage('trade', journal.trade_event(trade_id, row))
+        candles.record(meal.id, rows)
+        
+        trades = [
+            {
+                'id': trade_id,
+                'meal_id': meal.id,
+                'meal_name': meal.name,
+                'buyer': usernames[row['buyer_id']],
+                'seller': row['seller_name'],
+                'quantity': row['quantity'],
+                'price': row['price'],
+                'timestamp': row['timestamp'].isoformat()
+            }
+            for trade_id, row in zip(trade_ids, rows)
+        ]
+        market_events.stage('trades', trades)
+        return trades
     
     @staticmethod
     def buy_from_ipo(username, meal_name, quantity):
         """Buy shares directly from IPO"""
-        state = MarketService.get_or_create_market_state()
-        if not state.ipo_active:
+        ipo_start_time, ipo_active = MarketService.get_ipo_state()
+        if not ipo_active:
+            # Another process may have started it since this one cached the clock
+            reference_data.invalidate_ipo()
+            ipo_start_time, ipo_active = MarketService.get_ipo_state()
+        if not ipo_active:
             return False, "IPO not started"
         
         meal = MarketService.get_meal(meal_name)
         if not meal:
             return False, "Invalid meal"
+        if not valid_quantity(quantity):
+            return False, "Quantity must be a positive whole number"
         
-        user = MarketService.get_user(username)
-        ipo_price = MarketService.get_current_ipo_price()
-        cost = ipo_price * quantity
+        user = MarketService.get_user_ref(username)
+        ipo_price = MarketService.ipo_price_at(ipo_start_time, ipo_active)
+        
+        work = lambda: MarketService._buy_ipo(user, meal, ipo_price, quantity)
+        busy = (False, "Market busy, please retry")
+        if ipo_auction.running:
+            # Join this tick's batch; it is filled at this price when the tick ends
+            elapsed = (datetime.utcnow() - ipo_start_time).total_seconds()
+            success, message = ipo_auction.submit(IPO_DECAY_INTERVAL - elapsed % IPO_DECAY_INTERVAL, work, busy)
+        else:
+            success, message = MarketService._run_write(work, busy)
+        if not success:
+            return False, message
+        
+        return True, f"Bought {quantity} shares of {meal_name} at ${ipo_price:.2f}"
+    
+    @staticmethod
+    def _buy_ipo(user, meal, ipo_price, quantity):
+        """Stage an IPO purchase inside the current market write
         
-        if quantity > meal.house_supply:
-            return False, "Insufficient supply"
+        Supply is taken by one conditional UPDATE that only matches while
+        the house has the shares and the buyer's available (unheld) cash
+        covers them, and cash and shares move by relative UPDATEs, so
+        nothing is read into Python and written back and concurrent buyers
+        can neither oversell the house nor overdraw themselves.
+        """
+        cost = ipo_price * quantity
+        available = select(User.balance - User.held_balance).where(User.id == user.id).scalar_subquery()
+        house_supply = MarketService._update_returning(
+            Meal, meal.id, Meal.house_supply, {'house_supply': Meal.house_supply - quantity},
+            Meal.house_supply >= quantity, available >= cost
+        )
+        if house_supply is None:
+            funds = db.session.scalar(select(User.balance - User.held_balance).where(User.id == user.id))
+            return False, "Insufficient funds" if funds < cost else "Insufficient supply"
         
-        if user.balance < cost:
-            return False, "Insufficient funds"
+        balance = MarketService._update_returning(
+            User, user.id, User.balance, {'balance': User.balance - cost}
+        )
+        MarketService._add_shares(user.id, meal.id, quantity)
+        MarketService._record_trades(meal, [{
+            'meal_id': meal.id,
+            'buyer_id': user.id,
+            'seller_id': None,
+            'seller_name': "IPO_HOUSE",
+            'quantity': quantity,
+            'price': ipo_price,
+            'timestamp': datetime.utcnow()
+        }], {user.id: user.username})
+        market_events.stage('balance', {'balance': balance}, username=user.username)
+        journal.stage('supply', {'meal_id': meal.id, 'house_supply': house_supply})
+        MarketService._stage_book_event(meal, house_supply)
+        return True, "Bought"
+    
+    @staticmethod
+    def _update_returning(model, row_id, column, values, *conditions):
+        """UPDATE one row by id if the conditions hold; return column's new value, or None if unmatched"""
+        stmt = (
+            update(model)
+            .where(model.id == row_id, *conditions)
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+        if db.engine.dialect.update_returning:
+            return db.session.scalar(stmt.returning(column))
+        if not db.session.execute(stmt).rowcount:
+            return None
+        return db.session.scalar(select(column).where(model.id == row_id))
+    
+    @staticmethod
+    def _add_shares(user_id, meal_id, quantity):
+        """Add shares to a position in place, creating the row on first purchase"""
+        updated = db.session.execute(
+            update(Position)
+            .where(Position.user_id == user_id, Position.meal_id == meal_id)
+            .values(shares=Position.shares + quantity, updated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not updated:
+            db.session.execute(insert(Position).values(user_id=user_id, meal_id=meal_id, shares=quantity))
+    
+    @staticmethod
+    def place_buy_order(username, meal_name, price, quantity, snap_buy=False, time_in_force='GTC', expires_at=None):
+        """Place a buy order (bid) on the secondary market
         
-        # Update house supply
-        meal.house_supply -= quantity
+        time_in_force is one of book.TIME_IN_FORCE; a snap-buy is an
+        IOC, a MARKET order needs no price and a GTD order rests until
+        expires_at (naive UTC).
+        """
+        meal = MarketService.get_meal(meal_name)
+        if not meal:
+            return False, "Invalid meal", []
         
-        # Execute trade
-        MarketService.execute_trade(username, "IPO_HOUSE", meal.id, ipo_price, quantity)
+        user = MarketService.get_user_ref(username)
+        if snap_buy:
+            time_in_force = 'IOC'
         
-        return True, f"Bought {quantity} shares of {meal_name} at ${ipo_price:.2f}"
+        return MarketService._submit(
+            lambda: MarketService._place_buy(user, meal, price, quantity, time_in_force, expires_at),
+            (False, "Market busy, please retry", [])
+        )
     
     @staticmethod
-    def place_buy_order(username, meal_name, price, quantity, snap_buy=False):
-        """Place a buy order (bid) on the secondary market"""
+    def place_sell_order(username, meal_name, price, quantity, is_short=False, time_in_force='GTC', expires_at=None):
+        """Place a sell order (ask) on the secondary market"""
         meal = MarketService.get_meal(meal_name)
         if not meal:
             return False, "Invalid meal", []
         
-        user = MarketService.get_user(username)
-        trades_executed = []
-        remaining_qty = quantity
+        user = MarketService.get_user_ref(username)
         
-        # Try to match with existing asks
-        while remaining_qty > 0:
-            best_ask = MarketService.get_best_ask(meal.id)
-            if not best_ask or best_ask.price > price:
-                break
-            
-            # Execute trade
-            trade_qty = min(remaining_qty, best_ask.remaining_quantity)
-            
-            if user.balance < (best_ask.price * trade_qty):
-                break  # Insufficient funds
-            
-            # Execute the trade
-            seller = User.query.get(best_ask.seller_id)
-            trade = MarketService.execute_trade(
-                username, seller.username, meal.id, best_ask.price, trade_qty
+        return MarketService._submit(
+            lambda: MarketService._place_sell(user, meal, price, quantity, is_short, time_in_force, expires_at),
+            (False, "Market busy, please retry", [])
+        )
+    
+    @staticmethod
+    def _prepare(meal, side, price, quantity, time_in_force, expires_at):
+        """An incoming order's limit, whether it rests, its expiry and any rejection, from one look at the book
+        
+        Resting orders past their expiry are expired first, so they never
+        count as liquidity or trade even if no maintenance pass has run since.
+        """
+        now = datetime.utcnow()
+        expires_at, rejected = order_expiry(time_in_force, expires_at, now)
+        if rejected:
+            return price, False, None, rejected
+        book = order_books.get(meal.id)
+        with book.lock:
+            expired = book.due(now)
+            if expired:
+                MarketService._close_orders([Order.id.in_(expired)], 'EXPIRED')
+            price, rest, rejected = prepare_order(book, side, price, quantity, time_in_force)
+        return price, rest, expires_at, rejected
+    
+    @staticmethod
+    def _place_buy(user, meal, price, quantity, time_in_force='GTC', expires_at=None):
+        """Stage a buy order inside the current market write"""
+        price, rest, expires_at, rejected = MarketService._prepare(
+            meal, 'BID', price, quantity, time_in_force, expires_at
+        )
+        if rejected:
+            return False, rejected, []
+        
+        # Hold the most the order can cost; fills below the limit release the difference
+        if not reservations.reserve_cash(user.id, price * quantity):
+            return False, "Insufficient funds", []
+        
+        # Match against existing asks
+        remaining_qty, trades_executed = MarketService._match(
+            user, meal, 'BID', price, quantity, rest=rest, expires_at=expires_at
+        )
+        
+        return MarketService._order_result(quantity, remaining_qty, trades_executed, rested=rest)
+    
+    @staticmethod
+    def _place_sell(user, meal, price, quantity, is_short, time_in_force='GTC', expires_at=None):
+        """Stage a sell order inside the current market write"""
+        price, rest, expires_at, rejected = MarketService._prepare(
+            meal, 'ASK', price, quantity, time_in_force, expires_at
+        )
+        if rejected:
+            return False, rejected, []
+        
+        if is_short:
+            # A short holds no shares, so it has to be covered by the user's equity instead
+            if not risk.short_allowed(user.id, meal.id, price, quantity):
+                return False, "Insufficient margin", []
+        elif not reservations.reserve_shares(user.id, meal.id, quantity):
+            # Shares held by other resting asks are not available
+            return False, "Insufficient shares", []
+        
+        # Match against existing bids
+        remaining_qty, trades_executed = MarketService._match(
+            user, meal, 'ASK', price, quantity, rest=rest, short=is_short, expires_at=expires_at
+        )
+        
+        return MarketService._order_result(quantity, remaining_qty, trades_executed, rested=rest)
+    
+    @staticmethod
+    def liquidate_margin_breaches():
+        """Buy back the shorts of every user below the maintenance margin, one market write each
+        
+        Returns {username: {meal name: shares bought back}} for every user liquidated.
+        """
+        valuations.ensure_current()
+        liquidated = {}
+        for username in valuations.margin_breaches():
+            user = reference_data.user(username)
+            if user is None:
+                continue
+            covered = MarketService._run_write(lambda: MarketService._liquidate(user), None)
+            if covered is not None:
+                liquidated[username] = covered
+        return liquidated
+    
+    @staticmethod
+    def _liquidate(user):
+        """Stage the liquidation of one user inside the current market write
+        
+        The margin is checked again against the user's own rows. If it is
+        still breached, every resting order they have is cancelled and each
+        short, largest exposure first, is bought back as far as the asks on
+        the book and their cash allow, at no more than MARKET_ORDER_BAND over
+        the meal's last trade. Returns {meal name: shares bought back}, or
+        None if the user is no longer below the maintenance margin.
+        """
+        equity, exposure, _, shorts = risk.account(user.id)
+        if not exposure or equity >= SHORT_MAINTENANCE_MARGIN * exposure:
+            return None
+        MarketService._cancel_all(user, None, None)
+        
+        covered = {}
+        prices = risk.marks(set(shorts))
+        last_trade = last_trades(set(shorts))
+        for meal_id, shares in sorted(shorts.items(), key=lambda item: item[1] * prices[item[0]][1]):
+            meal = reference_data.meal_by_id(meal_id)
+            quantity, limit = MarketService._coverable(
+                user, meal, -shares, buy_back_limit(last_trade.get(meal_id))
             )
-            trades_executed.append(trade)
-            
-            # Update order
-            best_ask.remaining_quantity -= trade_qty
-            if best_ask.remaining_quantity <= 0:
-                best_ask.status = 'FILLED'
-            
-            remaining_qty -= trade_qty
-            db.session.commit()
+            if quantity:
+                _, _, trades = MarketService._place_buy(user, meal, limit, quantity, 'IOC')
+                covered[meal.name] = sum(trade['quantity'] for trade in trades)
+        market_events.stage('liquidation', {'covered': covered}, username=user.username)
+        return covered
+    
+    @staticmethod
+    def _coverable(user, meal, needed, cap=None):
+        """How many of `needed` shares the resting asks at or below cap and the user's available cash cover, and at what limit"""
+        available = db.session.scalar(select(User.balance - User.held_balance).where(User.id == user.id))
+        book = order_books.get(meal.id)
+        quantity, limit = 0, None
+        with book.lock:
+            for level in book.depth('ASK'):
+                if cap is not None and level.price > cap:
+                    break
+                # The whole buy is held at its limit, the worst price it reaches
+                affordable = needed if level.price <= 0 else min(needed, int(available // level.price))
+                take = min(level.quantity, affordable - quantity)
+                if take <= 0:
+                    break
+                quantity += take
+                limit = level.price
+                if quantity >= needed:
+                    break
+        return quantity, limit
+    
+    @staticmethod
+    def place_orders(username, orders, atomic=True):
+        """Place a batch of buys, sells, shorts and cancels in a single transaction
         
-        # If there's remaining quantity and not a snap-buy, place bid
-        if remaining_qty > 0 and not snap_buy:
-            order = Order(
-                meal_id=meal.id,
-                order_type='BID',
-                price=price,
-                quantity=remaining_qty,
-                remaining_quantity=remaining_qty,
-                buyer_id=user.id,
-                status='ACTIVE'
+        Each order is a dict with a 'type' of buy, sell, short or cancel plus
+        the fields that order needs (meal, price, qty, optional time_in_force,
+        expires_at in unix seconds or snap_buy / order_id).
+        The user and every referenced meal are resolved once for the whole
+        batch, and every order is checked with the same rules as a single
+        order before anything runs. In atomic mode a malformed order raises
+        InvalidBatch and the first rejected order rolls the entire batch
+        back; otherwise malformed and rejected orders are skipped and the
+        rest commit.
+        
+        Returns (success, message, results) with one result dict per order.
+        """
+        user = MarketService.get_user_ref(username)
+        meal_names = {
+            order.get('meal') for order in orders
+            if isinstance(order, dict) and isinstance(order.get('meal'), str)
+        }
+        meals = {name: MarketService.get_meal(name) for name in meal_names}
+        
+        errors = [MarketService._batch_order_error(order, meals) for order in orders]
+        if atomic and any(errors):
+            index = next(index for index, error in enumerate(errors) if error)
+            raise InvalidBatch(
+                f"Order {index + 1} is invalid: {errors[index]}. Nothing was placed",
+                [MarketService._batch_result(order, False, error or "Not placed") for order, error in zip(orders, errors)]
             )
-            db.session.add(order)
-            db.session.commit()
-            
+        
+        def work():
+            results = []
+            for index, order in enumerate(orders):
+                if errors[index]:
+                    results.append(MarketService._batch_result(order, False, errors[index]))
+                    continue
+                result = MarketService._place_batch_order(user, meals, order)
+                results.append(result)
+                if atomic and not result['success']:
+                    raise BatchRejected(index, result['message'])
+            return results
+        
+        try:
+            results = MarketService._run_write(work, None)
+        except BatchRejected as rejected:
+            index, message = rejected.args
+            return False, f"Order {index + 1} rejected: {message}. Batch rolled back", []
+        
+        if results is None:
+            return False, "Market busy, please retry", []
+        
+        accepted = sum(1 for result in results if result['success'])
+        return accepted > 0, f"{accepted} of {len(orders)} orders accepted", results
+    
+    @staticmethod
+    def _batch_time_in_force(order):
+        return 'IOC' if order.get('snap_buy') else str(order.get('time_in_force', 'GTC')).upper()
+    
+    @staticmethod
+    def _batch_order_error(order, meals):
+        """Why a batch entry is malformed, checked before the batch runs, or None"""
+        if not isinstance(order, dict):
+            return "Each order must be an object"
+        order_type = order.get('type')
+        if order_type == 'cancel':
+            return None if valid_quantity(order.get('order_id')) else "order_id must be a whole number"
+        if order_type not in ('buy', 'sell', 'short'):
+            return "Unknown order type"
+        meal_name = order.get('meal')
+        if not isinstance(meal_name, str) or not meals.get(meal_name):
+            return "Invalid meal"
+        try:
+            expiry_from_unix(order.get('expires_at'))
+        except ValueError as error:
+            return str(error)
+        return order_error(order.get('price'), order.get('qty'), MarketService._batch_time_in_force(order))
+    
+    @staticmethod
+    def _batch_result(order, success, message, trades=()):
+        order = order if isinstance(order, dict) else {}
+        return {'type': order.get('type'), 'meal': order.get('meal'), 'success': success, 'message': message, 'trades': list(trades)}
+    
+    @staticmethod
+    def _place_batch_order(user, meals, order):
+        """Stage one validated order from a batch and describe the outcome"""
+        order_type = order.get('type')
+        
+        if order_type == 'cancel':
+            success, message = MarketService._cancel(user, order.get('order_id'))
+            return MarketService._batch_result(order, success, message)
+        
+        meal = meals[order.get('meal')]
+        price = order.get('price')
+        quantity = order.get('qty')
+        time_in_force = MarketService._batch_time_in_force(order)
+        expires_at = expiry_from_unix(order.get('expires_at'))
+        
+        if order_type == 'buy':
+            success, message, trades = MarketService._place_buy(
+                user, meal, price, quantity, time_in_force, expires_at
+            )
+        else:
+            success, message, trades = MarketService._place_sell(
+                user, meal, price, quantity, order_type == 'short', time_in_force, expires_at
+            )
+        
+        return MarketService._batch_result(order, success, message, trades)
+    
+    @staticmethod
+    def _order_result(quantity, remaining_qty, trades_executed, rested=True):
+        """Build the (success, message, trades) result for a placed order"""
+        if remaining_qty > 0 and rested:
             return True, f"Executed {quantity - remaining_qty} shares, {remaining_qty} shares added to order book", trades_executed
         
         if trades_executed:
@@ -276,77 +838,394 @@ class MarketService:
         return False, "No matching orders", []
     
     @staticmethod
-    def place_sell_order(username, meal_name, price, quantity, is_short=False):
-        """Place a sell order (ask) on the secondary market"""
-        meal = MarketService.get_meal(meal_name)
-        if not meal:
-            return False, "Invalid meal", []
+    def _submit(work, exhausted_result):
+        """Run one order as a market write, on the matching thread if the engine is running"""
+        if engine.running:
+            return engine.submit(work, exhausted_result)
+        return MarketService._run_write(work, exhausted_result)
+    
+    @staticmethod
+    def _run_write(work, exhausted_result):
+        """Run work() as one market write and commit it once
         
-        user = MarketService.get_user(username)
+        If an in-memory book turns out to be stale (another process touched
+        a resting order first), the transaction is rolled back and retried
+        against books rebuilt from the database. Any other failure rolls
+        back and re-raises. Returns exhausted_result if every retry is stale.
+        """
+        for attempt in range(MATCH_RETRIES):
+            try:
+                sequence = MarketService._begin_write()
+                result = work()
+                MarketService._commit_write(sequence)
+                return result
+            except StaleBookError:
+                MarketService._abort_write()
+            except Exception:
+                MarketService._abort_write()
+                raise
         
-        # Check if user has shares (unless shorting)
-        if not is_short:
-            position = Position.query.filter_by(user_id=user.id, meal_id=meal.id).first()
-            if not position or position.shares < quantity:
-                return False, "Insufficient shares", []
+        return exhausted_result
+    
+    @staticmethod
+    def _abort_write():
+        """Roll back a market write; books it may have touched are rebuilt by the next write"""
+        db.session.rollback()
+        order_books.invalidate()
+    
+    @staticmethod
+    def _match(user, meal, side, price, quantity, rest=True, short=False, expires_at=None):
+        """Sweep the book for an incoming order and stage every resulting write
         
-        trades_executed = []
+        The order's cash or shares must already be reserved; fills release
+        them and whatever is left stays held by the resting remainder.
+        """
+        book = order_books.get(meal.id)
+        with book.lock:
+            return MarketService._sweep(user, meal, book, side, price, quantity, rest, short, expires_at)
+    
+    @staticmethod
+    def _sweep(user, meal, book, side, price, quantity, rest, short, expires_at=None):
+        opposite = 'ASK' if side == 'BID' else 'BID'
+        fills = []
         remaining_qty = quantity
         
-        # Try to match with existing bids
         while remaining_qty > 0:
-            best_bid = MarketService.get_best_bid(meal.id)
-            if not best_bid or best_bid.price < price:
+            resting = book.best(opposite)
+            if not resting:
+                break
+            if side == 'BID' and resting.price > price:
+                break
+            if side == 'ASK' and resting.price < price:
                 break
             
-            # Execute trade
-            trade_qty = min(remaining_qty, best_bid.remaining_quantity)
-            buyer = User.query.get(best_bid.buyer_id)
-            trade = MarketService.execute_trade(
-                buyer.username, username, meal.id, best_bid.price, trade_qty
-            )
-            trades_executed.append(trade)
-            
-            # Update order
-            best_bid.remaining_quantity -= trade_qty
-            if best_bid.remaining_quantity <= 0:
-                best_bid.status = 'FILLED'
-            
+            trade_qty = min(remaining_qty, resting.remaining)
+            fills.append((resting, trade_qty, resting.remaining))
+            book.fill(resting, trade_qty)
             remaining_qty -= trade_qty
-            db.session.commit()
         
-        # If there's remaining quantity, place ask
-        if remaining_qty > 0:
+        instrumentation.observe_match(len({resting.price for resting, _, _ in fills}), len(fills))
+        trades = []
+        if fills:
+            MarketService._update_resting_orders(fills)
+            # A bid's cash is held at its own limit price and a short ask holds no shares
+            settled = []
+            for resting, trade_qty, _ in fills:
+                if side == 'BID':
+                    settled.append((user.id, resting.user, resting.price, trade_qty,
+                                    price * trade_qty, 0 if resting.short else trade_qty))
+                else:
+                    settled.append((resting.user, user.id, resting.price, trade_qty,
+                                    resting.price * trade_qty, 0 if short else trade_qty))
+            trades = MarketService._settle_fills(meal, settled)
+        
+        # If there's remaining quantity, rest it on the book
+        if remaining_qty > 0 and rest:
             order = Order(
                 meal_id=meal.id,
-                order_type='ASK',
+                order_type=side,
                 price=price,
                 quantity=remaining_qty,
                 remaining_quantity=remaining_qty,
-                seller_id=user.id,
-                status='ACTIVE'
+                buyer_id=user.id if side == 'BID' else None,
+                seller_id=user.id if side == 'ASK' else None,
+                short=short,
+                status='ACTIVE',
+                expires_at=expires_at
             )
             db.session.add(order)
-            db.session.commit()
-            
-            return True, f"Executed {quantity - remaining_qty} shares, {remaining_qty} shares added to order book", trades_executed
+            db.session.flush()
+            journal.stage('order', journal.order_event(order))
+            book.add(BookOrder(order.id, side, price, remaining_qty, user.id, short, expires_at))
+        elif remaining_qty > 0:
+            # Nothing rests, so the unfilled part holds nothing
+            if side == 'BID':
+                reservations.release(cash={user.id: price * remaining_qty})
+            elif not short:
+                reservations.release(shares={(user.id, meal.id): remaining_qty})
         
-        if trades_executed:
-            return True, f"Executed {quantity - remaining_qty} shares", trades_executed
+        MarketService._stage_book_event(meal)
+        return remaining_qty, trades
+    
+    @staticmethod
+    def _update_resting_orders(fills):
+        """Write every resting-order fill with one executemany UPDATE
         
-        return False, "No matching orders", []
+        Each row only updates while it still holds the quantity the book
+        expected, so a mismatch in the affected row count means the book was
+        stale and the whole match has to be retried.
+        """
+        table = Order.__table__
+        stmt = table.update().where(
+            table.c.id == bindparam('b_id'),
+            table.c.status == 'ACTIVE',
+            table.c.remaining_quantity == bindparam('b_expected')
+        ).values(
+            remaining_quantity=bindparam('b_remaining'),
+            status=bindparam('b_status'),
+            updated_at=datetime.utcnow()
+        )
+        params = [
+            {
+                'b_id': resting.id,
+                'b_expected': expected,
+                'b_remaining': expected - trade_qty,
+                'b_status': 'FILLED' if expected - trade_qty <= 0 else 'ACTIVE'
+            }
+            for resting, trade_qty, expected in fills
+        ]
+        result = db.session.execute(stmt, params)
+        
+        if db.engine.dialect.supports_sane_multi_rowcount and result.rowcount != len(fills):
+            raise StaleBookError()
+        
+        for row in params:
+            journal.stage('order_update', {
+                'id': row['b_id'],
+                'remaining_quantity': row['b_remaining'],
+                'status': row['b_status']
+            })
+    
     
     @staticmethod
     def get_trade_history(limit=20):
         """Get recent trade history"""
-        trades = Trade.query.order_by(Trade.timestamp.desc()).limit(limit).all()
+        trades = MarketService.trade_query().limit(limit).all()
         return [trade.to_dict() for trade in trades]
     
+    @staticmethod
+    def trade_query(meal_id=None, user_id=None, side=None, start=None, end=None, cursor=None, ascending=False,
+                    include_archived=False):
+        """Trades matching the filters, in keyset order on (timestamp, id)
+        
+        side is BUY or SELL from user_id's point of view. cursor is the
+        (timestamp, id) of the last trade already returned; the next page
+        starts right after it with an index range seek instead of an OFFSET.
+        With include_archived the query runs over trades and trades_archive
+        together and yields plain rows; serialize either kind with trade_dict.
+        """
+        if include_archived:
+            # Archived trades keep their ids, so one ordering covers both tables
+            trades = union_all(
+                select(Trade.id, Trade.meal_id, Trade.buyer_id, Trade.seller_id, Trade.seller_name,
+                       Trade.quantity, Trade.price, Trade.timestamp),
+                select(ArchivedTrade.id, ArchivedTrade.meal_id, ArchivedTrade.buyer_id, ArchivedTrade.seller_id,
+                       ArchivedTrade.seller_name, ArchivedTrade.quantity, ArchivedTrade.price, ArchivedTrade.timestamp)
+            ).subquery()
+            columns = trades.c
+            query = db.session.query(trades)
+        else:
+            columns = Trade
+            query = Trade.query.options(*TRADE_LOADS)
+        if meal_id is not None:
+            query = query.filter(columns.meal_id == meal_id)
+        if user_id is not None:
+            if side == 'BUY':
+                query = query.filter(columns.buyer_id == user_id)
+            elif side == 'SELL':
+                query = query.filter(columns.seller_id == user_id)
+            else:
+                query = query.filter(or_(columns.buyer_id == user_id, columns.seller_id == user_id))
+        if start is not None:
+            query = query.filter(columns.timestamp >= start)
+        if end is not None:
+            query = query.filter(columns.timestamp < end)
+        
+        # Fills from one order share a timestamp, so break ties by insertion order
+        key = tuple_(columns.timestamp, columns.id)
+        if cursor is not None:
+            query = query.filter(key > tuple_(*cursor) if ascending else key < tuple_(*cursor))
+        if ascending:
+            return query.order_by(columns.timestamp.asc(), columns.id.asc())
+        return query.order_by(columns.timestamp.desc(), columns.id.desc())
+    
+    @staticmethod
+    def trade_dict(trade):
+        """A Trade, or a row from trade_query(include_archived=True), as a dict"""
+        if isinstance(trade, Trade):
+            return trade.to_dict()
+        return {
+            'id': trade.id,
+            'meal_id': trade.meal_id,
+            'meal_name': reference_data.meal_name(trade.meal_id),
+            'buyer': reference_data.username(trade.buyer_id) if trade.buyer_id is not None else None,
+            'seller': trade.seller_name,
+            'quantity': trade.quantity,
+            'price': trade.price,
+            'timestamp': trade.timestamp.isoformat()
+        }
+    
+    @staticmethod
+    def _filtered_trades(meal_name, username, side, start, end, cursor, ascending, include_archived):
+        """trade_query for names instead of ids; None if the meal or user does not exist"""
+        meal_id = user_id = None
+        if meal_name is not None:
+            meal = MarketService.get_meal(meal_name)
+            if not meal:
+                return None
+            meal_id = meal.id
+        if username is not None:
+            user = reference_data.user(username)
+            if user is None:
+                return None
+            user_id = user.id
+        return MarketService.trade_query(meal_id, user_id, side, start, end, cursor, ascending, include_archived)
+    
+    @staticmethod
+    def get_trade_page(meal_name=None, username=None, side=None, start=None, end=None,
+                       cursor=None, limit=TRADE_PAGE_DEFAULT, ascending=False, include_archived=False):
+        """One page of filtered trade history and the cursor for the next (None on the last page)"""
+        query = MarketService._filtered_trades(
+            meal_name, username, side, start, end, cursor, ascending, include_archived
+        )
+        if query is None:
+            return [], None
+        trades = query.limit(limit).all()
+        next_cursor = None
+        if len(trades) == limit:
+            next_cursor = encode_trade_cursor(trades[-1].timestamp, trades[-1].id)
+        return [MarketService.trade_dict(trade) for trade in trades], next_cursor
+    
+    @staticmethod
+    def iter_trades(meal_name=None, username=None, side=None, start=None, end=None,
+                    cursor=None, limit=None, ascending=False, include_archived=False):
+        """Yield every matching trade as a dict, fetched in keyset batches
+        
+        Only one batch is held in memory at a time, so a full audit export
+        never materializes the whole history.
+        """
+        remaining = limit
+        while remaining is None or remaining > 0:
+            batch_size = TRADE_STREAM_BATCH if remaining is None else min(TRADE_STREAM_BATCH, remaining)
+            query = MarketService._filtered_trades(
+                meal_name, username, side, start, end, cursor, ascending, include_archived
+            )
+            if query is None:
+                return
+            trades = query.limit(batch_size).all()
+            for trade in trades:
+                yield MarketService.trade_dict(trade)
+            if len(trades) < batch_size:
+                return
+            cursor = (trades[-1].timestamp, trades[-1].id)
+            if remaining is not None:
+                remaining -= len(trades)
+            db.session.expunge_all()
+    
+    @staticmethod
+    def get_market_summary_json():
+        """Market summary as JSON bytes, served from the snapshot cache"""
+        return MarketService.cached_market_summary()[1]
+    
+    @staticmethod
+    def cached_market_summary(version=None):
+        """IPO state and market summary JSON bytes from the snapshot cache
+        
+        The cached snapshot carries the IPO start time; the IPO price only
+        depends on the clock, so it is computed fresh on every call.
+        """
+        if version is None:
+            version = current_sequence()
+        ipo_start_time, ipo_active, meals = snapshot_cache.get(
+            ('market_summary',), version, MarketService._market_summary_snapshot
+        )
+        ipo_price = MarketService.ipo_price_at(ipo_start_time, ipo_active)
+        body = b'{"ipo_price":%s,"ipo_active":%s,"meals":%s}' % (
+            to_json(ipo_price), to_json(ipo_active), meals
+        )
+        return (ipo_start_time, ipo_active), body
+    
+    @staticmethod
+    def _market_summary_snapshot():
+        state = MarketService.get_or_create_market_state()
+        # Rebuilt whenever the sequence moves, so this also refreshes the cached IPO clock
+        reference_data.set_ipo_state(state.ipo_start_time, state.ipo_active)
+        return state.ipo_start_time, state.ipo_active, to_json(MarketService._meal_summaries())
+    
+    @staticmethod
+    def get_stream_snapshot(username):
+        """Initial state for a live market stream
+        
+        Returns the IPO state, so the stream can tick the IPO price itself,
+        and the snapshot as JSON bytes.
+        """
+        ipo_state, market = MarketService.cached_market_summary()
+        trades = MarketService.get_trade_history_json()
+        user = MarketService.get_user(username)
+        user_data = {
+            'username': username,
+            'balance': user.balance,
+            'available_balance': user.balance - user.held_balance,
+            'net_worth': MarketService.get_net_worth(username)['net_worth'],
+            'ipo_price': MarketService.ipo_price_at(*ipo_state)
+        }
+        body = b'{"market":%s,"trades":%s,"user":%s}' % (market, trades, to_json(user_data))
+        return ipo_state, body
+    
+    @staticmethod
+    def get_order_book_json(meal_name, version=None):
+        """Order book for a meal as JSON bytes, served from the snapshot cache"""
+        if meal_name not in ALL_MEALS:
+            return to_json(None)
+        if version is None:
+            version = current_sequence()
+        return snapshot_cache.get(
+            ('order_book', meal_name), version,
+            lambda: to_json(MarketService.get_order_book(meal_name))
+        )
+    
+    @staticmethod
+    def get_trade_history_json(limit=20, version=None):
+        """Recent trade history as JSON bytes, served from the snapshot cache"""
+        if version is None:
+            version = current_sequence()
+        return snapshot_cache.get(
+            ('trade_history', limit), version,
+            lambda: to_json(MarketService.get_trade_history(limit))
+        )
+    
+    @staticmethod
+    def get_candles(meal_name, interval, start=None, end=None, limit=CANDLE_DEFAULT_LIMIT):
+        """OHLCV bars for a meal at one of the CANDLE_INTERVALS widths, oldest first
+        
+        Returns None for an unknown meal or interval.
+        """
+        meal = MarketService.get_meal(meal_name)
+        if not meal or interval not in CANDLE_INTERVALS:
+            return None
+        return candles.get_candles(
+            meal.id, CANDLE_INTERVALS[interval], start, end, max(1, min(limit, CANDLE_MAX_LIMIT))
+        )
+    
+    @staticmethod
+    def get_user_orders(username, meal_name=None):
+        """Get the user's active orders, optionally for one meal"""
+        user = MarketService.get_user_ref(username)
+        query = Order.query.options(*ORDER_LOADS).filter(
+            or_(Order.buyer_id == user.id, Order.seller_id == user.id),
+            Order.status == 'ACTIVE'
+        )
+        if meal_name:
+            meal = MarketService.get_meal(meal_name)
+            if not meal:
+                return []
+            query = query.filter(Order.meal_id == meal.id)
+        return [order.to_dict() for order in query.order_by(Order.id.asc())]
+    
     @staticmethod
     def cancel_order(order_id, username):
         """Cancel an active order"""
-        user = MarketService.get_user(username)
-        order = Order.query.get(order_id)
+        user = MarketService.get_user_ref(username)
+        
+        return MarketService._run_write(
+            lambda: MarketService._cancel(user, order_id),
+            (False, "Market busy, please retry")
+        )
+    
+    @staticmethod
+    def _cancel(user, order_id):
+        """Stage the cancellation of one of the user's orders inside the current market write"""
+        order = db.session.get(Order, order_id)
         
         if not order:
             return False, "Order not found"
@@ -359,6 +1238,115 @@ class MarketService:
             return False, "Order not active"
         
         order.status = 'CANCELLED'
-        db.session.commit()
+        reservations.release_orders([order])
+        journal.stage('cancel', {'ids': [order.id]})
+        book = order_books.get(order.meal_id)
+        with book.lock:
+            book.remove(order.id)
+        MarketService._stage_book_event(reference_data.meal_by_id(order.meal_id))
+        
+        return True, "Order cancelled"
+    
+    @staticmethod
+    def cancel_all_orders(username, meal_name=None, side=None):
+        """Cancel all of a user's active orders, optionally filtered by meal and side"""
+        user = MarketService.get_user_ref(username)
+        meal = None
+        if meal_name:
+            meal = MarketService.get_meal(meal_name)
+            if not meal:
+                return False, "Invalid meal", 0
+        if side not in (None, 'BID', 'ASK'):
+            return False, "Invalid side", 0
+        
+        cancelled = MarketService._run_write(
+            lambda: MarketService._cancel_all(user, meal, side),
+            None
+        )
+        if cancelled is None:
+            return False, "Market busy, please retry", 0
+        
+        return True, f"Cancelled {cancelled} orders", cancelled
+    
+    @staticmethod
+    def _cancel_all(user, meal, side):
+        """Stage a bulk cancel as a single UPDATE inside the current market write"""
+        if side == 'BID':
+            owner = and_(Order.order_type == 'BID', Order.buyer_id == user.id)
+        elif side == 'ASK':
+            owner = and_(Order.order_type == 'ASK', Order.seller_id == user.id)
+        else:
+            owner = or_(Order.buyer_id == user.id, Order.seller_id == user.id)
+        
+        conditions = [owner]
+        if meal:
+            conditions.append(Order.meal_id == meal.id)
+        return MarketService._close_orders(conditions, 'CANCELLED')
+    
+    @staticmethod
+    def expire_orders(now=None):
+        """Expire every resting order past its expiry time as one market write; returns how many"""
+        now = now or datetime.utcnow()
+        due = select(Order.id).where(Order.status == 'ACTIVE', Order.expires_at <= now).limit(1)
+        if db.session.scalar(due) is None:
+            # Nothing to expire, so leave the market sequence (and every cache) alone
+            return 0
+        return MarketService._run_write(
+            lambda: MarketService._close_orders([Order.expires_at <= now], 'EXPIRED'),
+            None
+        )
+    
+    @staticmethod
+    def run_maintenance(now=None):
+        """Expire lapsed orders, then archive old closed orders and trades
+        
+        Returns (orders expired, orders archived, trades archived).
+        """
+        now = now or datetime.utcnow()
+        expired = MarketService.expire_orders(now) or 0
+        orders = maintenance.archive_orders(MarketService._run_write, now - timedelta(seconds=ORDER_ARCHIVE_AGE))
+        trades = maintenance.archive_trades(MarketService._run_write, now - timedelta(seconds=TRADE_ARCHIVE_AGE))
+        return expired, orders, trades
+    
+    @staticmethod
+    def _close_orders(conditions, status):
+        """Stage closing every active order matching conditions with one UPDATE
+        
+        Used for bulk cancels and expiry: what the orders held is released
+        and they are dropped from the resident books. Returns how many closed.
+        """
+        conditions = [*conditions, Order.status == 'ACTIVE']
+        stmt = update(Order).where(*conditions).values(
+            status=status,
+            updated_at=datetime.utcnow()
+        ).execution_options(synchronize_session=False)
+        
+        columns = (
+            Order.id, Order.meal_id, Order.order_type, Order.price, Order.remaining_quantity,
+            Order.buyer_id, Order.seller_id, Order.short
+        )
+        if db.engine.dialect.update_returning:
+            closed = db.session.execute(stmt.returning(*columns)).all()
+        else:
+            closed = db.session.execute(select(*columns).where(*conditions)).all()
+            db.session.execute(stmt)
+        
+        if closed:
+            reservations.release_orders(closed)
+            event = {'ids': [order.id for order in closed]}
+            if status != 'CANCELLED':
+                event['status'] = status
+            journal.stage('cancel', event)
+        
+        # Drop the closed orders from the resident books
+        meal_ids = set()
+        for order_id, meal_id, *_ in closed:
+            book = order_books.get(meal_id)
+            with book.lock:
+                book.remove(order_id)
+            meal_ids.add(meal_id)
+        
+        for meal_id in meal_ids:
+            MarketService._stage_book_event(reference_data.meal_by_id(meal_id))
         
-        return True, "Order cancelled"
\ No newline at end of file
+        return len(closed)
@@ -0,0 +1,118 @@
+"""
+Optional group-commit matching thread
+
+With MATCHING_ENGINE=1 each app process starts one matching thread. Order
+placement is handed to it through a queue and the request thread waits
+for the result. The thread drains whatever has queued up and runs it as a
+single market write, so a burst of orders costs one sequence bump and one
+commit instead of one each.
+
+This is narrower than a sharded engine. There are no per-meal queues or
+threads, and holds are not claimed before dispatch. Every market write,
+whatever its meal, takes the same market sequence lock, and each order
+reserves its cash or shares through the ledger (reservations.py) inside
+that write. More matching threads would only queue up behind each other
+on the lock, and there is no cross-shard reservation to coordinate.
+Group commit is the part that pays off under that lock.
+"""
+import queue
+import threading
+from concurrent.futures import Future
+from database import db
+from config import MATCHING_BATCH_SIZE
+
+
+class MatchRequest:
+    """One order waiting for the matching thread"""
+    __slots__ = ('work', 'exhausted_result', 'future')
+
+    def __init__(self, work, exhausted_result):
+        self.work = work
+        self.exhausted_result = exhausted_result
+        self.future = Future()
+
+
+def run_batch(run_write, batch):
+    """Run a batch of requests as one market write and resolve their futures"""
+    try:
+        results = run_write(lambda: [request.work() for request in batch], None)
+    except Exception as exc:
+        db.session.remove()
+        if len(batch) == 1:
+            batch[0].future.set_exception(exc)
+            return
+        # One failing request must not take its neighbours down with it
+        for request in batch:
+            run_batch(run_write, [request])
+        return
+    db.session.remove()
+
+    if results is None:
+        for request in batch:
+            request.future.set_result(request.exhausted_result)
+    else:
+        for request, result in zip(batch, results):
+            request.future.set_result(result)
+
+
+class MatchingEngine:
+    """Queues orders for the matching thread and commits them in batches"""
+
+    def __init__(self):
+        self.app = None
+        self.run_write = None
+        self.requests = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, app, run_write):
+        """Start the matching thread; run_write runs a list of orders as one market write"""
+        with self._lock:
+            if self._thread:
+                return
+            self.app = app
+            self.run_write = run_write
+            self._thread = threading.Thread(target=self._run, name='matching-engine', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the matching thread once its queued orders are done"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread:
+            self.requests.put(None)
+            thread.join()
+
+    def submit(self, work, exhausted_result):
+        """Run work() on the matching thread and wait for its result"""
+        request = MatchRequest(work, exhausted_result)
+        self.requests.put(request)
+        return request.future.result()
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            batch = [request]
+            stopping = False
+            while len(batch) < MATCHING_BATCH_SIZE:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+            with self.app.app_context():
+                run_batch(self.run_write, batch)
+            if stopping:
+                return
+
+
+engine = MatchingEngine()
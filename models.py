@@ -1,4 +1,7 @@
+import itertools
 import time
+from datetime import datetime
+from book import OrderBook, BookOrder, prepare_order, order_expiry, valid_quantity
 from config import (
     FRIENDS, ALL_MEALS, INITIAL_BALANCE, INITIAL_HOUSE_SUPPLY,
     IPO_START_PRICE, IPO_DECAY_RATE, IPO_DECAY_INTERVAL, MEAL_CATEGORIES
@@ -11,8 +14,27 @@ class Market:
         self.house_supply = {meal: INITIAL_HOUSE_SUPPLY for meal in ALL_MEALS}
         self.trade_history = []
         self.ipo_start_time = None
-        self.asks = {meal: [] for meal in ALL_MEALS}
-        self.bids = {meal: [] for meal in ALL_MEALS}
+        self.books = {meal: OrderBook() for meal in ALL_MEALS}
+        self._order_ids = itertools.count(1)
+    
+    @property
+    def asks(self):
+        """Resting asks per meal as listing dicts, best price first"""
+        return {meal: self._listings(book, 'ASK') for meal, book in self.books.items()}
+    
+    @property
+    def bids(self):
+        """Resting bids per meal as listing dicts, best price first"""
+        return {meal: self._listings(book, 'BID') for meal, book in self.books.items()}
+    
+    @staticmethod
+    def _listing(order):
+        """Listing dict for a resting order, as the CLI expects it"""
+        owner = 'seller' if order.side == 'ASK' else 'user'
+        return {owner: order.user, 'qty': order.remaining, 'price': order.price}
+    
+    def _listings(self, book, side):
+        return [self._listing(order) for level in book.depth(side) for order in level.orders]
     
     def get_current_ipo_price(self):
         """Calculate current IPO price based on time elapsed"""
@@ -45,15 +67,13 @@ class Market:
     
     def get_best_ask(self, meal):
         """Get lowest ask price for a meal"""
-        if not self.asks[meal]:
-            return None
-        return min(self.asks[meal], key=lambda x: x['price'])
+        best_ask = self.books[meal].best_ask()
+        return self._listing(best_ask) if best_ask else None
     
     def get_best_bid(self, meal):
         """Get highest bid price for a meal"""
-        if not self.bids[meal]:
-            return None
-        return max(self.bids[meal], key=lambda x: x['price'])
+        best_bid = self.books[meal].best_bid()
+        return self._listing(best_bid) if best_bid else None
     
     def get_market_summary(self):
         """Get market overview with all meals"""
@@ -89,14 +109,15 @@ class Market:
     
     def get_order_book(self, meal):
         """Get full order book for a specific meal"""
+        book = self.books[meal]
         return {
             'meal': meal,
-            'asks': sorted(self.asks[meal], key=lambda x: x['price']),
-            'bids': sorted(self.bids[meal], key=lambda x: x['price'], reverse=True)
+            'asks': self._listings(book, 'ASK'),
+            'bids': self._listings(book, 'BID')
         }
     
     def execute_trade(self, buyer, seller, meal, price, qty, listing=None):
-        """Execute a trade between buyer and seller"""
+        """Execute a trade between buyer and seller; listing is the resting order it fills, if any"""
         cost = price * qty
         
         # Update balances
@@ -122,12 +143,7 @@ class Market:
         
         # Cleanup order book
         if listing:
-            listing['qty'] -= qty
-            if listing['qty'] <= 0:
-                if 'seller' in listing:
-                    self.asks[meal].remove(listing)
-                else:
-                    self.bids[meal].remove(listing)
+            self.books[meal].fill(listing, qty)
         
         return trade
     
@@ -139,6 +155,9 @@ class Market:
         if meal not in ALL_MEALS:
             return False, "Invalid meal"
         
+        if not valid_quantity(qty):
+            return False, "Quantity must be a positive whole number"
+        
         ipo_price = self.get_current_ipo_price()
         cost = ipo_price * qty
         
@@ -153,44 +172,60 @@ class Market:
         
         return True, f"Bought {qty} shares of {meal} at ${ipo_price:.2f}"
     
-    def place_buy_order(self, user, meal, price, qty, snap_buy=False):
-        """Place a buy order (bid) on the secondary market"""
+    def _prepare(self, meal, side, price, qty, time_in_force, expires_at):
+        """Drop the book's lapsed orders, then decide how an incoming order may trade"""
+        now = datetime.utcnow()
+        book = self.books[meal]
+        for order_id in book.due(now):
+            book.remove(order_id)
+        expires_at, rejected = order_expiry(time_in_force, expires_at, now)
+        if rejected:
+            return price, False, None, rejected
+        price, rest, rejected = prepare_order(book, side, price, qty, time_in_force)
+        return price, rest, expires_at, rejected
+    
+    def place_buy_order(self, user, meal, price, qty, snap_buy=False, time_in_force='GTC', expires_at=None):
+        """Place a buy order (bid) on the secondary market; a snap-buy is an IOC"""
         if meal not in ALL_MEALS:
             return False, "Invalid meal", []
         
+        book = self.books[meal]
+        price, rest, expires_at, rejected = self._prepare(
+            meal, 'BID', price, qty, 'IOC' if snap_buy else time_in_force, expires_at
+        )
+        if rejected:
+            return False, rejected, []
+        # A fill-or-kill must not stop part way for lack of cash
+        if time_in_force == 'FOK' and self.balances[user] < price * qty:
+            return False, "Insufficient funds", []
+        
         trades_executed = []
         remaining_qty = qty
         
         # Try to match with existing asks
         while remaining_qty > 0:
-            sorted_asks = sorted(self.asks[meal], key=lambda x: x['price'])
-            if not sorted_asks:
+            best_ask = book.best_ask()
+            if not best_ask:
                 break
             
-            best_ask = sorted_asks[0]
-            
             # Only match if ask price is at or below our bid price
-            if best_ask['price'] > price:
+            if best_ask.price > price:
                 break
             
             # Execute trade
-            trade_qty = min(remaining_qty, best_ask['qty'])
+            trade_qty = min(remaining_qty, best_ask.remaining)
             
-            if self.balances[user] < (best_ask['price'] * trade_qty):
+            if self.balances[user] < (best_ask.price * trade_qty):
                 break  # Insufficient funds
             
-            trade = self.execute_trade(user, best_ask['seller'], meal, 
-                                      best_ask['price'], trade_qty, best_ask)
+            trade = self.execute_trade(user, best_ask.user, meal, 
+                                      best_ask.price, trade_qty, best_ask)
             trades_executed.append(trade)
             remaining_qty -= trade_qty
         
-        # If there's remaining quantity and not a snap-buy, place bid
-        if remaining_qty > 0 and not snap_buy:
-            self.bids[meal].append({
-                'user': user,
-                'qty': remaining_qty,
-                'price': price
-            })
+        # If there's remaining quantity and the order rests, place bid
+        if remaining_qty > 0 and rest:
+            book.add(BookOrder(next(self._order_ids), 'BID', price, remaining_qty, user, expires_at=expires_at))
             return True, f"Executed {qty - remaining_qty} shares, {remaining_qty} shares added to order book", trades_executed
         
         if trades_executed:
@@ -198,11 +233,16 @@ class Market:
         
         return False, "No matching orders", []
     
-    def place_sell_order(self, user, meal, price, qty, is_short=False):
+    def place_sell_order(self, user, meal, price, qty, is_short=False, time_in_force='GTC', expires_at=None):
         """Place a sell order (ask) on the secondary market"""
         if meal not in ALL_MEALS:
             return False, "Invalid meal", []
         
+        book = self.books[meal]
+        price, rest, expires_at, rejected = self._prepare(meal, 'ASK', price, qty, time_in_force, expires_at)
+        if rejected:
+            return False, rejected, []
+        
         # Check if user has shares (unless shorting)
         if not is_short and self.portfolios[user][meal] < qty:
             return False, "Insufficient shares", []
@@ -212,30 +252,24 @@ class Market:
         
         # Try to match with existing bids
         while remaining_qty > 0:
-            sorted_bids = sorted(self.bids[meal], key=lambda x: x['price'], reverse=True)
-            if not sorted_bids:
+            best_bid = book.best_bid()
+            if not best_bid:
                 break
             
-            best_bid = sorted_bids[0]
-            
             # Only match if bid price is at or above our ask price
-            if best_bid['price'] < price:
+            if best_bid.price < price:
                 break
             
             # Execute trade
-            trade_qty = min(remaining_qty, best_bid['qty'])
-            trade = self.execute_trade(best_bid['user'], user, meal, 
-                                      best_bid['price'], trade_qty, best_bid)
+            trade_qty = min(remaining_qty, best_bid.remaining)
+            trade = self.execute_trade(best_bid.user, user, meal, 
+                                      best_bid.price, trade_qty, best_bid)
             trades_executed.append(trade)
             remaining_qty -= trade_qty
         
-        # If there's remaining quantity, place ask
-        if remaining_qty > 0:
-            self.asks[meal].append({
-                'seller': user,
-                'qty': remaining_qty,
-                'price': price
-            })
+        # If there's remaining quantity and the order rests, place ask
+        if remaining_qty > 0 and rest:
+            book.add(BookOrder(next(self._order_ids), 'ASK', price, remaining_qty, user, expires_at=expires_at))
             return True, f"Executed {qty - remaining_qty} shares, {remaining_qty} shares added to order book", trades_executed
         
         if trades_executed:
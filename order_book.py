@@ -0,0 +1,116 @@
+"""
+In-memory order books for the Dining Exchange
+
+One OrderBook (book.py) per meal, loaded from the orders table or the
+market journal and kept in step with this process's market writes.
+"""
+import threading
+from datetime import datetime
+from database import Order
+from market_cache import current_sequence
+from book import OrderBook, BookOrder
+import journal
+
+
+class OrderBookRegistry:
+    """Process-wide set of order books, one per meal, loaded from the Order table"""
+
+    def __init__(self):
+        self._books = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.sequence = None
+
+    def get(self, meal_id):
+        """Get the book for a meal, loading it from the database on first use"""
+        book = self._books.get(meal_id)
+        if book is None:
+            with self._lock:
+                book = self._books.get(meal_id)
+                if book is None:
+                    # After load_all a missing meal simply has no active orders
+                    book = OrderBook() if self._loaded else self._load(meal_id)
+                    self._books[meal_id] = book
+        return book
+
+    def load_all(self):
+        """Build every meal's book with a single pass over the active orders
+        
+        If the market journal is enabled and has caught up with the
+        database, the books are built from its latest snapshot and tail
+        instead of the orders table.
+        """
+        sequence = current_sequence()
+        image = journal.journal.load() if journal.enabled() else None
+        if image is not None and image.sequence == sequence:
+            orders = [(order['meal_id'], self._from_event(order)) for order in image.active_orders()]
+        else:
+            rows = Order.query.filter_by(status='ACTIVE').order_by(Order.id.asc()).all()
+            orders = [(order.meal_id, self._from_row(order)) for order in rows]
+        
+        books = {}
+        for meal_id, order in orders:
+            book = books.get(meal_id)
+            if book is None:
+                book = books[meal_id] = OrderBook()
+            book.add(order)
+        with self._lock:
+            self._books = books
+            self._loaded = True
+        self.sequence = sequence
+
+    def clear(self):
+        with self._lock:
+            self._books = {}
+            self._loaded = False
+    
+    def sync(self, previous):
+        """Drop every book if another process wrote since this one last did
+        
+        Called with the market sequence number just before this process's
+        own write. If it is not the last number this process saw, some other
+        worker changed the market in between and the books are rebuilt
+        lazily from the database. Returns whether the books were dropped.
+        """
+        if self.sequence is None or previous != self.sequence:
+            self.clear()
+            return True
+        return False
+    
+    def invalidate(self):
+        """Distrust every book; the next write rebuilds them from the database"""
+        self.sequence = None
+    
+    def seen(self, sequence):
+        """Record the market sequence number of a write this process committed"""
+        self.sequence = sequence
+    
+    def _load(self, meal_id):
+        book = OrderBook()
+        orders = Order.query.filter_by(
+            meal_id=meal_id,
+            status='ACTIVE'
+        ).order_by(Order.id.asc()).all()
+        for order in orders:
+            book.add(self._from_row(order))
+        return book
+
+    @staticmethod
+    def _from_row(order):
+        user_id = order.buyer_id if order.order_type == 'BID' else order.seller_id
+        return BookOrder(
+            order.id, order.order_type, order.price, order.remaining_quantity, user_id,
+            order.short, order.expires_at
+        )
+
+    @staticmethod
+    def _from_event(order):
+        user_id = order['buyer_id'] if order['order_type'] == 'BID' else order['seller_id']
+        return BookOrder(
+            order['id'], order['order_type'], order['price'], order['remaining_quantity'], user_id,
+            order.get('short', False),
+            datetime.fromisoformat(order['expires_at']) if order.get('expires_at') else None
+        )
+
+
+order_books = OrderBookRegistry()
@@ -0,0 +1,97 @@
+"""
+Background jobs that run a pass every few seconds
+
+The liquidation pass (risk.py) and the maintenance pass (maintenance.py)
+each run on a PeriodicJob: a daemon thread that calls the pass inside an
+app context every interval seconds, logs any failure and carries on.
+
+Every worker process starts the thread, but only one runs the pass: each
+tick first claims the job's row in job_leases with a conditional UPDATE,
+which only succeeds for the current holder or once its lease has run out
+(LEASE_INTERVALS ticks without a renewal). If the holder dies, another
+worker takes the job over.
+"""
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import insert, or_, update
+from sqlalchemy.exc import IntegrityError
+from database import db, JobLease
+
+# Ticks a job's holder may miss before another process takes the job over
+LEASE_INTERVALS = 3
+
+
+def claim(name, holder, seconds):
+    """Take or renew the lease on a job for `seconds`; returns whether holder has it"""
+    now = datetime.utcnow()
+    values = {'holder': holder, 'expires_at': now + timedelta(seconds=seconds)}
+    renewed = db.session.execute(
+        update(JobLease)
+        .where(JobLease.name == name, or_(JobLease.holder == holder, JobLease.expires_at < now))
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not renewed:
+        try:
+            db.session.execute(insert(JobLease).values(name=name, **values))
+        except IntegrityError:
+            # Someone else holds it
+            db.session.rollback()
+            return False
+    db.session.commit()
+    return True
+
+
+class PeriodicJob:
+    """Calls run_pass() every interval seconds on a background thread"""
+
+    def __init__(self, name):
+        self.name = name
+        self.app = None
+        self.run_pass = None
+        self.interval = 0
+        self.holder = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, app, run_pass, interval):
+        """Start calling run_pass() every interval seconds; 0 leaves the thread off"""
+        if self._thread or interval <= 0:
+            return
+        self.app = app
+        self.run_pass = run_pass
+        self.interval = interval
+        # Taken here rather than at import, so forked workers each get their own
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        thread, self._thread = self._thread, None
+        self._stopping.set()
+        if thread:
+            thread.join()
+
+    def report(self, result):
+        """Called with each successful pass's result, outside the app context"""
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    if not claim(self.name, self.holder, LEASE_INTERVALS * self.interval):
+                        continue
+                    result = self.run_pass()
+                except Exception:
+                    self.app.logger.exception("%s pass failed", self.name.capitalize())
+                    continue
+                finally:
+                    db.session.remove()
+            self.report(result)
@@ -0,0 +1,117 @@
+"""
+Resident reference data for the Dining Exchange
+
+Meals and users almost never change, so each process loads their name/id
+maps once and hot paths resolve names without a query. The IPO clock is
+cached too: it is set by start_ipo, refreshed whenever the market summary
+snapshot is rebuilt, and dropped when this process sees a market write made
+by another one (see MarketService._begin_write).
+"""
+import threading
+from database import User, Meal
+
+
+class MealRef:
+    """The fixed identity of a meal"""
+    __slots__ = ('id', 'name', 'category')
+
+    def __init__(self, meal_id, name, category):
+        self.id = meal_id
+        self.name = name
+        self.category = category
+
+
+class UserRef:
+    """The fixed identity of a user"""
+    __slots__ = ('id', 'username')
+
+    def __init__(self, user_id, username):
+        self.id = user_id
+        self.username = username
+
+
+class ReferenceData:
+    """Process-wide name/id maps for meals and users plus the cached IPO clock"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meals = None
+        self._meals_by_id = None
+        self._users = None
+        self._users_by_id = None
+        self._ipo_state = None
+
+    def meal(self, name):
+        """Get a meal by name, or None if there is no such meal"""
+        self._load()
+        return self._meals.get(name)
+
+    def meal_by_id(self, meal_id):
+        self._load()
+        return self._meals_by_id.get(meal_id)
+
+    def meal_id(self, name):
+        meal = self.meal(name)
+        return meal.id if meal else None
+
+    def meal_name(self, meal_id):
+        meal = self.meal_by_id(meal_id)
+        return meal.name if meal else None
+
+    def user(self, username):
+        """Get a user by name, checking the database once for users created elsewhere"""
+        self._load()
+        ref = self._users.get(username)
+        if ref is None:
+            user = User.query.filter_by(username=username).first()
+            if user is not None:
+                ref = self.add_user(user)
+        return ref
+
+    def username(self, user_id):
+        self._load()
+        ref = self._users_by_id.get(user_id)
+        return ref.username if ref else None
+
+    def add_user(self, user):
+        """Record a newly created user"""
+        self._load()
+        ref = UserRef(user.id, user.username)
+        with self._lock:
+            self._users[ref.username] = ref
+            self._users_by_id[ref.id] = ref
+        return ref
+
+    def ipo_state(self):
+        """Cached (ipo_start_time, ipo_active), or None if it has to be read again"""
+        return self._ipo_state
+
+    def set_ipo_state(self, ipo_start_time, ipo_active):
+        self._ipo_state = (ipo_start_time, ipo_active)
+
+    def invalidate_ipo(self):
+        self._ipo_state = None
+
+    def clear(self):
+        """Forget everything; it is reloaded on next use"""
+        with self._lock:
+            self._meals = None
+            self._meals_by_id = None
+            self._users = None
+            self._users_by_id = None
+            self._ipo_state = None
+
+    def _load(self):
+        if self._users is not None:
+            return
+        meals = [MealRef(meal.id, meal.name, meal.category) for meal in Meal.query.all()]
+        users = [UserRef(user.id, user.username) for user in User.query.all()]
+        with self._lock:
+            if self._users is None:
+                self._meals = {meal.name: meal for meal in meals}
+                self._meals_by_id = {meal.id: meal for meal in meals}
+                self._users_by_id = {user.id: user for user in users}
+                self._users = {user.username: user for user in users}
+
+
+reference_data = ReferenceData()
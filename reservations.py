@@ -0,0 +1,155 @@
+"""
+Reservation ledger: cash and shares held by resting orders
+
+A resting bid holds price x remaining quantity of its owner's cash and a
+resting ask (unless it is a short sale) holds its remaining shares.
+users.held_balance and positions.held_shares are the totals, so what a
+user can still commit is balance - held_balance and shares - held_shares.
+
+An incoming order reserves its full size up front with one conditional
+UPDATE that only matches while enough is available, so it is rejected
+before it touches the book rather than stopping part way through a sweep.
+Every fill releases what it used (cash at the bid's own limit price) in
+the same write that moves the cash and shares, and a cancel or expiry
+releases what the order still held. Matching itself never checks a
+balance, and every order resting on the book can be settled.
+
+The held totals are derived from the active orders alone; rebuild()
+recomputes them after a schema migration or a journal replay.
+"""
+from collections import defaultdict
+from sqlalchemy import func, insert, select, update
+from database import db, User, Position, Order
+
+
+def reserve_cash(user_id, amount):
+    """Hold amount of a user's cash; returns False, holding nothing, if less is available"""
+    return db.session.execute(
+        update(User)
+        .where(User.id == user_id, User.balance - User.held_balance >= amount)
+        .values(held_balance=User.held_balance + amount)
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+
+
+def reserve_shares(user_id, meal_id, quantity):
+    """Hold quantity of a user's shares in a meal; returns False, holding nothing, if fewer are available"""
+    return db.session.execute(
+        update(Position)
+        .where(
+            Position.user_id == user_id,
+            Position.meal_id == meal_id,
+            Position.shares - Position.held_shares >= quantity
+        )
+        .values(held_shares=Position.held_shares + quantity)
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+
+
+def release(cash=None, shares=None):
+    """Give back held cash ({user_id: amount}) and shares ({(user_id, meal_id): quantity})"""
+    for user_id, amount in (cash or {}).items():
+        if amount:
+            db.session.execute(
+                update(User)
+                .where(User.id == user_id)
+                .values(held_balance=User.held_balance - amount)
+                .execution_options(synchronize_session=False)
+            )
+    for (user_id, meal_id), quantity in (shares or {}).items():
+        if quantity:
+            db.session.execute(
+                update(Position)
+                .where(Position.user_id == user_id, Position.meal_id == meal_id)
+                .values(held_shares=Position.held_shares - quantity)
+                .execution_options(synchronize_session=False)
+            )
+
+
+def release_orders(orders):
+    """Give back everything a set of just-cancelled or expired orders still held
+
+    orders are Order rows, or result rows with the same column names.
+    """
+    cash = defaultdict(float)
+    shares = defaultdict(int)
+    for order in orders:
+        if order.order_type == 'BID':
+            cash[order.buyer_id] += order.price * order.remaining_quantity
+        elif not order.short:
+            shares[(order.seller_id, order.meal_id)] += order.remaining_quantity
+    release(cash, shares)
+
+
+def rebuild():
+    """Recompute every held total from the active orders
+
+    Stages the updates in the current transaction without committing.
+    """
+    db.session.execute(update(User).values(held_balance=0.0).execution_options(synchronize_session=False))
+    db.session.execute(update(Position).values(held_shares=0).execution_options(synchronize_session=False))
+
+    bids = db.session.execute(
+        select(Order.buyer_id, func.sum(Order.price * Order.remaining_quantity))
+        .where(Order.status == 'ACTIVE', Order.order_type == 'BID')
+        .group_by(Order.buyer_id)
+    ).all()
+    for user_id, amount in bids:
+        db.session.execute(
+            update(User).where(User.id == user_id).values(held_balance=amount)
+            .execution_options(synchronize_session=False)
+        )
+
+    asks = db.session.execute(
+        select(Order.seller_id, Order.meal_id, func.sum(Order.remaining_quantity))
+        .where(Order.status == 'ACTIVE', Order.order_type == 'ASK', Order.short.is_(False))
+        .group_by(Order.seller_id, Order.meal_id)
+    ).all()
+    for user_id, meal_id, quantity in asks:
+        updated = db.session.execute(
+            update(Position)
+            .where(Position.user_id == user_id, Position.meal_id == meal_id)
+            .values(held_shares=quantity)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not updated:
+            db.session.execute(insert(Position).values(
+                user_id=user_id, meal_id=meal_id, shares=0, held_shares=quantity
+            ))
+    return len(bids), len(asks)
+
+
+def mark_uncovered_asks_short():
+    """Flag as short sales the active asks their seller's shares cannot cover
+
+    Asks placed before the ledger existed did not record whether they were
+    short sales. A seller whose resting asks in a meal add up to more than
+    the shares they hold was selling short, so all of those asks are
+    treated as short and hold nothing. Returns how many sellers' asks changed.
+    """
+    shares = {
+        (user_id, meal_id): count
+        for user_id, meal_id, count in db.session.execute(
+            select(Position.user_id, Position.meal_id, Position.shares)
+        )
+    }
+    asks = db.session.execute(
+        select(Order.seller_id, Order.meal_id, func.sum(Order.remaining_quantity))
+        .where(Order.status == 'ACTIVE', Order.order_type == 'ASK')
+        .group_by(Order.seller_id, Order.meal_id)
+    ).all()
+    uncovered = [
+        (user_id, meal_id) for user_id, meal_id, quantity in asks
+        if shares.get((user_id, meal_id), 0) < quantity
+    ]
+    for user_id, meal_id in uncovered:
+        db.session.execute(
+            update(Order)
+            .where(
+                Order.seller_id == user_id, Order.meal_id == meal_id,
+                Order.status == 'ACTIVE', Order.order_type == 'ASK'
+            )
+            .values(short=True)
+            .execution_options(synchronize_session=False)
+        )
+    return len(uncovered)
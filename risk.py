@@ -0,0 +1,98 @@
+"""
+Margin requirements for short sales and the liquidation pass
+
+A user's equity is their net worth: cash plus every position marked at the
+meal's mark price (valuation.py). Their short exposure is every short
+position marked at its buy-back price, the best ask (at most
+MARKET_ORDER_BAND over the last trade) or else the last trade. Opening or
+adding to a short needs equity of at least SHORT_INITIAL_MARGIN times the
+exposure it would leave, counting resting short asks as if they had
+filled. The check runs inside the order's market write against the user's
+own rows and the live books, so orders earlier in the same batch are
+included.
+
+Between orders the exposure is tracked incrementally by valuations, which
+only revalues the holders of a meal whose price moved and keeps the set
+of users below SHORT_MAINTENANCE_MARGIN. The liquidation pass
+(MarketService.liquidate_margin_breaches) reads that set and buys those
+users' shorts back, never paying more than that same band over the last
+trade. With RISK_LIQUIDATION_INTERVAL set, the Liquidator runs it on a
+background thread (periodic.py), off the request path;
+`python manage_db.py liquidate` runs one pass by hand.
+"""
+from sqlalchemy import func, select
+from database import db, User, Position, Order
+from order_book import order_books
+from valuation import mark_price, short_mark_price, last_trades
+from periodic import PeriodicJob
+from config import SHORT_INITIAL_MARGIN
+
+
+def marks(meal_ids):
+    """(mark, buy-back price) for each meal, from the live books and the last trades"""
+    if not meal_ids:
+        return {}
+    last_trade = last_trades(meal_ids)
+    result = {}
+    for meal_id in meal_ids:
+        book = order_books.get(meal_id)
+        best_bid, best_ask = book.best_bid(), book.best_ask()
+        best_bid = best_bid.price if best_bid else None
+        best_ask = best_ask.price if best_ask else None
+        result[meal_id] = (
+            mark_price(best_bid, best_ask, last_trade.get(meal_id)),
+            short_mark_price(best_ask, last_trade.get(meal_id))
+        )
+    return result
+
+
+def account(user_id):
+    """A user's margin position as of the current transaction
+
+    Returns (equity, exposure, pending, shorts): short exposure of the
+    positions held, the exposure resting short asks would add if they
+    filled, and each short position's shares by meal id.
+    """
+    cash = db.session.scalar(select(User.balance).where(User.id == user_id))
+    positions = dict(db.session.execute(
+        select(Position.meal_id, Position.shares)
+        .where(Position.user_id == user_id, Position.shares != 0)
+    ).all())
+    resting = dict(db.session.execute(
+        select(Order.meal_id, func.sum(Order.remaining_quantity))
+        .where(
+            Order.seller_id == user_id, Order.status == 'ACTIVE',
+            Order.order_type == 'ASK', Order.short.is_(True)
+        )
+        .group_by(Order.meal_id)
+    ).all())
+    prices = marks(set(positions) | set(resting))
+
+    equity = cash + sum(shares * prices[meal_id][0] for meal_id, shares in positions.items())
+    shorts = {meal_id: shares for meal_id, shares in positions.items() if shares < 0}
+    exposure = sum(-shares * prices[meal_id][1] for meal_id, shares in shorts.items())
+    pending = sum(quantity * prices[meal_id][1] for meal_id, quantity in resting.items())
+    return equity, exposure, pending, shorts
+
+
+def short_allowed(user_id, meal_id, price, quantity):
+    """Whether the user's equity covers the initial margin on a new short sale
+
+    The new shares are counted at the higher of the order's price and the
+    meal's buy-back price, and the sale proceeds are not credited.
+    """
+    equity, exposure, pending, _ = account(user_id)
+    buy_back = marks({meal_id})[meal_id][1]
+    required = SHORT_INITIAL_MARGIN * (exposure + pending + quantity * max(price, buy_back))
+    return equity >= required
+
+
+class Liquidator(PeriodicJob):
+    """Runs the liquidation pass every few seconds on a background thread"""
+
+    def report(self, liquidated):
+        for username, covered in liquidated.items():
+            self.app.logger.warning("Liquidated %s below the maintenance margin: bought back %s", username, covered)
+
+
+liquidator = Liquidator('liquidator')
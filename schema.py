@@ -0,0 +1,135 @@
+"""
+Schema upgrades and query-plan checks for existing databases
+
+db.create_all() only creates missing tables. upgrade_schema() also adds
+columns and indexes that were introduced after a database was created,
+backfilling what they derive from, and check_query_plans() verifies the
+hot market queries are served by an index rather than a full table scan.
+"""
+from datetime import datetime
+from sqlalchemy import inspect, or_, text
+from database import db, Order, Trade
+import reservations
+
+# Tables whose hot queries must never fall back to a full scan
+SCAN_GUARDED_TABLES = ('orders', 'trades')
+
+# Columns of the reservation ledger; adding them means the held totals must be computed
+HOLD_COLUMNS = {'column users.held_balance', 'column positions.held_shares', 'column orders.short'}
+
+
+def upgrade_schema():
+    """Add missing columns and indexes to existing tables; return what was added
+
+    Runs on every app start as well as from manage_db.py migrate, so
+    whichever sees a new column first also fills it in.
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+    added = []
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                with engine.begin() as conn:
+                    conn.execute(text(_add_column_ddl(table.name, column, engine.dialect)))
+                added.append(f"column {table.name}.{column.name}")
+
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(engine)
+                added.append(f"index {index.name}")
+
+    if set(added) & HOLD_COLUMNS:
+        # Orders resting from before the ledger start out holding their cash and shares
+        if 'column orders.short' in added:
+            shorts = reservations.mark_uncovered_asks_short()
+            added.append(f"short flags on the resting asks of {shorts} uncovered sellers")
+        bids, asks = reservations.rebuild()
+        db.session.commit()
+        added.append(f"holds for {bids} bidders and {asks} positions behind resting orders")
+
+    return added
+
+
+def _add_column_ddl(table_name, column, dialect):
+    ddl = f"ALTER TABLE {table_name} ADD COLUMN {column.name} {column.type.compile(dialect=dialect)}"
+    if column.server_default is not None:
+        default = column.server_default.arg
+        default = f"'{default}'" if isinstance(default, str) else str(default.compile(dialect=dialect))
+        ddl += f" DEFAULT {default}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+    return ddl
+
+
+def hot_queries():
+    """The market's hot read queries, as (name, query) pairs"""
+    from market_service import MarketService
+
+    def book_side(side, ordering):
+        return Order.query.filter_by(meal_id=1, order_type=side, status='ACTIVE').order_by(ordering)
+
+    return [
+        ('best_ask', book_side('ASK', Order.price.asc()).limit(1)),
+        ('best_bid', book_side('BID', Order.price.desc()).limit(1)),
+        ('order_book_asks', book_side('ASK', Order.price.asc())),
+        ('order_book_bids', book_side('BID', Order.price.desc())),
+        ('book_reload', Order.query.filter_by(meal_id=1, status='ACTIVE').order_by(Order.id.asc())),
+        ('market_summary', MarketService._meal_summary_query()),
+        ('my_orders', Order.query.filter(
+            or_(Order.buyer_id == 1, Order.seller_id == 1),
+            Order.status == 'ACTIVE'
+        ).order_by(Order.id.asc())),
+        ('trade_history', Trade.query.order_by(Trade.timestamp.desc(), Trade.id.desc()).limit(20)),
+        ('meal_trades', Trade.query.filter_by(meal_id=1).order_by(Trade.timestamp.desc()).limit(20)),
+        ('trade_page', MarketService.trade_query(cursor=(datetime(2100, 1, 1), 1)).limit(20)),
+        ('user_trades', MarketService.trade_query(user_id=1).limit(20)),
+        ('user_buys', MarketService.trade_query(user_id=1, side='BUY').limit(20)),
+        ('short_asks', Order.query.filter(
+            Order.seller_id == 1, Order.status == 'ACTIVE',
+            Order.order_type == 'ASK', Order.short.is_(True)
+        )),
+        ('expired_orders', Order.query.filter(
+            Order.status == 'ACTIVE', Order.expires_at <= datetime(2100, 1, 1)
+        )),
+    ]
+
+
+def check_query_plans():
+    """EXPLAIN every hot query and return those that fully scan a guarded table
+
+    Returns a list of (name, plan lines) for every regression; an empty list
+    means all hot queries are index-backed.
+    """
+    dialect = db.engine.dialect.name
+    failures = []
+
+    with db.engine.connect() as conn:
+        if dialect == 'postgresql':
+            # Tiny tables make sequential scans look cheap; only ask whether an index is usable
+            conn.execute(text("SET enable_seqscan = off"))
+
+        for name, query in hot_queries():
+            sql = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+            if dialect == 'sqlite':
+                plan = [row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+            else:
+                plan = [row[0] for row in conn.execute(text(f"EXPLAIN {sql}"))]
+
+            if any(_is_full_scan(line, dialect) for line in plan):
+                failures.append((name, plan))
+
+    return failures
+
+
+def _is_full_scan(line, dialect):
+    if dialect == 'sqlite':
+        words = line.split()
+        return len(words) == 2 and words[0] == 'SCAN' and words[1] in SCAN_GUARDED_TABLES
+    return any(f"Seq Scan on {table}" in line for table in SCAN_GUARDED_TABLES)
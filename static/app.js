@@ -1,3 +1,6 @@
+// Last response body and ETag per GET endpoint, for conditional requests
+let responseCache = {};
+
 // API helper functions
 async function apiCall(endpoint, method = 'GET', data = null) {
     const options = {
@@ -11,8 +14,22 @@ async function apiCall(endpoint, method = 'GET', data = null) {
         options.body = JSON.stringify(data);
     }
     
+    const cached = method === 'GET' ? responseCache[endpoint] : null;
+    if (cached) {
+        options.headers['If-None-Match'] = cached.etag;
+    }
+    
     const response = await fetch(endpoint, options);
-    return await response.json();
+    if (response.status === 304 && cached) {
+        return JSON.parse(cached.body);
+    }
+    
+    const body = await response.text();
+    const etag = response.headers.get('ETag');
+    if (method === 'GET' && etag && response.ok) {
+        responseCache[endpoint] = { etag, body };
+    }
+    return JSON.parse(body);
 }
 
 // Global variable to store meals by category
@@ -20,6 +37,15 @@ let allMeals = [];
 let currentFilter = 'all';
 let priceHistory = {}; // Store price history for charts
 let chartInstance = null;
+let marketSummary = null; // Last market summary received
+let recentTrades = []; // Last trade history received
+
+// Live updates: server-sent events with polling as the fallback
+let liveSource = null;
+let pollTimer = null;
+let streamFailures = 0;
+let leaderboardTimer = null;
+const LEADERBOARD_REFRESH_DELAY = 1000; // ms; a burst of trades refreshes the leaderboard once
 
 // Login/Logout
 async function login() {
@@ -32,22 +58,15 @@ async function login() {
         
         document.getElementById('loginSection').style.display = 'none';
         document.getElementById('mainApp').style.display = 'block';
-        loadUserData();
-        loadMarketData();
-        loadTradeHistory();
-        
-        // Auto-refresh every 5 seconds
-        setInterval(() => {
-            loadUserData();
-            loadMarketData();
-            loadTradeHistory();
-        }, 5000);
+        startLiveUpdates();
     } else {
         alert('Invalid username');
     }
 }
 
 async function logout() {
+    stopLiveUpdates();
+    responseCache = {};
     await apiCall('/api/logout', 'POST');
     localStorage.removeItem('username');
     document.getElementById('loginSection').style.display = 'block';
@@ -64,28 +83,147 @@ window.addEventListener('DOMContentLoaded', async () => {
         if (result.success) {
             document.getElementById('loginSection').style.display = 'none';
             document.getElementById('mainApp').style.display = 'block';
-            loadUserData();
-            loadMarketData();
-            loadTradeHistory();
-            
-            // Auto-refresh every 5 seconds
-            setInterval(() => {
-                loadUserData();
-                loadMarketData();
-                loadTradeHistory();
-            }, 5000);
+            startLiveUpdates();
         } else {
             localStorage.removeItem('username');
         }
     }
 });
 
+// Subscribe to the market stream, falling back to polling if it is unavailable
+function startLiveUpdates() {
+    stopLiveUpdates();
+    
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+    
+    liveSource = new EventSource('/api/stream');
+    
+    liveSource.onopen = () => {
+        streamFailures = 0;
+        stopPolling();
+    };
+    
+    liveSource.addEventListener('snapshot', (event) => {
+        const snapshot = JSON.parse(event.data);
+        renderUserData(snapshot.user);
+        renderMarketData(snapshot.market);
+        renderTradeHistory(snapshot.trades);
+        loadLeaderboard();
+    });
+    
+    liveSource.addEventListener('book', (event) => {
+        if (!marketSummary) return;
+        const update = JSON.parse(event.data);
+        const index = marketSummary.meals.findIndex(meal => meal.id === update.id);
+        if (index >= 0) {
+            marketSummary.meals[index] = { ...marketSummary.meals[index], ...update };
+            renderMarketData(marketSummary);
+        }
+    });
+    
+    liveSource.addEventListener('trades', (event) => {
+        const trades = JSON.parse(event.data).reverse();
+        renderTradeHistory(trades.concat(recentTrades).slice(0, 20));
+        scheduleLeaderboard();
+    });
+    
+    liveSource.addEventListener('balance', (event) => {
+        const update = JSON.parse(event.data);
+        document.getElementById('balance').textContent = update.balance.toFixed(2);
+        if (update.held_balance !== undefined) {
+            document.getElementById('availableBalance').textContent = (update.balance - update.held_balance).toFixed(2);
+        }
+    });
+    
+    liveSource.addEventListener('liquidation', (event) => {
+        const update = JSON.parse(event.data);
+        const covered = Object.entries(update.covered).map(([meal, qty]) => `${qty} ${meal}`).join(', ');
+        alert(`Margin call: your shorts were bought back (${covered || 'no asks to buy from'})`);
+        loadPortfolio();
+    });
+    
+    liveSource.addEventListener('ipo', (event) => {
+        const update = JSON.parse(event.data);
+        document.getElementById('ipoPrice').textContent = update.ipo_price.toFixed(2);
+        if (marketSummary) {
+            marketSummary.ipo_price = update.ipo_price;
+            marketSummary.ipo_active = update.ipo_active;
+        }
+    });
+    
+    liveSource.onerror = () => {
+        // The browser reconnects on its own; poll meanwhile and give up after repeated failures
+        streamFailures += 1;
+        startPolling();
+        if (liveSource.readyState === EventSource.CLOSED || streamFailures >= 3) {
+            liveSource.close();
+            liveSource = null;
+        }
+    };
+}
+
+function stopLiveUpdates() {
+    if (liveSource) {
+        liveSource.close();
+        liveSource = null;
+    }
+    if (leaderboardTimer) {
+        clearTimeout(leaderboardTimer);
+        leaderboardTimer = null;
+    }
+    stopPolling();
+}
+
+// Refresh the leaderboard once the trades arriving together have settled
+function scheduleLeaderboard() {
+    if (leaderboardTimer) return;
+    leaderboardTimer = setTimeout(() => {
+        leaderboardTimer = null;
+        loadLeaderboard();
+    }, LEADERBOARD_REFRESH_DELAY);
+}
+
+// Fallback: refresh everything every 5 seconds
+function startPolling() {
+    if (pollTimer) return;
+    loadUserData();
+    loadMarketData();
+    loadTradeHistory();
+    loadLeaderboard();
+    pollTimer = setInterval(() => {
+        loadUserData();
+        loadMarketData();
+        loadTradeHistory();
+        loadLeaderboard();
+    }, 5000);
+}
+
+function stopPolling() {
+    if (pollTimer) {
+        clearInterval(pollTimer);
+        pollTimer = null;
+    }
+}
+
 // Load user data
 async function loadUserData() {
     const result = await apiCall('/api/current_user');
+    renderUserData(result);
+}
+
+function renderUserData(result) {
     if (result.username) {
         document.getElementById('username').textContent = result.username;
         document.getElementById('balance').textContent = result.balance.toFixed(2);
+        if (result.available_balance !== undefined) {
+            document.getElementById('availableBalance').textContent = result.available_balance.toFixed(2);
+        }
+        if (result.net_worth !== undefined) {
+            document.getElementById('netWorth').textContent = result.net_worth.toFixed(2);
+        }
         document.getElementById('ipoPrice').textContent = result.ipo_price.toFixed(2);
         
         // Only show Start IPO button for Josh
@@ -102,6 +240,11 @@ async function loadUserData() {
 // Load market data
 async function loadMarketData() {
     const result = await apiCall('/api/market_summary');
+    renderMarketData(result);
+}
+
+function renderMarketData(result) {
+    marketSummary = result;
     const tbody = document.getElementById('marketBody');
     tbody.innerHTML = '';
     
@@ -185,6 +328,11 @@ function updateMealDropdown(type) {
 // Load trade history
 async function loadTradeHistory() {
     const result = await apiCall('/api/trade_history');
+    renderTradeHistory(result);
+}
+
+function renderTradeHistory(result) {
+    recentTrades = result;
     const tbody = document.getElementById('tradeBody');
     tbody.innerHTML = '';
     
@@ -201,6 +349,33 @@ async function loadTradeHistory() {
     });
 }
 
+// Load leaderboard (net worth marked to market)
+async function loadLeaderboard() {
+    const result = await apiCall('/api/leaderboard');
+    renderLeaderboard(result);
+}
+
+function renderLeaderboard(result) {
+    const tbody = document.getElementById('leaderboardBody');
+    const me = document.getElementById('username').textContent;
+    tbody.innerHTML = '';
+    
+    result.forEach(entry => {
+        const row = document.createElement('tr');
+        row.innerHTML = `
+            <td>${entry.rank}</td>
+            <td>${entry.username}</td>
+            <td>$${entry.cash.toFixed(2)}</td>
+            <td>$${entry.positions_value.toFixed(2)}</td>
+            <td>$${entry.net_worth.toFixed(2)}</td>
+        `;
+        tbody.appendChild(row);
+        if (entry.username === me) {
+            document.getElementById('netWorth').textContent = entry.net_worth.toFixed(2);
+        }
+    });
+}
+
 // Load portfolio
 async function loadPortfolio() {
     const result = await apiCall('/api/portfolio');
@@ -211,10 +386,10 @@ async function loadPortfolio() {
         return;
     }
     
-    let html = '<table style="width: 100%;"><tr><th>Meal</th><th>Shares</th></tr>';
+    let html = '<table style="width: 100%;"><tr><th>Meal</th><th>Shares</th><th>Value</th></tr>';
     for (const [meal, data] of Object.entries(result)) {
         const badge = data.is_short ? '<span class="badge badge-danger">SHORT</span>' : '';
-        html += `<tr><td>${meal}</td><td>${data.shares} ${badge}</td></tr>`;
+        html += `<tr><td>${meal}</td><td>${data.shares} ${badge}</td><td>$${data.value.toFixed(2)}</td></tr>`;
     }
     html += '</table>';
     display.innerHTML = html;
@@ -260,13 +435,14 @@ async function secondaryBuy() {
     const price = parseFloat(document.getElementById('secondaryBuyPrice').value);
     const qty = parseInt(document.getElementById('secondaryBuyQty').value);
     const snap_buy = document.getElementById('snapBuy').checked;
+    const time_in_force = document.getElementById('secondaryBuyTimeInForce').value;
     
     if (!meal) {
         alert('Please select a category and meal');
         return;
     }
     
-    const result = await apiCall('/api/secondary_buy', 'POST', { meal, price, qty, snap_buy });
+    const result = await apiCall('/api/secondary_buy', 'POST', { meal, price, qty, snap_buy, time_in_force });
     alert(result.message);
     
     if (result.success) {
@@ -287,13 +463,14 @@ async function sell() {
     const price = parseFloat(document.getElementById('sellPrice').value);
     const qty = parseInt(document.getElementById('sellQty').value);
     const is_short = document.getElementById('isShort').checked;
+    const time_in_force = document.getElementById('sellTimeInForce').value;
     
     if (!meal) {
         alert('Please select a category and meal');
         return;
     }
     
-    const result = await apiCall('/api/sell', 'POST', { meal, price, qty, is_short });
+    const result = await apiCall('/api/sell', 'POST', { meal, price, qty, is_short, time_in_force });
     alert(result.message);
     
     if (result.success) {
@@ -334,8 +511,12 @@ function switchIndex(category) {
     });
     document.getElementById('tab-' + category).classList.add('active');
     
-    // Reload market data with filter
-    loadMarketData();
+    // Re-render market data with filter
+    if (marketSummary) {
+        renderMarketData(marketSummary);
+    } else {
+        loadMarketData();
+    }
 }
 
 // Draw mini sparkline chart
@@ -378,14 +559,26 @@ function selectMealForChart(mealName) {
     updateChart();
 }
 
-// Update full price chart
-function updateChart() {
-    const mealName = document.getElementById('chartMealSelect').value;
+// Update full price chart from the server's 1-minute candles (traded prices),
+// falling back to the best bid/ask seen since the page loaded
+async function updateChart() {
+    const select = document.getElementById('chartMealSelect');
+    const mealName = select.value;
     if (!mealName) return;
     
+    let history = priceHistory[mealName] || [];
+    try {
+        const result = await apiCall(`/api/candles/${encodeURIComponent(mealName)}?interval=1m&limit=60`);
+        if (result.candles && result.candles.length >= 2) {
+            history = result.candles.map(candle => ({ time: candle.time * 1000, price: candle.close }));
+        }
+    } catch (error) {
+        console.error('Failed to load candles:', error);
+    }
+    if (select.value !== mealName) return; // Another meal was picked meanwhile
+    
     const canvas = document.getElementById('priceChart');
     const ctx = canvas.getContext('2d');
-    const history = priceHistory[mealName] || [];
     
     if (history.length < 2) {
         ctx.clearRect(0, 0, canvas.width, canvas.height);
@@ -0,0 +1,65 @@
+"""
+Shared fixtures: one app on a throwaway SQLite database, reset before each test
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+os.environ['JOURNAL_PATH'] = ''
+os.environ['MAINTENANCE_INTERVAL'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app as flask_app  # noqa: E402
+from database import db, User, Position  # noqa: E402
+from init_db import init_database  # noqa: E402
+from market_cache import snapshot_cache  # noqa: E402
+from market_service import MarketService  # noqa: E402
+from order_book import order_books  # noqa: E402
+from reference_data import reference_data  # noqa: E402
+from valuation import valuations  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    return flask_app
+
+
+@pytest.fixture
+def market(app):
+    """A fresh market with the IPO started, inside an app context"""
+    with app.app_context():
+        db.drop_all()
+        init_database()
+        order_books.clear()
+        order_books.invalidate()
+        reference_data.clear()
+        valuations.invalidate()
+        snapshot_cache.clear()
+        MarketService.start_ipo()
+        yield MarketService
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app, market):
+    return app.test_client()
+
+
+def login(client, username):
+    client.post('/api/login', json={'username': username})
+
+
+def held_cash(username):
+    db.session.expire_all()
+    return User.query.filter_by(username=username).one().held_balance
+
+
+def held_shares(username, meal_name):
+    db.session.expire_all()
+    user = User.query.filter_by(username=username).one()
+    meal = MarketService.get_meal(meal_name)
+    position = Position.query.filter_by(user_id=user.id, meal_id=meal.id).first()
+    return position.held_shares if position else 0
@@ -0,0 +1,126 @@
+import json
+import time
+from datetime import datetime, timedelta
+
+from conftest import login
+
+
+def test_malformed_expiry_is_a_bad_request(client):
+    login(client, 'Jack')
+    for expires_at in ('tomorrow', [1], 1e300, True):
+        response = client.post('/api/secondary_buy', json={
+            'meal': 'Beef Stew', 'price': 50, 'qty': 1, 'time_in_force': 'GTD', 'expires_at': expires_at
+        })
+        assert response.status_code == 400
+        assert response.json['message'] == "expires_at must be a time in unix seconds"
+
+
+def test_past_expiry_is_a_bad_request(client):
+    login(client, 'Jack')
+    response = client.post('/api/secondary_buy', json={
+        'meal': 'Beef Stew', 'price': 50, 'qty': 1, 'time_in_force': 'GTD', 'expires_at': time.time() - 60
+    })
+    assert response.status_code == 400
+    assert response.json['message'] == "Expiry time has already passed"
+    response = client.post('/api/secondary_buy', json={
+        'meal': 'Beef Stew', 'price': 50, 'qty': 1, 'time_in_force': 'GTD', 'expires_at': time.time() + 60
+    })
+    assert response.status_code == 200 and response.json['success']
+
+
+def test_best_effort_batch_reports_malformed_orders(client):
+    login(client, 'Jack')
+    response = client.post('/api/orders/batch', json={'mode': 'best_effort', 'orders': [
+        {'type': 'buy', 'meal': 'Beef Stew', 'price': 50},
+        {'type': 'buy', 'meal': 'Beef Stew', 'price': 50, 'qty': 2},
+        {'type': 'buy', 'meal': 'Beef Stew', 'price': 1000, 'qty': -20},
+        {'type': 'sell', 'meal': ['Beef Stew'], 'price': 50, 'qty': 1},
+        'cancel everything',
+        {'type': 'cancel', 'order_id': 'x'},
+    ]})
+    assert response.status_code == 200
+    results = response.json['results']
+    assert [result['success'] for result in results] == [False, True, False, False, False, False]
+    assert results[0]['message'] == "Quantity must be a positive whole number"
+    assert results[2]['message'] == "Quantity must be a positive whole number"
+    assert results[3]['message'] == "Invalid meal"
+    assert results[4]['message'] == "Each order must be an object"
+    assert results[5]['message'] == "order_id must be a whole number"
+    assert response.json['message'] == "1 of 6 orders accepted"
+
+
+def test_atomic_batch_with_a_malformed_order_is_a_bad_request(client):
+    login(client, 'Jack')
+    response = client.post('/api/orders/batch', json={'orders': [
+        {'type': 'buy', 'meal': 'Beef Stew', 'price': 50, 'qty': 2},
+        {'type': 'buy', 'meal': 'Beef Stew', 'price': 0, 'qty': 2},
+    ]})
+    assert response.status_code == 400
+    assert response.json['message'] == "Order 2 is invalid: Price must be a positive number. Nothing was placed"
+    assert [result['message'] for result in response.json['results']] == ["Not placed", "Price must be a positive number"]
+    assert client.get('/api/my_orders').json == []
+
+
+def test_trade_history_can_include_archived_trades(client, market):
+    assert market.buy_from_ipo('Sam', 'Beef Stew', 10)[0]
+    assert market.place_sell_order('Sam', 'Beef Stew', 100, 3)[0]
+    assert market.place_buy_order('Jack', 'Beef Stew', 100, 2)[0]
+    assert market.place_buy_order('Jack', 'Beef Stew', 100, 1)[0]
+    assert market.run_maintenance(now=datetime.utcnow() + timedelta(days=30))[2] == 2
+
+    live = client.get('/api/trade_history?user=Jack').get_json()
+    assert [trade['quantity'] for trade in live] == [1]
+    everything = client.get('/api/trade_history?user=Jack&archived=1').get_json()
+    assert [trade['quantity'] for trade in everything] == [1, 2]
+    assert everything[1]['buyer'] == 'Jack' and everything[1]['meal_name'] == 'Beef Stew'
+
+    lines = client.get('/api/trade_history?format=ndjson&archived=1&order=asc').data.splitlines()
+    assert [json.loads(line)['seller'] for line in lines] == ['IPO_HOUSE', 'Sam', 'Sam']
+
+
+def test_etags_depend_on_the_query(client, market):
+    assert market.buy_from_ipo('Sam', 'Beef Stew', 10)[0]
+    for price in (100, 101, 102):
+        assert market.place_sell_order('Sam', 'Beef Stew', price, 1)[0]
+        assert market.place_buy_order('Jack', 'Beef Stew', price, 1)[0]
+
+    first = client.get('/api/trade_history?limit=1')
+    second = client.get('/api/trade_history?limit=1&cursor=' + first.headers['X-Next-Cursor'])
+    assert first.get_json() != second.get_json()
+    assert first.headers['ETag'] != second.headers['ETag']
+    # Parameter order does not matter
+    again = client.get('/api/trade_history?cursor=' + first.headers['X-Next-Cursor'] + '&limit=1',
+                       headers={'If-None-Match': second.headers['ETag']})
+    assert again.status_code == 304
+
+    stew = client.get('/api/order_book/Beef%20Stew')
+    chuck_eye = client.get('/api/order_book/Korean%20Chuck%20Eye')
+    assert stew.headers['ETag'] != chuck_eye.headers['ETag']
+
+
+def test_bad_trade_history_bounds_are_a_bad_request(client):
+    for query in ('start=1e300', 'start=nan', 'end=inf', 'end=-1e300', 'start=soon'):
+        for fmt in ('', '&format=ndjson'):
+            response = client.get(f'/api/trade_history?{query}{fmt}')
+            assert response.status_code == 400
+            assert response.json['message'] == "Invalid start/end"
+    assert client.get('/api/trade_history?start=0&end=4102444800').status_code == 200
+
+
+def test_bad_candle_bounds_are_a_bad_request(client):
+    for query in ('start=1e300', 'end=nan', 'start=-inf'):
+        response = client.get(f'/api/candles/Beef%20Stew?{query}')
+        assert response.status_code == 400
+        assert response.json['message'] == "Invalid start/end"
+    assert client.get('/api/candles/Beef%20Stew?start=0').status_code == 200
+
+
+def test_cancel_all_rejects_a_meal_that_is_not_a_name(client, market):
+    login(client, 'Jack')
+    assert market.place_buy_order('Jack', 'Beef Stew', 50, 1)[0]
+    for body in ({'meal': ['Beef Stew']}, {'meal': {'name': 'Beef Stew'}}, {'meal': 7}, ['Beef Stew']):
+        response = client.post('/api/orders/cancel_all', json=body)
+        assert response.status_code == 400
+        assert response.json['message'] == "Invalid meal"
+    response = client.post('/api/orders/cancel_all', json={'meal': 'Beef Stew'})
+    assert response.json['cancelled'] == 1
@@ -0,0 +1,48 @@
+import time
+from datetime import datetime, timedelta
+
+from database import Order
+from conftest import held_cash, held_shares
+
+
+def lapse_soon():
+    return datetime.utcnow() + timedelta(seconds=0.3)
+
+
+def test_fok_ignores_lapsed_asks(market):
+    assert market.buy_from_ipo('Sam', 'Beef Stew', 10)[0]
+    assert market.place_sell_order('Sam', 'Beef Stew', 100, 5, time_in_force='GTD', expires_at=lapse_soon())[0]
+    assert market.place_sell_order('Sam', 'Beef Stew', 101, 2)[0]
+    time.sleep(0.4)
+    ok, message, trades = market.place_buy_order('Jack', 'Beef Stew', 110, 6, time_in_force='FOK')
+    assert not ok and message == "Not enough liquidity to fill the whole order" and not trades
+    assert held_cash('Jack') == 0
+    assert held_shares('Sam', 'Beef Stew') == 2
+    assert Order.query.filter_by(status='EXPIRED').count() == 1
+
+
+def test_post_only_does_not_cross_lapsed_bids(market):
+    assert market.buy_from_ipo('Sam', 'Beef Stew', 10)[0]
+    assert market.place_buy_order('Jack', 'Beef Stew', 120, 5, time_in_force='GTD', expires_at=lapse_soon())[0]
+    time.sleep(0.4)
+    ok, message, _ = market.place_sell_order('Sam', 'Beef Stew', 110, 5, time_in_force='POST_ONLY')
+    assert ok, message
+    assert held_cash('Jack') == 0
+
+
+def test_lapsed_orders_never_trade(market):
+    assert market.place_buy_order('Jack', 'Beef Stew', 50, 5, time_in_force='GTD', expires_at=lapse_soon())[0]
+    assert held_cash('Jack') == 250
+    time.sleep(0.4)
+    assert market.buy_from_ipo('Sam', 'Beef Stew', 5)[0]
+    ok, _, trades = market.place_sell_order('Sam', 'Beef Stew', 40, 2, time_in_force='IOC')
+    assert not ok and not trades
+    assert held_cash('Jack') == 0
+
+
+def test_gtd_needs_a_future_expiry(market):
+    ok, message, _ = market.place_buy_order('Jack', 'Beef Stew', 50, 5, time_in_force='GTD')
+    assert not ok and message == "Expiry time required"
+    past = datetime.utcnow() - timedelta(seconds=1)
+    ok, message, _ = market.place_buy_order('Jack', 'Beef Stew', 50, 5, time_in_force='GTD', expires_at=past)
+    assert not ok and message == "Expiry time has already passed"
@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+
+from database import db, Order, Trade, ArchivedOrder, ArchivedTrade
+from market_cache import current_sequence
+from periodic import claim
+
+
+def test_idle_pass_does_not_write(market):
+    before = current_sequence()
+    assert market.run_maintenance() == (0, 0, 0)
+    assert current_sequence() == before
+
+
+def test_pass_expires_and_archives(market):
+    assert market.buy_from_ipo('Sam', 'Beef Stew', 10)[0]
+    assert market.place_sell_order('Sam', 'Beef Stew', 100, 3)[0]
+    assert market.place_buy_order('Jack', 'Beef Stew', 100, 3)[0]
+    assert market.place_buy_order('Jack', 'Beef Stew', 90, 1, time_in_force='DAY')[0]
+    assert market.place_buy_order('Josh', 'Beef Stew', 80, 1)[0]
+
+    expired, orders, trades = market.run_maintenance(now=datetime.utcnow() + timedelta(days=30))
+    db.session.expire_all()
+    assert (expired, orders, trades) == (1, 2, 1)
+    assert Order.query.filter_by(status='ACTIVE').count() == 1
+    assert ArchivedOrder.query.count() == 2
+    # Each meal's last trade stays for marks and margin
+    assert Trade.query.count() == 1 and ArchivedTrade.query.count() == 1
+
+    before = current_sequence()
+    assert market.run_maintenance(now=datetime.utcnow() + timedelta(days=30)) == (0, 0, 0)
+    assert current_sequence() == before
+
+
+def test_one_holder_per_job(market):
+    assert claim('maintainer', 'a:1', 60)
+    assert not claim('maintainer', 'b:2', 60)
+    assert claim('maintainer', 'a:1', 60)
+    assert claim('liquidator', 'b:2', 60)
+    # An expired lease can be taken over
+    assert claim('other', 'a:1', -1)
+    assert claim('other', 'b:2', 60)
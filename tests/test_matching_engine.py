@@ -0,0 +1,52 @@
+import threading
+import time
+
+from conftest import held_cash
+from database import db, Order
+from market_cache import current_sequence
+from market_service import MarketService
+from matching_engine import engine
+
+
+def test_queued_orders_commit_as_one_write(app, market):
+    started = threading.Event()
+    release = threading.Event()
+    batches = []
+
+    def run_write(work, exhausted_result):
+        batches.append(None)
+        if len(batches) == 1:
+            # Hold the first write so the other orders queue up behind it
+            started.set()
+            release.wait(5)
+        return MarketService._run_write(work, exhausted_result)
+
+    def place(username, price):
+        with app.app_context():
+            results[username] = MarketService.place_buy_order(username, 'Beef Stew', price, 1)
+            db.session.remove()
+
+    results = {}
+    before = current_sequence()
+    engine.start(app, run_write)
+    try:
+        first = threading.Thread(target=place, args=('Jack', 50))
+        first.start()
+        assert started.wait(5)
+        rest = [threading.Thread(target=place, args=(name, 51)) for name in ('Josh', 'Levi', 'Sam', 'Noah')]
+        for thread in rest:
+            thread.start()
+        while engine.requests.qsize() < len(rest):
+            time.sleep(0.001)
+        release.set()
+        for thread in [first] + rest:
+            thread.join()
+    finally:
+        engine.stop()
+
+    assert all(success for success, _, _ in results.values())
+    assert len(batches) == 2
+    assert current_sequence() == before + 2
+    db.session.expire_all()
+    assert Order.query.filter_by(status='ACTIVE', order_type='BID').count() == 5
+    assert held_cash('Josh') == 51
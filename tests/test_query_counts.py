@@ -0,0 +1,89 @@
+"""
+The serializing read paths issue the same number of queries whatever the data size
+"""
+import random
+from datetime import datetime
+
+from sqlalchemy import event, insert
+
+from conftest import login
+from database import db, User, Meal, Order, Position, Trade
+from market_cache import snapshot_cache
+from reference_data import reference_data
+from valuation import valuations
+
+ENDPOINTS = (
+    ('order_book', '/api/order_book/Beef%20Stew'),
+    ('trade_history', '/api/trade_history'),
+    ('portfolio', '/api/portfolio'),
+    ('my_orders', '/api/my_orders'),
+)
+
+
+def seed(count, rng):
+    """Bulk insert `count` resting orders, trades and positions spread over every user and meal"""
+    users = db.session.query(User.id, User.username).all()
+    meal_ids = [meal_id for (meal_id,) in db.session.query(Meal.id)]
+    orders, trades = [], []
+    for _ in range(count):
+        user_id = rng.choice(users).id
+        side = rng.choice(('BID', 'ASK'))
+        quantity = rng.randint(1, 10)
+        orders.append({
+            'meal_id': rng.choice(meal_ids),
+            'order_type': side,
+            'price': round(rng.uniform(20, 150), 2),
+            'quantity': quantity,
+            'remaining_quantity': quantity,
+            'buyer_id': user_id if side == 'BID' else None,
+            'seller_id': user_id if side == 'ASK' else None,
+            'status': 'ACTIVE'
+        })
+        buyer, seller = rng.sample(users, 2)
+        trades.append({
+            'meal_id': rng.choice(meal_ids),
+            'buyer_id': buyer.id,
+            'seller_id': seller.id,
+            'seller_name': seller.username,
+            'quantity': quantity,
+            'price': round(rng.uniform(20, 150), 2),
+            'timestamp': datetime.utcnow()
+        })
+    db.session.execute(insert(Order), orders)
+    db.session.execute(insert(Trade), trades)
+    # Jack holds something in as many meals as there are rows, up to every meal
+    jack = User.query.filter_by(username='Jack').one()
+    held = {meal_id for (meal_id,) in db.session.query(Position.meal_id).filter_by(user_id=jack.id)}
+    db.session.execute(insert(Position), [
+        {'user_id': jack.id, 'meal_id': meal_id, 'shares': 5}
+        for meal_id in meal_ids[:count] if meal_id not in held
+    ])
+    db.session.commit()
+
+
+def count_queries(client):
+    """Statements each endpoint issues with nothing cached"""
+    counts = {}
+    for name, path in ENDPOINTS:
+        snapshot_cache.clear()
+        reference_data.clear()
+        valuations.invalidate()
+        db.session.remove()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            assert client.get(path).status_code == 200
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        counts[name] = len(statements)
+    return counts
+
+
+def test_query_counts_do_not_grow_with_rows(client, market):
+    rng = random.Random(0)
+    login(client, 'Jack')
+    seed(20, rng)
+    small = count_queries(client)
+    seed(180, rng)
+    assert count_queries(client) == small
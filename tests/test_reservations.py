@@ -0,0 +1,36 @@
+from conftest import held_cash, held_shares
+
+
+def test_negative_quantity_is_rejected_before_reserving(market):
+    ok, message, _ = market.place_buy_order('Jack', 'Beef Stew', 1000, -20)
+    assert not ok and message == "Quantity must be a positive whole number"
+    assert held_cash('Jack') == 0
+    # The balance is still guarded: more than it covers is refused
+    ok, message, _ = market.place_buy_order('Jack', 'Beef Stew', 1000, 25)
+    assert not ok and message == "Insufficient funds"
+
+
+def test_bad_quantities_and_prices_are_rejected(market):
+    assert market.buy_from_ipo('Sam', 'Beef Stew', 10)[0]
+    for quantity in (0, 2.5, '3', None, True):
+        ok, message, _ = market.place_sell_order('Sam', 'Beef Stew', 100, quantity)
+        assert not ok and message == "Quantity must be a positive whole number"
+    for price in (0, -5, float('nan'), float('inf'), '100'):
+        ok, message, _ = market.place_sell_order('Sam', 'Beef Stew', price, 5)
+        assert not ok and message == "Price must be a positive number"
+    assert held_shares('Sam', 'Beef Stew') == 0
+
+
+def test_market_orders_need_no_price(market):
+    assert market.buy_from_ipo('Sam', 'Beef Stew', 10)[0]
+    assert market.place_sell_order('Sam', 'Beef Stew', 150, 5)[0]
+    ok, message, trades = market.place_buy_order('Jack', 'Beef Stew', None, 2, time_in_force='MARKET')
+    assert ok and [trade['price'] for trade in trades] == [150]
+    assert held_cash('Jack') == 0
+    assert held_shares('Sam', 'Beef Stew') == 3
+
+
+def test_ipo_rejects_non_positive_quantities(market):
+    for quantity in (0, -5, 1.5):
+        ok, message = market.buy_from_ipo('Jack', 'Beef Stew', quantity)
+        assert not ok and message == "Quantity must be a positive whole number"
@@ -0,0 +1,34 @@
+from database import db, User
+from market_service import MarketService
+from reference_data import reference_data
+from valuation import valuations
+
+
+def short_fifty(market):
+    """Jack shorts 50 Beef Stew to Sam at 100"""
+    assert market.place_sell_order('Jack', 'Beef Stew', 100, 50, is_short=True)[0]
+    assert market.place_buy_order('Sam', 'Beef Stew', 100, 50)[0]
+
+
+def test_far_off_ask_does_not_liquidate_a_short(market):
+    short_fifty(market)
+    assert market.place_sell_order('Sam', 'Beef Stew', 1000, 5)[0]
+    valuations.ensure_current()
+    meal = MarketService.get_meal('Beef Stew')
+    assert valuations.short_mark(meal.id) == 110
+    assert market.liquidate_margin_breaches() == {}
+
+
+def test_liquidation_buys_back_within_the_band(market):
+    short_fifty(market)
+    assert market.place_sell_order('Sam', 'Beef Stew', 105, 5)[0]
+    assert market.place_sell_order('Sam', 'Beef Stew', 1000, 5)[0]
+    # Leave Jack's equity under the maintenance margin on the banded exposure
+    User.query.filter_by(username='Jack').update({'balance': 6500.0})
+    db.session.commit()
+    reference_data.clear()
+    valuations.invalidate()
+
+    assert market.liquidate_margin_breaches() == {'Jack': {'Beef Stew': 5}}
+    book = market.get_order_book('Beef Stew')
+    assert [level['price'] for level in book['asks']] == [1000]
@@ -0,0 +1,12 @@
+from schema import check_query_plans
+
+
+def test_hot_queries_use_an_index(market):
+    assert market.buy_from_ipo('Sam', 'Beef Stew', 20)[0]
+    for price in (100, 101, 102):
+        assert market.place_sell_order('Sam', 'Beef Stew', price, 2)[0]
+        assert market.place_buy_order('Jack', 'Beef Stew', price, 1)[0]
+    assert market.place_buy_order('Josh', 'Beef Stew', 90, 1, time_in_force='DAY')[0]
+    assert market.place_sell_order('Levi', 'Beef Stew', 150, 1, is_short=True)[0]
+
+    assert check_query_plans() == []
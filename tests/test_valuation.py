@@ -0,0 +1,19 @@
+from market_service import MarketService
+from valuation import valuations
+
+
+def test_portfolio_marks_without_a_full_rebuild(market):
+    assert market.buy_from_ipo('Sam', 'Beef Stew', 10)[0]
+    assert market.place_sell_order('Sam', 'Beef Stew', 120, 2)[0]
+    assert market.place_buy_order('Jack', 'Beef Stew', 120, 2)[0]
+    assert market.place_sell_order('Sam', 'Beef Stew', 130, 1)[0]
+    assert market.place_buy_order('Josh', 'Beef Stew', 100, 1)[0]
+
+    # As if another worker had written since this one built its values
+    valuations.invalidate()
+    portfolio = MarketService.get_portfolio('Jack')
+    assert portfolio['Beef Stew']['mark'] == 115
+    assert valuations.sequence is None
+
+    valuations.ensure_current()
+    assert MarketService.get_portfolio('Jack') == portfolio
@@ -0,0 +1,277 @@
+"""
+Mark-to-market net worth and the leaderboard
+
+Every user's net worth is their cash plus each position marked at the
+meal's mark price: the mid of the in-memory book when both sides are
+quoted, otherwise the last trade price (0 if the meal has never traded).
+Short positions count as liabilities at the same mark.
+
+Short exposure is marked at what buying the shares back would cost: the
+best ask, otherwise the last trade price. Like a MARKET order, a buy-back
+never pays more than MARKET_ORDER_BAND over the last trade, so one far-off
+ask cannot push a short into liquidation on its own. Users whose net worth
+falls below SHORT_MAINTENANCE_MARGIN of their exposure are kept in a set
+for the liquidation pass (risk.py).
+
+The values are kept per process and updated from the events each market
+write publishes (trades, balance and top-of-book changes), touching only
+the users whose cash or positions changed and the holders of meals whose
+mark moved. Users are ranked in a sorted list, so re-ranking one costs
+O(log n). If another process wrote in between, everything is rebuilt from
+the database with a handful of aggregate queries on the next read.
+"""
+import threading
+from sqlalchemy import func, select
+from sortedcontainers import SortedList
+from database import db, User, Position, Order, Trade, Meal
+from market_cache import current_sequence
+from config import SHORT_MAINTENANCE_MARGIN, MARKET_ORDER_BAND
+
+
+def mark_price(best_bid, best_ask, last_trade):
+    """Book mid when both sides are quoted, else the last trade price"""
+    if best_bid is not None and best_ask is not None:
+        return (best_bid + best_ask) / 2
+    return last_trade if last_trade is not None else 0.0
+
+
+def last_trades(meal_ids=None):
+    """{meal_id: last trade price} for the meals that have traded, all of them or just meal_ids"""
+    latest = select(func.max(Trade.id)).group_by(Trade.meal_id)
+    if meal_ids is not None:
+        latest = latest.where(Trade.meal_id.in_(meal_ids))
+    return dict(db.session.execute(select(Trade.meal_id, Trade.price).where(Trade.id.in_(latest))).all())
+
+
+def book_quotes(meal_ids=None):
+    """{meal_id: (best bid, best ask)} from the active orders, for every meal or just meal_ids"""
+    query = (
+        select(Order.meal_id, Order.order_type, func.max(Order.price), func.min(Order.price))
+        .where(Order.status == 'ACTIVE')
+        .group_by(Order.meal_id, Order.order_type)
+    )
+    if meal_ids is not None:
+        query = query.where(Order.meal_id.in_(meal_ids))
+    quotes = {}
+    for meal_id, side, highest, lowest in db.session.execute(query):
+        best_bid, best_ask = quotes.get(meal_id, (None, None))
+        if side == 'BID':
+            best_bid = highest
+        else:
+            best_ask = lowest
+        quotes[meal_id] = (best_bid, best_ask)
+    return quotes
+
+
+def buy_back_limit(last_trade):
+    """The most a buy-back pays per share: MARKET_ORDER_BAND over the last trade, None if it never traded"""
+    if last_trade is None:
+        return None
+    return round(last_trade * (1 + MARKET_ORDER_BAND), 2)
+
+
+def short_mark_price(best_ask, last_trade):
+    """What buying a share back costs: the best ask up to buy_back_limit, else the last trade price"""
+    if best_ask is None:
+        return last_trade if last_trade is not None else 0.0
+    limit = buy_back_limit(last_trade)
+    return best_ask if limit is None else min(best_ask, limit)
+
+
+class Valuations:
+    """Per-user net worth and ranking for one process"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.sequence = None  # market sequence the values reflect; None when stale
+        self.cash = {}  # username -> balance
+        self.positions = {}  # username -> {meal_id: shares}
+        self.holders = {}  # meal_id -> set of usernames with a non-zero position
+        self.last_trade = {}  # meal_id -> price
+        self.quotes = {}  # meal_id -> (best_bid, best_ask)
+        self.marks = {}  # meal_id -> mark price
+        self.short_marks = {}  # meal_id -> buy-back price for shorts
+        self.net_worth = {}  # username -> value
+        self.exposure = {}  # username -> short shares at their buy-back price
+        self.breaches = set()  # usernames below the maintenance margin
+        self.ranking = SortedList()  # (-net_worth, username)
+
+    def apply(self, sequence, events):
+        """Fold the events of a write this process just committed into the values
+
+        Events arrive as published to market_events. If this process missed a
+        write (the sequence is not the next one), the values are marked stale
+        and rebuilt on the next read instead.
+        """
+        with self._lock:
+            if self.sequence is None or sequence != self.sequence + 1:
+                self.sequence = None
+                return
+
+            users = set()
+            meals = set()
+            for name, data, username in events:
+                if name == 'trades':
+                    for trade in data:
+                        meal_id = trade['meal_id']
+                        self._move_shares(trade['buyer'], meal_id, trade['quantity'])
+                        if trade['seller'] != 'IPO_HOUSE':
+                            self._move_shares(trade['seller'], meal_id, -trade['quantity'])
+                            users.add(trade['seller'])
+                        users.add(trade['buyer'])
+                        self.last_trade[meal_id] = trade['price']
+                        meals.add(meal_id)
+                elif name == 'balance':
+                    self.cash[username] = data['balance']
+                    users.add(username)
+                elif name == 'book':
+                    self.quotes[data['id']] = (data['best_bid'], data['best_ask'])
+                    meals.add(data['id'])
+
+            for meal_id in meals:
+                mark = self._mark(meal_id)
+                short_mark = self._short_mark(meal_id)
+                if mark != self.marks.get(meal_id) or short_mark != self.short_marks.get(meal_id):
+                    self.marks[meal_id] = mark
+                    self.short_marks[meal_id] = short_mark
+                    users.update(self.holders.get(meal_id, ()))
+            for username in users:
+                self._revalue(username)
+            self.sequence = sequence
+
+    def ensure_current(self, version=None):
+        """Rebuild from the database unless the values reflect the current sequence"""
+        if version is None:
+            version = current_sequence()
+        with self._lock:
+            if self.sequence != version:
+                self.load(version)
+
+    def load(self, version):
+        """Rebuild every value from the database as of market sequence `version`"""
+        with self._lock:
+            self.cash = dict(db.session.execute(select(User.username, User.balance)).all())
+            meal_ids = db.session.scalars(select(Meal.id)).all()
+
+            self.positions = {}
+            self.holders = {}
+            rows = db.session.execute(
+                select(User.username, Position.meal_id, Position.shares)
+                .join(User, User.id == Position.user_id)
+                .where(Position.shares != 0)
+            )
+            for username, meal_id, shares in rows:
+                self.positions.setdefault(username, {})[meal_id] = shares
+                self.holders.setdefault(meal_id, set()).add(username)
+
+            self.last_trade = last_trades()
+            self.quotes = book_quotes()
+
+            self.marks = {meal_id: self._mark(meal_id) for meal_id in meal_ids}
+            self.short_marks = {meal_id: self._short_mark(meal_id) for meal_id in meal_ids}
+            self.net_worth = {}
+            self.exposure = {}
+            self.breaches = set()
+            self.ranking = SortedList()
+            for username in self.cash:
+                self._revalue(username)
+            # A write that committed while these queries ran may be half reflected
+            self.sequence = version if current_sequence() == version else None
+
+    def invalidate(self):
+        with self._lock:
+            self.sequence = None
+
+    def user(self, username):
+        """A user's cash, positions value and net worth, or None for an unknown user"""
+        with self._lock:
+            if username not in self.cash:
+                return None
+            cash = self.cash[username]
+            return {
+                'username': username,
+                'cash': cash,
+                'positions_value': self.net_worth[username] - cash,
+                'net_worth': self.net_worth[username],
+                'short_exposure': self.exposure[username]
+            }
+
+    def mark(self, meal_id):
+        with self._lock:
+            return self.marks.get(meal_id, 0.0)
+
+    def marks_for(self, meal_ids, version):
+        """Mark prices for a few meals as of `version`
+
+        When another process has written since the values were built, the
+        marks are read for just these meals rather than rebuilding everyone.
+        """
+        with self._lock:
+            if self.sequence == version or not meal_ids:
+                return {meal_id: self.marks.get(meal_id, 0.0) for meal_id in meal_ids}
+        trades = last_trades(meal_ids)
+        quotes = book_quotes(meal_ids)
+        return {
+            meal_id: mark_price(*quotes.get(meal_id, (None, None)), trades.get(meal_id))
+            for meal_id in meal_ids
+        }
+
+    def short_mark(self, meal_id):
+        with self._lock:
+            return self.short_marks.get(meal_id, 0.0)
+
+    def margin_breaches(self):
+        """Usernames below the maintenance margin, furthest below first"""
+        with self._lock:
+            return sorted(self.breaches, key=lambda username: self.net_worth[username] / self.exposure[username])
+
+    def leaderboard(self, limit):
+        """The `limit` richest users, highest net worth first"""
+        with self._lock:
+            return [
+                dict(self.user(username), rank=rank)
+                for rank, (_, username) in enumerate(self.ranking[:limit], 1)
+            ]
+
+    def _move_shares(self, username, meal_id, quantity):
+        holdings = self.positions.setdefault(username, {})
+        shares = holdings.get(meal_id, 0) + quantity
+        if shares:
+            holdings[meal_id] = shares
+            self.holders.setdefault(meal_id, set()).add(username)
+        else:
+            holdings.pop(meal_id, None)
+            self.holders.get(meal_id, set()).discard(username)
+
+    def _mark(self, meal_id):
+        best_bid, best_ask = self.quotes.get(meal_id, (None, None))
+        return mark_price(best_bid, best_ask, self.last_trade.get(meal_id))
+
+    def _short_mark(self, meal_id):
+        _, best_ask = self.quotes.get(meal_id, (None, None))
+        return short_mark_price(best_ask, self.last_trade.get(meal_id))
+
+    def _revalue(self, username):
+        holdings = self.positions.get(username, {})
+        value = self.cash.get(username, 0.0) + sum(
+            shares * self.marks.get(meal_id, 0.0)
+            for meal_id, shares in holdings.items()
+        )
+        previous = self.net_worth.get(username)
+        if previous is not None:
+            self.ranking.discard((-previous, username))
+        self.net_worth[username] = value
+        self.ranking.add((-value, username))
+
+        exposure = sum(
+            -shares * self.short_marks.get(meal_id, 0.0)
+            for meal_id, shares in holdings.items() if shares < 0
+        )
+        self.exposure[username] = exposure
+        if exposure > 0 and value < SHORT_MAINTENANCE_MARGIN * exposure:
+            self.breaches.add(username)
+        else:
+            self.breaches.discard(username)
+
+
+valuations = Valuations()